@@ -2,7 +2,8 @@ import sys
 import argparse
 import datetime
 import pandas
-import igraph
+
+import graphfile
 
 _first_day = datetime.date(1900, 1, 1)
 
@@ -27,6 +28,9 @@ _computed_columns = {
   'year':    ('pubdate', _pubdate_to_year),
 }
 
+column_choices = ['pmid', 'pubdate', 'pubdays', 'score', 'citcount', 'year']
+filter_choices = ['clinical-only', 'non-clinical-only']
+
 def _get_column_value(articlev, column):
   '''Returns the value of a given article attribute. Passes the article
   attribute value to a function specified by _computed_columns if
@@ -58,27 +62,35 @@ def _article_is_non_clinical(articlev):
       return False
   return True
 
-def _main(input_file_path, output_file_path, columns, filter_method):
-  g = igraph.Graph.Read(input_file_path, format='picklez')
+def required_attrs(columns):
+  '''Returns the node attributes that the table with the given columns reads.'''
+  return set(['type', 'pubtypes'] + [_computed_columns[column][0] if column in _computed_columns else column for column in columns])
 
-  mat = pandas.DataFrame(columns=columns)
+def article_table(g, columns, filter_method = None):
+  '''Returns a data frame with the given columns for the articles of the graph,
+  optionally filtered with "clinical-only" or "non-clinical-only".'''
+  # rows are collected first, since growing the data frame one row at a time copies it every time
+  (indices, rows) = ([], [])
   for (index, articlev) in enumerate(g.vs.select(type='article')):
     if filter_method == 'clinical-only':
       if not _article_is_clinical(articlev): continue
     elif filter_method == 'non-clinical-only':
       if not _article_is_non_clinical(articlev): continue
       
-    row = map(lambda column: _get_column_value(articlev, column), columns)
-    mat.loc[index] = row
+    indices.append(index)
+    rows.append(map(lambda column: _get_column_value(articlev, column), columns))
+  return pandas.DataFrame(rows, index=indices, columns=columns, dtype=object)
 
-  mat.to_csv(output_file_path, mode='w')
+def _main(input_file_path, output_file_path, columns, filter_method):
+  g = graphfile.read(input_file_path, v_attrs=required_attrs(columns), e_attrs=[])
+  article_table(g, columns, filter_method).to_csv(output_file_path, mode='w')
 
 def _parse_args(rawargs):
   p = argparse.ArgumentParser()
-  p.add_argument('--filter', choices=['clinical-only', 'non-clinical-only'])
+  p.add_argument('--filter', choices=filter_choices)
   p.add_argument('input')
   p.add_argument('output')
-  p.add_argument('columns', nargs='+', choices=['pmid', 'pubdate', 'pubdays', 'score', 'citcount', 'year'])
+  p.add_argument('columns', nargs='+', choices=column_choices)
   p.set_defaults(columns=['pubdays'])
   return p.parse_args(rawargs)
 
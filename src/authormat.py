@@ -1,17 +1,14 @@
 import sys
 import collections
+import itertools
+import multiprocessing
 import pandas
 import igraph
 import numpy
 import scipy.stats
 import argparse
 
-def outgoing_counts_of_type(articles, node_type):
-  '''Given a list of article nodes, returns a list of the number of neighbors each article
-  has that match the given type. E.g., if node_type == "author", this will return a list
-  of the number of authors connected to each article node.'''
-
-  return [len([neighbor for neighbor in article.neighbors(mode = igraph.OUT) if neighbor['type'] == node_type]) for article in articles]
+import graphfile
 
 def h_index(counts):
   n = len(counts)
@@ -26,135 +23,210 @@ def h_index(counts):
       return i
   return 0
 
-def tg_score(articles):
-  tg_count = 0
-  total_count = 0
-
-  visited = set()
-
-  for article in articles:
-    for citing_article in filter(lambda n: n['type'] == 'article' and n['pubtypes'] != None, article.neighbors(mode = igraph.OUT)):
-      if citing_article.index in visited: continue
-      visited.add(citing_article.index)
-      total_count += 1
-      for pubtype in map(lambda t: t.lower(), citing_article['pubtypes']):
-        if not ('trial' in pubtype or 'guideline' in pubtype): continue
-        tg_count += 1
-        break
-  if total_count == 0:
-    return 0
-  else:
-    return tg_count / float(total_count)
-
-def lists_of_co_authors(articles, author_name):
-  '''Returns a nested list, where each sublist is a list of co-authors for each article.
-  This will filter out all authors who match the given author_name.'''
-
-  # Unfortunately a one-liner for speed reasons
-  return [[author['label'] for author in article.neighbors(mode = igraph.OUT) if (author['type'] == 'author' and not author['label'].lower().startswith(author_name))] for article in articles]
-
-def flatten(list_of_lists):
-  '''Takes a nested list and returns a single-level list.'''
-  return [elem for a_list in list_of_lists for elem in a_list]
-
-def calc_co_author_freqs_and_uniqueness(articles, author_name):
-  '''Returns the tuple (dict, float). The first value is a dictionary of co-author frequencies
-  across all given articles. The second is the co-author uniqueness. This is the ratio of
-  the number of unique co-authors to the total number of co-authors.'''
-
-  co_authors_lists = lists_of_co_authors(articles, author_name)
-  all_co_authors = flatten(co_authors_lists)
-  if len(all_co_authors) == 0:
-    return (None, None)
-  co_authors_counts = collections.Counter(all_co_authors)
-  num_articles = float(len(co_authors_lists))
-  freqs = [count / num_articles for count in co_authors_counts.values()]
-
-  num_unique_authors = len(co_authors_counts)
-  uniqueness = num_unique_authors / float(len(all_co_authors))
-
-  return (freqs, uniqueness)
-
-def calc_metrics(graph_file_path, mat):
-  '''Calculates the values for each column for the given
-  graph_file_path and stores in the in the matrix.'''
-  g = igraph.Graph.Read(graph_file_path, format='picklez')
+class _ArticleNeighbors:
+  '''The out-neighbors of the given articles of the author and their types, pulled out of
+  the graph once as arrays, so each metric is computed with array operations instead of
+  walking the neighbor vertices again.'''
+
+  def __init__(self, g, author_name, articles):
+    self.author_name = author_name
+    self.num_articles = len(articles)
+    self.labels = g.vs['label']
+    self.pubtypes = g.vs['pubtypes'] if 'pubtypes' in g.vs.attribute_names() else [None] * g.vcount()
+    node_types = g.vs['type']
+    self.type_codes = dict((node_type, code) for (code, node_type) in enumerate(sorted(set(node_types))))
+    self.types = numpy.fromiter((self.type_codes[node_type] for node_type in node_types), dtype=numpy.int64, count=len(node_types))
+
+    # igraph returns each article's neighbors as a list of indices, in the same order as
+    # article.neighbors, without making a vertex object for every neighbor
+    neighbor_lists = [g.neighbors(article, mode = igraph.OUT) for article in articles]
+    num_neighbors = numpy.fromiter(itertools.imap(len, neighbor_lists), dtype=numpy.int64, count=len(articles))
+    self.neighbors = numpy.fromiter(itertools.chain.from_iterable(neighbor_lists), dtype=numpy.int64, count=num_neighbors.sum())
+    neighbor_articles = numpy.repeat(numpy.arange(len(articles)), num_neighbors)
+    num_types = len(self.type_codes)
+    self.type_counts = numpy.bincount(neighbor_articles * num_types + self.types[self.neighbors], minlength=len(articles) * num_types).reshape(len(articles), num_types)
+
+  def _neighbors_of_type(self, node_type):
+    if node_type not in self.type_codes:
+      return self.neighbors[:0]
+    return self.neighbors[self.types[self.neighbors] == self.type_codes[node_type]]
+
+  def counts_of_type(self, node_type):
+    '''Returns a list of the number of neighbors each article has that match the given type.
+    E.g., if node_type == "author", this will return a list of the number of authors
+    connected to each article node.'''
+    if node_type not in self.type_codes:
+      return [0] * self.num_articles
+    return self.type_counts[:, self.type_codes[node_type]].tolist()
+
+  def co_author_freqs_and_uniqueness(self):
+    '''Returns the tuple (list, float). The first value is the list of co-author frequencies
+    across all articles. The second is the co-author uniqueness. This is the ratio of
+    the number of unique co-authors to the total number of co-authors. Authors whose
+    label starts with the author name are not co-authors.'''
+    authors = self._neighbors_of_type('author')
+    (author_nodes, first_positions, counts) = numpy.unique(authors, return_index=True, return_counts=True)
+    is_co_author = [not self.labels[v].lower().startswith(self.author_name) for v in author_nodes.tolist()]
+    (co_authors, first_positions, counts) = (author_nodes[is_co_author], first_positions[is_co_author], counts[is_co_author])
+    if len(co_authors) == 0:
+      return (None, None)
+
+    # co-authors are counted by label, which different nodes could share
+    count_by_label = collections.defaultdict(int)
+    for (v, count) in zip(co_authors.tolist(), counts.tolist()):
+      count_by_label[self.labels[v]] += count
+    # the frequencies are listed in the order that a Counter of the co-author labels would list
+    # them, since their sums depend on the order; a dict with the same keys inserted in the
+    # order they first appear iterates in that order
+    label_order = dict.fromkeys(self.labels[v] for v in co_authors[numpy.argsort(first_positions)].tolist())
+    num_articles = float(self.num_articles)
+    freqs = [count_by_label[label] / num_articles for label in label_order]
+
+    uniqueness = len(count_by_label) / float(counts.sum())
+    return (freqs, uniqueness)
+
+  def tg_score(self):
+    '''Returns the fraction of the distinct articles citing the articles that are trials or
+    guidelines, among the citing articles with pubtypes, or 0 if there are none.'''
+    citing_articles = numpy.unique(self._neighbors_of_type('article')).tolist()
+    citing_pubtypes = [self.pubtypes[v] for v in citing_articles if self.pubtypes[v] != None]
+    if len(citing_pubtypes) == 0:
+      return 0
+    tg_count = sum(1 for pubtypes in citing_pubtypes if any('trial' in pubtype.lower() or 'guideline' in pubtype.lower() for pubtype in pubtypes))
+    return tg_count / float(len(citing_pubtypes))
+
+columns = [
+  'mean-co-authors', 'median-co-authors', 'sd-co-authors', 'skew-co-authors', 'kurt-co-authors',
+  'num-articles-over-20-coauthors',
+  'mean-institutions', 'median-institutions', 'sd-institutions',
+  'mean-grant-agencies', 'median-grant-agencies', 'sd-grant-agencies',
+  'delta-pub-years', 'mean-pub-years', 'median-pub-years', 'sd-pub-years', 'skew-pub-years', 'kurt-pub-years',
+  'mean-collab-freq', 'median-collab-freq', 'sd-collab-freq', 'collab-uniqueness',
+  'h-index', 'max-citations', 'tg-score']
+
+def calc_metrics(graph_file_path):
+  '''Calculates the values of the columns for the given graph_file_path. Returns the tuple
+  (author name, dictionary of column values), which leaves out the columns that can't be
+  calculated, or None if the author has no articles.'''
+  g = graphfile.read(graph_file_path, v_attrs=['type', 'label', 'pubdate', 'citcount', 'pubtypes'], e_attrs=[])
   author_name = g['name'].lower()
   author = g.vs.find(label = author_name, type='author')
 
-  level_1_articles = author.neighbors(mode = igraph.OUT)
+  level_1_articles = g.neighbors(author.index, mode = igraph.OUT)
   if len(level_1_articles) == 0:
-    return
+    return None
 
-  coauthor_counts = outgoing_counts_of_type(level_1_articles, 'author')
-  coauthor_freqs, coauthor_uniqueness = calc_co_author_freqs_and_uniqueness(level_1_articles, author_name)
-  institution_counts = outgoing_counts_of_type(level_1_articles, 'institution')
-  grantagency_counts = outgoing_counts_of_type(level_1_articles, 'grantagency')
-  article_years = [article['pubdate'] / 10000 for article in level_1_articles if article['pubdate'] != None]
-  #citcounts = outgoing_counts_of_type(level_1_articles, 'article')
-  citcounts = [article['citcount'] for article in level_1_articles if article['citcount'] != None]
+  neighbors = _ArticleNeighbors(g, author_name, level_1_articles)
+  coauthor_counts = neighbors.counts_of_type('author')
+  coauthor_freqs, coauthor_uniqueness = neighbors.co_author_freqs_and_uniqueness()
+  institution_counts = neighbors.counts_of_type('institution')
+  grantagency_counts = neighbors.counts_of_type('grantagency')
+  (pubdates, citcounts) = (g.vs['pubdate'], g.vs['citcount'])
+  article_years = [pubdates[article] / 10000 for article in level_1_articles if pubdates[article] != None]
+  #citcounts = neighbors.counts_of_type('article')
+  citcounts = [citcounts[article] for article in level_1_articles if citcounts[article] != None]
 
-  mat.loc[author_name] = float('nan')
+  metrics = {}
 
   if coauthor_counts:
-    mat['mean-co-authors'][author_name] = numpy.mean(coauthor_counts)
-    mat['median-co-authors'][author_name] = numpy.median(coauthor_counts)
-    mat['sd-co-authors'][author_name] = numpy.std(coauthor_counts)
-    mat['skew-co-authors'][author_name] = scipy.stats.skew(coauthor_counts)
-    mat['kurt-co-authors'][author_name] = scipy.stats.kurtosis(coauthor_counts)
-    mat['num-articles-over-20-coauthors'][author_name] = len([count for count in coauthor_counts if count >= 20])
+    metrics['mean-co-authors'] = numpy.mean(coauthor_counts)
+    metrics['median-co-authors'] = numpy.median(coauthor_counts)
+    metrics['sd-co-authors'] = numpy.std(coauthor_counts)
+    metrics['skew-co-authors'] = scipy.stats.skew(coauthor_counts)
+    metrics['kurt-co-authors'] = scipy.stats.kurtosis(coauthor_counts)
+    metrics['num-articles-over-20-coauthors'] = len([count for count in coauthor_counts if count >= 20])
 
   if institution_counts:
-    mat['mean-institutions'][author_name] = numpy.mean(institution_counts)
-    mat['median-institutions'][author_name] = numpy.median(institution_counts)
-    mat['sd-institutions'][author_name] = numpy.std(institution_counts)
+    metrics['mean-institutions'] = numpy.mean(institution_counts)
+    metrics['median-institutions'] = numpy.median(institution_counts)
+    metrics['sd-institutions'] = numpy.std(institution_counts)
 
   if grantagency_counts:
-    mat['mean-grant-agencies'][author_name] = numpy.mean(grantagency_counts)
-    mat['median-grant-agencies'][author_name] = numpy.median(grantagency_counts)
-    mat['sd-grant-agencies'][author_name] = numpy.std(grantagency_counts)
+    metrics['mean-grant-agencies'] = numpy.mean(grantagency_counts)
+    metrics['median-grant-agencies'] = numpy.median(grantagency_counts)
+    metrics['sd-grant-agencies'] = numpy.std(grantagency_counts)
 
   if article_years:
-    mat['delta-pub-years'][author_name] = max(article_years) - min(article_years)
-    mat['mean-pub-years'][author_name] = numpy.mean(article_years)
-    mat['median-pub-years'][author_name] = numpy.median(article_years)
-    mat['sd-pub-years'][author_name] = numpy.std(article_years)
-    mat['skew-pub-years'][author_name] = scipy.stats.skew(article_years)
-    mat['kurt-pub-years'][author_name] = scipy.stats.kurtosis(article_years)
+    metrics['delta-pub-years'] = max(article_years) - min(article_years)
+    metrics['mean-pub-years'] = numpy.mean(article_years)
+    metrics['median-pub-years'] = numpy.median(article_years)
+    metrics['sd-pub-years'] = numpy.std(article_years)
+    metrics['skew-pub-years'] = scipy.stats.skew(article_years)
+    metrics['kurt-pub-years'] = scipy.stats.kurtosis(article_years)
 
   if coauthor_freqs:
-    mat['mean-collab-freq'][author_name] = numpy.mean(coauthor_freqs)
-    mat['median-collab-freq'][author_name] = numpy.median(coauthor_freqs)
-    mat['sd-collab-freq'][author_name] = numpy.std(coauthor_freqs)
-    mat['collab-uniqueness'][author_name] = coauthor_uniqueness
+    metrics['mean-collab-freq'] = numpy.mean(coauthor_freqs)
+    metrics['median-collab-freq'] = numpy.median(coauthor_freqs)
+    metrics['sd-collab-freq'] = numpy.std(coauthor_freqs)
+    metrics['collab-uniqueness'] = coauthor_uniqueness
 
   if citcounts:
-    mat['h-index'][author_name] = h_index(citcounts)
-    mat['max-citations'][author_name] = max(citcounts)
+    metrics['h-index'] = h_index(citcounts)
+    metrics['max-citations'] = max(citcounts)
 
   if level_1_articles:
-    mat['tg-score'][author_name] = tg_score(level_1_articles)
-
-def write_matrix(graph_file_paths, output_file_path):
-  mat = pandas.DataFrame(columns = [
-    'mean-co-authors', 'median-co-authors', 'sd-co-authors', 'skew-co-authors', 'kurt-co-authors',
-    'num-articles-over-20-coauthors',
-    'mean-institutions', 'median-institutions', 'sd-institutions',
-    'mean-grant-agencies', 'median-grant-agencies', 'sd-grant-agencies',
-    'delta-pub-years', 'mean-pub-years', 'median-pub-years', 'sd-pub-years', 'skew-pub-years', 'kurt-pub-years',
-    'mean-collab-freq', 'median-collab-freq', 'sd-collab-freq', 'collab-uniqueness',
-    'h-index', 'max-citations', 'tg-score'])
-  for graph_file_path in graph_file_paths:
-    calc_metrics(graph_file_path, mat)
-  mat.to_csv(output_file_path, mode='w')
+    metrics['tg-score'] = neighbors.tg_score()
+
+  return (author_name, metrics)
+
+def _try_calc_metrics(graph_file_path):
+  '''Returns the tuple (graph_file_path, result of calc_metrics, error message). Errors are
+  returned instead of raised, so one unreadable file doesn't stop the other files.'''
+  try:
+    return (graph_file_path, calc_metrics(graph_file_path), None)
+  except Exception as e:
+    return (graph_file_path, None, '%s: %s' % (type(e).__name__, e))
+
+def build_matrix(results):
+  '''Returns the matrix of the (author name, metrics) results of calc_metrics, with one row
+  per author. An author listed more than once keeps the position of its first row and
+  the metrics of its last one. Results that are None are skipped.'''
+  rows = collections.OrderedDict()
+  for result in results:
+    if result == None: continue
+    (author_name, metrics) = result
+    rows[author_name] = metrics
+  # object columns keep integer metrics like h-index as integers, like the rows used to
+  values = [[metrics.get(column, float('nan')) for column in columns] for metrics in rows.values()]
+  return pandas.DataFrame(values, index=rows.keys(), columns=columns, dtype=object)
+
+def write_matrix(graph_file_paths, output_file_path, processes = 1):
+  '''Writes the matrix of the given graph files, calculating their metrics in the given
+  number of processes. Files that can't be read are skipped and reported on stderr.'''
+  if processes > 1:
+    pool = multiprocessing.Pool(processes)
+    chunk_size = max(1, len(graph_file_paths) / (processes * 8))
+    outcomes = pool.imap(_try_calc_metrics, graph_file_paths, chunk_size)
+  else:
+    pool = None
+    outcomes = itertools.imap(_try_calc_metrics, graph_file_paths)
+
+  results = []
+  failed_paths = []
+  try:
+    for (graph_file_path, result, error) in outcomes:
+      if error != None:
+        print >> sys.stderr, 'Skipping %s: %s' % (graph_file_path, error)
+        failed_paths.append(graph_file_path)
+        continue
+      results.append(result)
+  finally:
+    if pool != None:
+      pool.close()
+      pool.join()
+
+  build_matrix(results).to_csv(output_file_path, mode='w')
+  if failed_paths:
+    print >> sys.stderr, 'Skipped %d of %d files' % (len(failed_paths), len(graph_file_paths))
+  return failed_paths
 
 def calc_coauthor_counts(graph_file_path, output_file):
-  g = igraph.Graph.Read(graph_file_path, format='picklez')
+  g = graphfile.read(graph_file_path, v_attrs=['type', 'label'], e_attrs=[])
   author_name = g['name'].lower()
   author = g.vs.find(label = author_name, type='author')
 
-  level_1_articles = author.neighbors(mode = igraph.OUT)
-  coauthor_counts = outgoing_counts_of_type(level_1_articles, 'author')
+  level_1_articles = g.neighbors(author.index, mode = igraph.OUT)
+  coauthor_counts = _ArticleNeighbors(g, author_name, level_1_articles).counts_of_type('author')
 
   output_file.write(author_name)
   output_file.write('\n')
@@ -169,6 +241,7 @@ def write_coauthor_counts(graph_file_paths, output_file_path):
 def _parse_args(raw_args):
   parser = argparse.ArgumentParser()
   parser.add_argument('--type', choices=['matrix', 'coauthor_counts'], default='matrix')
+  parser.add_argument('--processes', type=int, default=1, help='the number of processes that calculate the matrix')
   parser.add_argument('output')
   parser.add_argument('inputs', nargs='+')
   return parser.parse_args(raw_args)
@@ -176,6 +249,6 @@ def _parse_args(raw_args):
 if __name__ == '__main__':
   args = _parse_args(sys.argv[1:])
   if args.type == 'matrix':
-    write_matrix(args.inputs, args.output)
+    write_matrix(args.inputs, args.output, args.processes)
   elif args.type == 'coauthor_counts':
     write_coauthor_counts(args.inputs, args.output)
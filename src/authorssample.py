@@ -1,6 +1,5 @@
 import sys
 import argparse
-import random
 import collections
 import codecs
 
@@ -34,6 +33,7 @@ class AuthorsSample:
 
   def close(self):
     self.wosclient.close()
+    self.pmclient.close()
 
   def _first_author(self, ref):
     authors = ref.get('authors')
@@ -42,31 +42,30 @@ class AuthorsSample:
     else:
       return authors[0][0]
 
-  def _add_wos_data(self, ref):
-    '''Takes an article dictionary and adds article data from WoS.'''
-    if not 'title' in ref or not ref['title'] or not 'authors' in ref or not self._first_author(ref):
-      return
-    wosrefs = self.wosclient.search(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year'))
-    if len(wosrefs) == 1:
-      ref.update(wosrefs[0])
+  def _add_wos_data(self, refs):
+    '''Takes a list of article dictionaries and adds article data from WoS.'''
+    refs = [ref for ref in refs if ref.get('title') and 'authors' in ref and self._first_author(ref)]
+    searches = [(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year')) for ref in refs]
+    for (ref, wosrefs) in zip(refs, self.wosclient.search_many(searches)):
+      if len(wosrefs) == 1:
+        ref.update(wosrefs[0])
 
-  def run(self, output_path, num_samples, sample_size, mesh_terms):
+  def run(self, output_path, num_samples, sample_size, mesh_terms, max_author_articles = None):
     output_file = codecs.open(output_path, 'w', encoding = 'utf-8')
     query = _create_mesh_terms_query(mesh_terms)
-    all_articles = self.pmclient.search_for_papers(query)
 
     for i in range(num_samples):
       output_file.write('# Sample %d\n' % i)
-      article_sample = random.sample(all_articles, sample_size)
+      # only the sampled PMIDs are downloaded, not every article under the MeSH terms
+      article_sample = self.pmclient.sample_papers(query, sample_size)
       self.pmclient.add_pubmed_data(article_sample)
       last_authors = [article['authors'][-1][0] for article in article_sample if ('authors' in article) and (len(article['authors']) > 0)]
 
       for author in last_authors:
-        articles_by_author = self.pmclient.search_for_papers(_create_mesh_terms_by_author(mesh_terms, author))
+        articles_by_author = self.pmclient.search_for_papers(_create_mesh_terms_by_author(mesh_terms, author), max_author_articles)
 
         self.pmclient.add_pubmed_data(articles_by_author)
-        for article in articles_by_author:
-          self._add_wos_data(article)
+        self._add_wos_data(articles_by_author)
 
         institutes = _most_common_institute(articles_by_author)
         if not institutes or institutes[0][1] < 2:
@@ -83,13 +82,14 @@ def _parse_args(raw_args):
   p.add_argument('--num-samples', type=int, required=True)
   p.add_argument('--sample-size', type=int, required=True)
   p.add_argument('--mesh-terms', nargs='+', required=True)
+  p.add_argument('--max-author-articles', type=int, required=False, help='look at no more than this many articles of each sampled author')
   return p.parse_args(raw_args)
 
 if __name__ == '__main__':
   p = _parse_args(sys.argv[1:])
   aus = AuthorsSample()
   try:
-    aus.run(p.output, p.num_samples, p.sample_size, p.mesh_terms)
+    aus.run(p.output, p.num_samples, p.sample_size, p.mesh_terms, p.max_author_articles)
   finally:
     aus.close()
 
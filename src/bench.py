@@ -0,0 +1,676 @@
+import sys
+import time
+import argparse
+import copy
+import collections
+import random
+import os
+import shutil
+import tempfile
+import multiprocessing
+from io import BytesIO
+import lxml.etree
+import igraph
+import pandas
+
+import util
+import wos
+import pubmed
+import clinicaltrials
+import litnet
+import graphfile
+import score
+import authormat
+
+def _time(func, repeat):
+  '''Calls func repeat times and returns the tuple (last result, best time in seconds).'''
+  best = None
+  result = None
+  for i in range(repeat):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    best = elapsed if best == None else min(best, elapsed)
+  return (result, best)
+
+def _report(name, baseline_name, baseline_secs, new_name, new_secs, num_items, item_name):
+  print '%s: %d %s' % (name, num_items, item_name)
+  print '  %-12s %9.2f ms  %9.1f us/%s' % (baseline_name, baseline_secs * 1e3, baseline_secs * 1e6 / max(num_items, 1), item_name.rstrip('s'))
+  print '  %-12s %9.2f ms  %9.1f us/%s' % (new_name, new_secs * 1e3, new_secs * 1e6 / max(num_items, 1), item_name.rstrip('s'))
+  print '  speedup      %9.1fx' % (baseline_secs / new_secs if new_secs > 0 else float('inf'))
+
+_wos_ns = 'http://scientific.thomsonreuters.com/schema/wok5.4/public/FullRecord'
+
+def _synthetic_wos_records(num_records, num_authors):
+  '''Returns the "records" XML of a WoS results page with num_records records,
+  each with num_authors authors and one address per ten authors.'''
+  recs = []
+  for i in range(num_records):
+    num_addresses = max(num_authors / 10, 1)
+    names = ''.join('<name seq_no="%d" role="author" addr_no="%d"><display_name>Author %d</display_name><wos_standard>Author%d, A</wos_standard></name>' % (j, j % num_addresses + 1, j, j) for j in range(1, num_authors + 1))
+    addresses = ''.join('<address_name><address_spec addr_no="%d"><full_address>%d Main St, City</full_address><organizations count="2"><organization>Org %d</organization><organization pref="Y">Pref Org %d</organization></organizations></address_spec></address_name>' % (j, j, j, j) for j in range(1, num_addresses + 1))
+    recs.append(
+      '<REC><UID>WOS:%012d</UID><static_data><summary>'
+      '<pub_info issue="%d" vol="%d" sortdate="2014-03-%02d" pubyear="2014"/>'
+      '<titles count="2"><title type="source">JOURNAL %d</title><title type="item">Title of record %d</title></titles>'
+      '<names count="%d">%s</names></summary>'
+      '<fullrecord_metadata><addresses count="%d">%s</addresses></fullrecord_metadata></static_data>'
+      '<dynamic_data><citation_related><tc_list><silo_tc coll_id="WOS" local_count="%d"/></tc_list></citation_related></dynamic_data></REC>'
+      % (i, i % 12 + 1, i % 50 + 1, i % 28 + 1, i, i, num_authors, names, num_addresses, addresses, i))
+  return '<records xmlns="%s">%s</records>' % (_wos_ns, ''.join(recs))
+
+def _convert_wos_record_xpath(record, ns):
+  """
+  Takes an XML tree of a single WoS record and returns a dictionary
+  representing the record's information. This is the XPath-based version
+  that wos._convert_wos_record replaced.
+
+  Args:
+    record: An XML tree, where the root is the 'REC' tag
+    ns: A dictionary that contains the key 'ns' whose value is the null XML namespace.
+
+  Returns:
+    A dictionary representing the record's information
+    with the following keys and value types:
+      wosid:        unicode
+      title:        unicode
+      journal:      unicode
+      issue:        unicode
+      volume:       unicode
+      pubdate:      int
+      institutions: {int: (unicode, [unicode])}
+      authors:      [(unicode, [int])]
+      citcount:     int
+  """
+
+  r = dict()
+  r['wosid'] = util.xpath_str(record, "ns:UID/text()", ns)
+  r['title'] = util.xpath_str(record, "ns:static_data/ns:summary/ns:titles/ns:title[@type='item']/text()",ns)
+  r['journal'] = util.xpath_str(record, "ns:static_data/ns:summary/ns:titles/ns:title[@type='source']/text()", ns)
+  pubinfo = util.xpath_nodes(record, "ns:static_data/ns:summary/ns:pub_info", ns)[0]
+  (r['issue'], r['volume'], pubdate) = (pubinfo.attrib.get('issue'), pubinfo.attrib.get('vol'), pubinfo.attrib.get('sortdate'))
+  if pubdate:
+    m = wos._date_re.match(pubdate)
+    r['pubdate'] = int(m.group('yr') + m.group('mon') + m.group('day'))
+
+  r['institutions'] = {}
+  num_institutions = int(util.xpath_nodes(record, "ns:static_data/ns:fullrecord_metadata/ns:addresses", ns)[0].attrib['count'])
+  for institution_tag in util.xpath_nodes(record, "ns:static_data/ns:fullrecord_metadata/ns:addresses/ns:address_name/ns:address_spec", ns):
+    index = int(institution_tag.attrib['addr_no'])
+    address = util.xpath_str(institution_tag, "ns:full_address/text()", ns)
+    organizations = util.xpath_strs(institution_tag, "ns:organizations/ns:organization/text()", ns)
+
+    r['institutions'][index] = (address, organizations)
+
+  r['authors'] = []
+  num_authors = int(util.xpath_nodes(record, "ns:static_data/ns:summary/ns:names", ns)[0].attrib['count'])
+  for i in range(1, num_authors + 1):
+    author_tag = util.xpath_nodes(record, "ns:static_data/ns:summary/ns:names/ns:name[@seq_no=$seq_no]", ns, seq_no=str(i))[0]
+    author_name = util.xpath_str(author_tag, "ns:wos_standard/text()", ns)
+    if author_name == None: continue
+    affiliation_indices = map(int, author_tag.attrib['addr_no'].split(' ')) if 'addr_no' in author_tag.attrib else None
+
+    r['authors'].append((author_name, affiliation_indices))
+
+  cittag = util.xpath_nodes(record, "ns:dynamic_data/ns:citation_related/ns:tc_list/ns:silo_tc[@coll_id='WOS']/@local_count", ns)
+  if cittag:
+    r['citcount'] = int(cittag[0])
+
+  return r
+
+def _convert_wos_page_xpath(records_xml):
+  doc = lxml.etree.fromstring(records_xml)
+  ns = {'ns': doc.nsmap[None]}
+  return [_convert_wos_record_xpath(record, ns) for record in doc.xpath('/ns:records/ns:REC', namespaces=ns)]
+
+def _convert_wos_page(records_xml):
+  return list(wos._iter_page_records(records_xml))
+
+def bench_wos_records(args):
+  '''Compares the XPath-based WoS record converter with the single-pass converter.'''
+  if args.inputs:
+    pages = []
+    for path in args.inputs:
+      with open(path, 'rb') as input_file:
+        pages.append(input_file.read())
+  else:
+    pages = [_synthetic_wos_records(args.records, args.authors)]
+
+  (old_results, old_secs) = _time(lambda: [_convert_wos_page_xpath(page) for page in pages], args.repeat)
+  (new_results, new_secs) = _time(lambda: [_convert_wos_page(page) for page in pages], args.repeat)
+  if old_results != new_results:
+    raise Exception('The converters returned different records')
+
+  num_records = sum(len(page_results) for page_results in new_results)
+  _report('WoS record conversion', 'xpath', old_secs, 'single-pass', new_secs, num_records, 'records')
+
+def _synthetic_pubmed_articles(num_articles):
+  '''Returns an efetch response with num_articles PubMed articles whose PMIDs are 1 to num_articles.'''
+  articles = []
+  for i in range(1, num_articles + 1):
+    authors = ''.join('<Author><LastName>Author%d</LastName><Initials>A</Initials><Affiliation>Dept %d, Univ %d</Affiliation></Author>' % (j, j, i % 100) for j in range(i % 7 + 1))
+    articles.append(
+      '<PubmedArticle><MedlineCitation><PMID>%d</PMID><Article><ArticleTitle>Title of article %d</ArticleTitle>'
+      '<AuthorList>%s</AuthorList><GrantList><Grant><Agency>Agency %d</Agency></Grant></GrantList>'
+      '<PublicationTypeList><PublicationType>Journal Article</PublicationType></PublicationTypeList></Article>'
+      '<MedlineJournalInfo><MedlineTA>J Bench</MedlineTA></MedlineJournalInfo>'
+      '<MeshHeadingList><MeshHeading><DescriptorName>Term %d</DescriptorName></MeshHeading></MeshHeadingList></MedlineCitation>'
+      '<PubmedData><History><PubMedPubDate PubStatus="pubmed"><Year>2010</Year><Month>%d</Month><Day>%d</Day></PubMedPubDate></History>'
+      '<ArticleIdList><ArticleId IdType="pubmed">%d</ArticleId></ArticleIdList></PubmedData></PubmedArticle>'
+      % (i, i, authors, i % 20, i % 50, i % 12 + 1, i % 28 + 1, i))
+  return '<?xml version="1.0"?>\n<PubmedArticleSet>%s</PubmedArticleSet>' % ''.join(articles)
+
+def _merge_pubmed_linear(refs, content):
+  '''The merge add_pubmed_data used to do: parse the whole response, then
+  find the ref of each article by scanning the list of refs.'''
+  doc = lxml.etree.parse(BytesIO(content), lxml.etree.XMLParser(recover=True, encoding='utf-8'))
+  for article in doc.xpath('/PubmedArticleSet/PubmedArticle'):
+    pubmed_ref = pubmed._article_to_pubmed_ref(article)
+    for ref in refs:
+      if 'pmid' in ref and ref['pmid'] == pubmed_ref['pmid']:
+        ref.update(pubmed_ref)
+        break
+  return refs
+
+def _merge_pubmed_indexed(refs, content):
+  refs_by_pmid = pubmed._refs_by_pmid(refs)
+  for article in pubmed._iter_articles(content):
+    pubmed_ref = pubmed._article_to_pubmed_ref(article)
+    for ref in refs_by_pmid.get(pubmed_ref['pmid'], []):
+      ref.update(pubmed_ref)
+  return refs
+
+def bench_pubmed_merge(args):
+  '''Compares merging efetch results into a layer of refs by scanning the refs
+  with merging them through a PMID index while the response is parsed.'''
+  for num_refs in args.refs:
+    content = _synthetic_pubmed_articles(num_refs)
+    # refs arrive in a different order than the articles, like they do from a crawl
+    refs = [{'pmid': unicode(pmid)} for pmid in reversed(range(1, num_refs + 1))]
+
+    (new_results, new_secs) = _time(lambda: _merge_pubmed_indexed(copy.deepcopy(refs), content), args.repeat)
+    if num_refs > args.max_baseline_refs:
+      print 'PubMed merge: %d refs' % num_refs
+      print '  %-12s %9.2f ms  (the linear merge is skipped above %d refs)' % ('indexed', new_secs * 1e3, args.max_baseline_refs)
+      continue
+    (old_results, old_secs) = _time(lambda: _merge_pubmed_linear(copy.deepcopy(refs), content), args.repeat)
+    if old_results != new_results:
+      raise Exception('The merges returned different refs')
+    _report('PubMed merge', 'linear', old_secs, 'indexed', new_secs, num_refs, 'refs')
+
+def _synthetic_clinical_trials(num_trials):
+  '''Returns a list of num_trials clinical_study documents with five references each.'''
+  docs = []
+  for i in range(num_trials):
+    refs = ''.join('<reference><citation>Author%d A, Other B. Title of reference %d. J Bench. 2010 Jan;%d(2):%d-%d.</citation><PMID>%d</PMID></reference>'
+                   % (j, j, i % 50 + 1, j * 10, j * 10 + 9, i * 10 + j) for j in range(1, 6))
+    xml = ('<clinical_study><id_info><nct_id>NCT%08d</nct_id></id_info><brief_title>Trial %d</brief_title>'
+           '<completion_date>January 2012</completion_date>%s</clinical_study>' % (i, i, refs))
+    docs.append(lxml.etree.ElementTree(lxml.etree.fromstring(xml)))
+  return docs
+
+def _uncompiled_xpath(path, ns = None):
+  '''Stands in for util.compiled_xpath, but parses the expression on every call like doc.xpath does.'''
+  return lambda doc, **variables: doc.xpath(path, namespaces=ns, **variables)
+
+def _time_xpath_parser(parse, items, repeat):
+  '''Times parse over items with expressions parsed on every call and with compiled expressions.'''
+  compiled_xpath = util.compiled_xpath
+  util.compiled_xpath = _uncompiled_xpath
+  try:
+    (old_results, old_secs) = _time(lambda: [parse(item) for item in items], repeat)
+  finally:
+    util.compiled_xpath = compiled_xpath
+  (new_results, new_secs) = _time(lambda: [parse(item) for item in items], repeat)
+  if old_results != new_results:
+    raise Exception('The parsers returned different results')
+  return (old_secs, new_secs)
+
+def bench_xpath(args):
+  '''Compares the per-record cost of the XPath-based parsers when every expression is
+  parsed on each call with their cost when the expressions come from util.compiled_xpath.'''
+  # _iter_articles frees each article once it's consumed, so the articles are kept in a whole document
+  articles = list(lxml.etree.fromstring(_synthetic_pubmed_articles(args.records)).iterchildren())
+  (old_secs, new_secs) = _time_xpath_parser(pubmed._article_to_pubmed_ref, articles, args.repeat)
+  _report('PubMed article parsing', 'uncompiled', old_secs, 'compiled', new_secs, len(articles), 'records')
+
+  doc = lxml.etree.fromstring(_synthetic_wos_records(args.records, args.authors))
+  ns = {'ns': doc.nsmap[None]}
+  records = list(doc.iterchildren())
+  (old_secs, new_secs) = _time_xpath_parser(lambda record: _convert_wos_record_xpath(record, ns), records, args.repeat)
+  _report('WoS record parsing', 'uncompiled', old_secs, 'compiled', new_secs, len(records), 'records')
+
+  trials = _synthetic_clinical_trials(args.records)
+  (old_secs, new_secs) = _time_xpath_parser(clinicaltrials._parse_clinical_trial, trials, args.repeat)
+  _report('Clinical trial parsing', 'uncompiled', old_secs, 'compiled', new_secs, len(trials), 'records')
+
+class _UnbufferedLitNet(litnet.LitNet):
+  '''LitNet as it was before vertices and edges were buffered: each one is added to g right away.'''
+
+  def add_v(self, **attrs):
+    index = self.g.vcount()
+    self.g.add_vertex(**attrs)
+    return index
+
+  def _set_v_attr(self, index, k, v):
+    self.g.vs[index][k] = v
+
+  def _add_unique_edge(self, src, trg, **attrs):
+    eid = self.g.get_eid(src, trg, error = False)
+    if eid < 0:
+      self.g.add_edge(src, trg, **attrs)
+    else:
+      e = self.g.es[eid]
+      for k, v in attrs.items():
+        e[k] = v
+
+def _synthetic_refs(num_refs):
+  '''Returns a list of num_refs refs with authors, institutions, and grant agencies drawn
+  from shared pools, so that most of them are added to the network more than once.
+  Some authors only differ by their initials, like "Author1, A" and "Author1, AB".'''
+  rand = random.Random(0)
+  refs = []
+  for i in range(num_refs):
+    authors = [(u'Author%d, %s' % (rand.randrange(num_refs / 2 + 1), rand.choice([u'A', u'AB', u'ABC', u'B', u'BD'])), None) for j in range(rand.randint(1, 8))]
+    institutions = dict((j, (u'Dept %d, Univ %d' % (j, rand.randrange(num_refs / 20 + 1)), [u'Univ %d' % rand.randrange(num_refs / 20 + 1)])) for j in range(1, rand.randint(1, 3) + 1))
+    refs.append({'pmid': unicode(i + 1), 'title': u'Title of article %d' % i, 'pubdate': 20100101 + i % 28,
+                 'pubtypes': [u'Journal Article'] if i % 3 else [u'Journal Article', u'Clinical Trial, Phase III'], 'meshterms': [[u'Term %d' % (i % 40), u'sub']],
+                 'authors': authors, 'institutions': institutions,
+                 'grantagencies': [u'Agency %d' % rand.randrange(50) for j in range(rand.randint(0, 2))]})
+  return refs
+
+def _build_litnet(net_class, refs):
+  '''Adds refs to a new network of the given class like a crawl does: each ref cites a root
+  or one of the refs before it, and every tenth ref is added again under another parent.'''
+  rand = random.Random(1)
+  net = net_class('bench')
+  root_index = net.add_v(type='drug', label='bench')
+  ref_indices = []
+  for (i, ref) in enumerate(refs):
+    parent_index = rand.choice(ref_indices) if i >= 100 else root_index
+    ref_indices.append(net.add_ref(ref, parent_index))
+    if i % 10 == 9:
+      net.add_ref(refs[rand.randrange(i)], rand.choice(ref_indices))
+  net.finalize()
+  return net
+
+def _litnet_contents(net):
+  g = net.g
+  return ([v.attributes() for v in g.vs], g.get_edgelist(), [e.attributes() for e in g.es])
+
+def bench_litnet_build(args):
+  '''Compares building networks by adding each vertex and edge to the igraph right away
+  with buffering them and adding them all in finalize().'''
+  for num_refs in args.refs:
+    refs = _synthetic_refs(num_refs)
+    (new_net, new_secs) = _time(lambda: _build_litnet(litnet.LitNet, refs), args.repeat)
+    if num_refs > args.max_baseline_refs:
+      print 'LitNet build: %d refs, %d nodes, %d edges' % (num_refs, new_net.g.vcount(), new_net.g.ecount())
+      print '  %-12s %9.2f ms  (the unbuffered build is skipped above %d refs)' % ('buffered', new_secs * 1e3, args.max_baseline_refs)
+      continue
+    (old_net, old_secs) = _time(lambda: _build_litnet(_UnbufferedLitNet, refs), args.repeat)
+    if _litnet_contents(old_net) != _litnet_contents(new_net):
+      raise Exception('The builds returned different networks')
+    _report('LitNet build', 'unbuffered', old_secs, 'buffered', new_secs, num_refs, 'refs')
+
+def _replace_node_with(g, replacee, replacer):
+  for src_idx in g.neighbors(replacee.index, mode = igraph.IN):
+    g.add_edge(src_idx, replacer.index)
+    g.delete_edges(g.get_eid(src_idx, replacee.index))
+  for trg_idx in g.neighbors(replacee.index, mode = igraph.OUT):
+    g.add_edge(replacer.index, trg_idx)
+    g.delete_edges(g.get_eid(replacee.index, trg_idx))
+
+def _remove_dup_authors_by_scan(net):
+  '''The remove_dup_authors LitNet used to have: it looks up every shorter variant of every
+  author by scanning all nodes, and moves the edges of duplicates one at a time.'''
+  for authv in net.g.vs(type='author'):
+    name_pieces = authv['label'].split(' ')
+    if len(name_pieces) != 2:
+      continue
+    last_name, first_initials = (name_pieces[0], name_pieces[1])
+    for n_initials in range(1, len(first_initials)):
+      for dupv in net.g.vs(type='author', label=' '.join([last_name, first_initials[:n_initials]])):
+        _replace_node_with(net.g, dupv, authv)
+
+def _litnet_edge_keys(net):
+  '''Returns the set of edges in net, each given by the type and label of its nodes.'''
+  keys = [(v['type'], v['label']) for v in net.g.vs]
+  return set((keys[src], keys[trg]) for (src, trg) in net.g.get_edgelist())
+
+def bench_dup_authors(args):
+  '''Compares removing duplicate authors by scanning all nodes for each variant of each
+  author with contracting them through a last name index.'''
+  for num_refs in args.refs:
+    refs = _synthetic_refs(num_refs)
+    new_net = _build_litnet(litnet.LitNet, refs)
+    new_copies = [copy.deepcopy(new_net) for i in range(args.repeat)]
+    (_, new_secs) = _time(lambda: new_copies.pop().remove_dup_authors(), args.repeat)
+    num_vs = new_net.g.vcount()
+    new_net.remove_dup_authors()
+    if num_refs > args.max_baseline_refs:
+      print 'Duplicate author removal: %d refs, %d nodes, %d merged' % (num_refs, num_vs, num_vs - new_net.g.vcount())
+      print '  %-12s %9.2f ms  (the scan is skipped above %d refs)' % ('contraction', new_secs * 1e3, args.max_baseline_refs)
+      continue
+    old_net = _build_litnet(litnet.LitNet, refs)
+    old_copies = [copy.deepcopy(old_net) for i in range(args.repeat)]
+    (_, old_secs) = _time(lambda: _remove_dup_authors_by_scan(old_copies.pop()), args.repeat)
+    _remove_dup_authors_by_scan(old_net)
+    if _litnet_edge_keys(old_net) != _litnet_edge_keys(new_net):
+      raise Exception('The duplicate authors were merged differently')
+    _report('Duplicate author removal', 'scan', old_secs, 'contraction', new_secs, num_vs, 'nodes')
+
+def _propagate_pubdates_by_loop(net):
+  '''The propagate_pubdates LitNet used to have: it visits the neighbors of each article in turn.'''
+  for refv in net.g.vs(type='article'):
+    ref_pubdate = refv['pubdate']
+    if ref_pubdate == None: continue
+    for adj in refv.neighbors(mode = igraph.OUT):
+      if adj['type'] in ['author', 'institution', 'grantagency']:
+        adj_pubdate = adj['pubdate']
+        if adj_pubdate == None or ref_pubdate < adj_pubdate:
+          adj['pubdate'] = ref_pubdate
+
+def bench_pubdates(args):
+  '''Compares propagating pubdates article by article with propagating them with numpy.'''
+  for num_refs in args.refs:
+    net = _build_litnet(litnet.LitNet, _synthetic_refs(num_refs))
+    new_copies = [copy.deepcopy(net) for i in range(args.repeat)]
+    (_, new_secs) = _time(lambda: new_copies.pop().propagate_pubdates(), args.repeat)
+    if num_refs > args.max_baseline_refs:
+      print 'Pubdate propagation: %d refs, %d edges' % (num_refs, net.g.ecount())
+      print '  %-12s %9.2f ms  (the loop is skipped above %d refs)' % ('numpy', new_secs * 1e3, args.max_baseline_refs)
+      continue
+    old_copies = [copy.deepcopy(net) for i in range(args.repeat)]
+    (_, old_secs) = _time(lambda: _propagate_pubdates_by_loop(old_copies.pop()), args.repeat)
+    old_net = copy.deepcopy(net)
+    _propagate_pubdates_by_loop(old_net)
+    net.propagate_pubdates()
+    if old_net.g.vs['pubdate'] != net.g.vs['pubdate']:
+      raise Exception('The propagations returned different pubdates')
+    _report('Pubdate propagation', 'loop', old_secs, 'numpy', new_secs, net.g.ecount(), 'edges')
+
+def _graph_contents(g):
+  return ([v.attributes() for v in g.vs], g.get_edgelist(), [e.attributes() for e in g.es], g.attributes())
+
+def bench_graph_read(args):
+  '''Compares reading networks saved as .pklz with reading them saved as .npz, in full and
+  with only the "type" attribute like netstats.py does.'''
+  temp_dir = tempfile.mkdtemp()
+  try:
+    for num_refs in args.refs:
+      net = _build_litnet(litnet.LitNet, _synthetic_refs(num_refs))
+      net.propagate_pubdates()
+      pklz_path = os.path.join(temp_dir, 'net.pklz')
+      npz_path = os.path.join(temp_dir, 'net.npz')
+      net.save(pklz_path)
+      net.save(npz_path)
+      print 'Sizes: %d nodes, %d edges, %.1f MB as .pklz, %.1f MB as .npz' % (
+        net.g.vcount(), net.g.ecount(), os.path.getsize(pklz_path) / 1e6, os.path.getsize(npz_path) / 1e6)
+
+      (old_g, old_secs) = _time(lambda: graphfile.read(pklz_path), args.repeat)
+      (new_g, new_secs) = _time(lambda: graphfile.read(npz_path), args.repeat)
+      if _graph_contents(old_g) != _graph_contents(new_g):
+        raise Exception('The files contain different networks')
+      _report('Full network read', 'pklz', old_secs, 'npz', new_secs, num_refs, 'refs')
+
+      (type_g, type_secs) = _time(lambda: graphfile.read(npz_path, v_attrs=['type'], e_attrs=[]), args.repeat)
+      if type_g.vs['type'] != old_g.vs['type'] or type_g.get_edgelist() != old_g.get_edgelist():
+        raise Exception('The networks read with only the "type" attribute differ')
+      _report('Node type read', 'pklz', old_secs, 'npz type', type_secs, num_refs, 'refs')
+  finally:
+    shutil.rmtree(temp_dir)
+
+def _article_score_by_loop(articlev):
+  return len(filter(lambda v: v['type'] == 'article', articlev.neighbors(mode = igraph.IN)))
+
+def _score_by_loop(g, article_scoring, neighbor_scoring):
+  '''The scoring score.py used to do, one node at a time.'''
+  if article_scoring == 'propagate':
+    rootv = g.vs.find(type='drug')
+    for (v, depth, parentv) in g.bfsiter(rootv.index, advanced = True):
+      if not v['type'] == 'article': continue
+      parent_score = parentv['score'] if parentv['type'] == 'article' else 0
+      v['score'] = parent_score + _article_score_by_loop(v)
+  else:
+    for v in g.vs(type='article'):
+      v['score'] = _article_score_by_loop(v)
+
+  for neighbor_type in ['author', 'institution', 'grantagency']:
+    for neighborv in g.vs(type=neighbor_type):
+      if neighbor_scoring == 'sum':
+        neighborv['score'] = sum(articlev['score'] for articlev in neighborv.neighbors(mode = igraph.IN) if articlev['type'] == 'article' and articlev['score'] != None)
+      else:
+        neighborv['score'] = len(filter(lambda v: v['type'] == 'article', neighborv.neighbors(mode = igraph.IN)))
+
+  for neighbor_type in ['author', 'institution', 'grantagency']:
+    for neighborv in g.vs(type=neighbor_type):
+      ct_count = 0
+      for articlev in filter(lambda v: (v['type'] == 'article') and (v['pubtypes'] != None), neighborv.neighbors(mode = igraph.IN)):
+        for pubtype in articlev['pubtypes']:
+          if 'Clinical' in pubtype:
+            ct_count += 1
+            break
+      neighborv['ct_count'] = ct_count
+
+def bench_score(args):
+  '''Compares scoring networks one node at a time with scoring them with sparse matrices,
+  for every combination of article and neighbor scoring methods.'''
+  if args.inputs:
+    graphs = [(path, graphfile.read(path)) for path in args.inputs]
+  else:
+    graphs = [('%d synthetic refs' % num_refs, _build_litnet(litnet.LitNet, _synthetic_refs(num_refs)).g) for num_refs in args.refs]
+
+  for (name, g) in graphs:
+    for article_scoring in sorted(score._article_score_methods):
+      for neighbor_scoring in sorted(score._neighbor_score_methods):
+        (old_g, new_g) = (g.copy(), g.copy())
+        old_copies = [g.copy() for i in range(args.repeat)]
+        new_copies = [g.copy() for i in range(args.repeat)]
+        (_, old_secs) = _time(lambda: _score_by_loop(old_copies.pop(), article_scoring, neighbor_scoring), args.repeat)
+        (_, new_secs) = _time(lambda: score.score(new_copies.pop(), article_scoring, neighbor_scoring), args.repeat)
+        _score_by_loop(old_g, article_scoring, neighbor_scoring)
+        score.score(new_g, article_scoring, neighbor_scoring)
+        if old_g.vs['score'] != new_g.vs['score'] or old_g.vs['ct_count'] != new_g.vs['ct_count']:
+          raise Exception('The scorings returned different scores')
+        _report('Scoring %s with %s/%s' % (name, article_scoring, neighbor_scoring), 'loop', old_secs, 'sparse', new_secs, g.vcount(), 'nodes')
+
+def _propagate_by_loop(g, parent_scoring):
+  '''Propagated article scores, one node at a time along the BFS. "bfs" is what score.py used
+  to do; "max" and "sum" combine every article one level up that links to the node.'''
+  rootv = g.vs.find(type='drug')
+  levels = {}
+  for (v, depth, parentv) in g.bfsiter(rootv.index, advanced = True):
+    levels[v.index] = depth
+    if not v['type'] == 'article': continue
+    if parent_scoring == 'bfs':
+      parent_scores = [parentv['score'] if parentv['type'] == 'article' else 0]
+    else:
+      parent_scores = [g.vs[u]['score'] for u in set(g.predecessors(v.index)) if g.vs[u]['type'] == 'article' and levels.get(u) == depth - 1]
+    combine = max if parent_scoring == 'max' else sum
+    v['score'] = combine(parent_scores or [0]) + _article_score_by_loop(v)
+
+def bench_propagate(args):
+  '''Compares propagating article scores along the BFS one node at a time with propagating
+  them level by level, for every way of combining parent scores.'''
+  if args.inputs:
+    graphs = [(path, graphfile.read(path)) for path in args.inputs]
+  else:
+    graphs = [('%d synthetic refs' % num_refs, _build_litnet(litnet.LitNet, _synthetic_refs(num_refs)).g) for num_refs in args.refs]
+
+  for (name, g) in graphs:
+    # the scoring graph is built once per scoring and shared with neighbor scoring, so it's timed on its own
+    (_, setup_secs) = _time(lambda: score._ScoringGraph(g.copy()), args.repeat)
+    print 'Building the scoring graph of %s: %.2f ms' % (name, setup_secs * 1e3)
+    for parent_scoring in sorted(score._parent_score_methods):
+      (old_g, new_g) = (g.copy(), g.copy())
+      old_copies = [g.copy() for i in range(args.repeat)]
+      new_sgs = [score._ScoringGraph(g.copy()) for i in range(args.repeat)]
+      (_, old_secs) = _time(lambda: _propagate_by_loop(old_copies.pop(), parent_scoring), args.repeat)
+      (_, new_secs) = _time(lambda: score._score_articles_by_propagation(new_sgs.pop(), parent_scoring), args.repeat)
+      _propagate_by_loop(old_g, parent_scoring)
+      score._score_articles_by_propagation(score._ScoringGraph(new_g), parent_scoring)
+      if old_g.vs['score'] != new_g.vs['score']:
+        raise Exception('The propagations returned different scores')
+      _report('Propagating %s with %s parents' % (name, parent_scoring), 'loop', old_secs, 'levels', new_secs, g.ecount(), 'edges')
+
+def _synthetic_author_net(author_num, num_articles):
+  '''Returns a bottom-up network of "Author<author_num> ABC" with num_articles articles, each
+  cited by up to three articles. Some co-authors' names start with the author's name,
+  and some articles don't have a pubdate or a citation count.'''
+  rand = random.Random(author_num)
+  name = u'Author%d ABC' % author_num
+  net = litnet.LitNet(name)
+  root_index = net._add_author(name)
+  co_authors = [u'Coauthor%d, %s' % (i, rand.choice([u'A', u'B'])) for i in range(2 * num_articles)] + [name + u'D', name + u' Jr']
+  pubtypes_choices = [[u'Journal Article'], [u'Journal Article', u'Clinical Trial, Phase II'], [u'Practice Guideline'], None]
+  for i in range(num_articles):
+    ref = {'pmid': unicode(i + 1), 'title': u'Title of article %d' % i, 'pubtypes': rand.choice(pubtypes_choices),
+           'pubdate': 19900101 + rand.randrange(25) * 10000 if i % 7 else None, 'citcount': rand.randrange(200) if i % 5 else None,
+           'authors': [(name, None)] + [(rand.choice(co_authors), None) for j in range(rand.choice([0, 1, 3, 8, 25]))],
+           'institutions': dict((j, (u'Dept %d, Univ %d' % (j, rand.randrange(20)), [u'Univ %d' % rand.randrange(20)])) for j in range(1, rand.randint(0, 3) + 1)),
+           'grantagencies': [u'Agency %d' % rand.randrange(50) for j in range(rand.randint(0, 2))]}
+    ref_index = net.add_ref(ref, root_index)
+    for j in range(rand.randint(0, 3)):
+      k = rand.randrange(2 * num_articles)
+      net.add_ref({'pmid': u'c%d' % k, 'title': u'Citing article %d' % k, 'pubtypes': pubtypes_choices[k % 4], 'authors': [(u'Citer%d, A' % k, None)]}, ref_index)
+  net.finalize()
+  return net
+
+def _write_matrix_by_rows(graph_file_paths, output_file_path):
+  '''Writes the author matrix like authormat.py used to, adding each author as a row of
+  NaNs and then setting its values one at a time.'''
+  mat = pandas.DataFrame(columns = authormat.columns)
+  for graph_file_path in graph_file_paths:
+    result = authormat.calc_metrics(graph_file_path)
+    if result == None: continue
+    (author_name, metrics) = result
+    mat.loc[author_name] = float('nan')
+    for (column, value) in metrics.items():
+      mat[column][author_name] = value
+  mat.to_csv(output_file_path, mode='w')
+
+def bench_authormat(args):
+  '''Compares building the author matrix a row at a time with building it once from the
+  metrics of each author, serially and in a process pool.'''
+  temp_dir = tempfile.mkdtemp()
+  try:
+    graph_file_paths = []
+    for author_num in range(args.authors):
+      path = os.path.join(temp_dir, 'author-%d.npz' % author_num)
+      _synthetic_author_net(author_num, author_num * 7 % (2 * args.articles)).save(path)
+      graph_file_paths.append(path)
+    broken_path = os.path.join(temp_dir, 'broken.npz')
+    with open(broken_path, 'wb') as broken_file:
+      broken_file.write('not a network')
+
+    old_path = os.path.join(temp_dir, 'old.csv')
+    (_, old_secs) = _time(lambda: _write_matrix_by_rows(graph_file_paths, old_path), args.repeat)
+    for (name, processes) in (('serial', 1), ('%d processes' % args.processes, args.processes)):
+      new_path = os.path.join(temp_dir, 'new.csv')
+      (failed_paths, new_secs) = _time(lambda: authormat.write_matrix(graph_file_paths + [broken_path], new_path, processes), args.repeat)
+      if failed_paths != [broken_path]:
+        raise Exception('Expected only %s to be skipped, not %s' % (broken_path, failed_paths))
+      if open(old_path).read() != open(new_path).read():
+        raise Exception('The matrices differ')
+      _report('Author matrix', 'by rows', old_secs, name, new_secs, args.authors, 'authors')
+  finally:
+    shutil.rmtree(temp_dir)
+
+def _author_metrics_by_walks(articles, author_name):
+  '''The neighbor counts, co-author frequencies and uniqueness, and tg-score that authormat.py
+  used to compute, walking the neighbors of each article vertex.'''
+  counts = [[len([v for v in article.neighbors(mode = igraph.OUT) if v['type'] == node_type]) for article in articles] for node_type in ('author', 'institution', 'grantagency')]
+  co_authors = [author['label'] for article in articles for author in article.neighbors(mode = igraph.OUT) if author['type'] == 'author' and not author['label'].lower().startswith(author_name)]
+  if co_authors:
+    co_author_counts = collections.Counter(co_authors)
+    freqs_and_uniqueness = ([count / float(len(articles)) for count in co_author_counts.values()], len(co_author_counts) / float(len(co_authors)))
+  else:
+    freqs_and_uniqueness = (None, None)
+  citing_articles = set(v.index for article in articles for v in article.neighbors(mode = igraph.OUT) if v['type'] == 'article' and v['pubtypes'] != None)
+  tg_count = len([v for v in citing_articles if any('trial' in t.lower() or 'guideline' in t.lower() for t in articles[0].graph.vs[v]['pubtypes'])])
+  return (counts, freqs_and_uniqueness, tg_count / float(len(citing_articles)) if citing_articles else 0)
+
+def _author_metrics_by_arrays(g, articles, author_name):
+  neighbors = authormat._ArticleNeighbors(g, author_name, articles)
+  counts = [neighbors.counts_of_type(node_type) for node_type in ('author', 'institution', 'grantagency')]
+  return (counts, neighbors.co_author_freqs_and_uniqueness(), neighbors.tg_score())
+
+def bench_author_kernels(args):
+  '''Compares computing authormat.py's per-article neighbor metrics by walking the neighbors of
+  each article with computing them from the out-edge arrays of the graph.'''
+  for num_articles in args.articles:
+    g = _synthetic_author_net(num_articles, num_articles).g
+    author_name = g['name'].lower()
+    author_index = g.vs.find(label = author_name, type='author').index
+    (old_metrics, old_secs) = _time(lambda: _author_metrics_by_walks(g.vs[author_index].neighbors(mode = igraph.OUT), author_name), args.repeat)
+    (new_metrics, new_secs) = _time(lambda: _author_metrics_by_arrays(g, g.neighbors(author_index, mode = igraph.OUT), author_name), args.repeat)
+    if repr(old_metrics) != repr(new_metrics):
+      raise Exception('The metrics differ')
+    _report('Author metrics of %d articles' % num_articles, 'walks', old_secs, 'arrays', new_secs, num_articles, 'articles')
+
+def _parse_args(args):
+  p = argparse.ArgumentParser()
+  p.add_argument('--repeat', type=int, default=3)
+  sp = p.add_subparsers(dest='benchmark')
+
+  wos_records = sp.add_parser('wos-records', help='convert WoS "records" XML pages, either the given files or a synthetic page')
+  wos_records.add_argument('--records', type=int, default=100)
+  wos_records.add_argument('--authors', type=int, default=500)
+  wos_records.add_argument('inputs', nargs='*')
+  wos_records.set_defaults(func=bench_wos_records)
+
+  pubmed_merge = sp.add_parser('pubmed-merge', help='merge synthetic efetch responses into layers of refs of the given sizes')
+  pubmed_merge.add_argument('--refs', type=int, nargs='+', default=[10000, 50000])
+  pubmed_merge.add_argument('--max-baseline-refs', type=int, default=50000)
+  pubmed_merge.set_defaults(func=bench_pubmed_merge)
+
+  xpath = sp.add_parser('xpath', help='parse synthetic PubMed articles, WoS records, and clinical trials with and without compiled XPath expressions')
+  xpath.add_argument('--records', type=int, default=2000)
+  xpath.add_argument('--authors', type=int, default=20)
+  xpath.set_defaults(func=bench_xpath)
+
+  litnet_build = sp.add_parser('litnet-build', help='build networks from the given numbers of synthetic refs')
+  litnet_build.add_argument('--refs', type=int, nargs='+', default=[1000, 5000, 200000])
+  litnet_build.add_argument('--max-baseline-refs', type=int, default=5000)
+  litnet_build.set_defaults(func=bench_litnet_build)
+
+  dup_authors = sp.add_parser('dup-authors', help='remove duplicate authors from networks built from the given numbers of synthetic refs')
+  dup_authors.add_argument('--refs', type=int, nargs='+', default=[1000, 5000, 200000])
+  dup_authors.add_argument('--max-baseline-refs', type=int, default=5000)
+  dup_authors.set_defaults(func=bench_dup_authors)
+
+  pubdates = sp.add_parser('pubdates', help='propagate pubdates in networks built from the given numbers of synthetic refs')
+  pubdates.add_argument('--refs', type=int, nargs='+', default=[5000, 50000, 200000])
+  pubdates.add_argument('--max-baseline-refs', type=int, default=50000)
+  pubdates.set_defaults(func=bench_pubdates)
+
+  graph_read = sp.add_parser('graph-read', help='read networks built from the given numbers of synthetic refs from .pklz and .npz files')
+  graph_read.add_argument('--refs', type=int, nargs='+', default=[1000, 50000])
+  graph_read.set_defaults(func=bench_graph_read)
+
+  score_parser = sp.add_parser('score', help='score the given network files, or networks built from the given numbers of synthetic refs')
+  score_parser.add_argument('--refs', type=int, nargs='+', default=[5000, 50000])
+  score_parser.add_argument('inputs', nargs='*')
+  score_parser.set_defaults(func=bench_score)
+
+  propagate = sp.add_parser('propagate', help='propagate article scores in the given network files, or networks built from the given numbers of synthetic refs')
+  propagate.add_argument('--refs', type=int, nargs='+', default=[5000, 50000, 200000])
+  propagate.add_argument('inputs', nargs='*')
+  propagate.set_defaults(func=bench_propagate)
+
+  authormat_parser = sp.add_parser('authormat', help='build the author matrix of synthetic bottom-up networks')
+  authormat_parser.add_argument('--authors', type=int, default=2000)
+  authormat_parser.add_argument('--articles', type=int, default=40, help='the mean number of articles per author')
+  authormat_parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+  authormat_parser.set_defaults(func=bench_authormat)
+
+  author_kernels = sp.add_parser('author-kernels', help='compute the neighbor metrics of synthetic authors with the given numbers of articles')
+  author_kernels.add_argument('--articles', type=int, nargs='+', default=[100, 3000, 20000])
+  author_kernels.set_defaults(func=bench_author_kernels)
+
+  return p.parse_args(args)
+
+if __name__ == '__main__':
+  args = _parse_args(sys.argv[1:])
+  args.func(args)
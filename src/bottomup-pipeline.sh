@@ -6,7 +6,9 @@ do
   read line
   output_path="$line"
 
-  if [ -e "$output_path" ]; then
+  # a network saved as .pklz before networks were saved as .npz, or the other way around
+  base_path="${output_path%.*}"
+  if [ -e "$output_path" ] || [ -e "${base_path}.pklz" ] || [ -e "${base_path}.npz" ]; then
     echo "Skipping $name"
   else
     echo $name
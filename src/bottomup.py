@@ -4,6 +4,7 @@ import datetime
 import litnet
 import wos
 import pubmed
+from crawler import Crawler
 
 class BottomUp:
   def __init__(self, verbose):
@@ -16,6 +17,7 @@ class BottomUp:
 
   def close(self):
     self.wos_client.close()
+    self.pm_client.close()
 
   def _first_author(self, ref):
     authors = ref.get('authors')
@@ -45,13 +47,18 @@ class BottomUp:
   def _time_str(self):
     return datetime.datetime.now().strftime('[%H:%M:%S]')
 
-  def _add_wos_data(self, ref):
-    '''Takes an article dictionary and adds WoS data about the given article.'''
-    if not 'title' in ref or not ref['title'] or not 'authors' in ref:
-      return
-    wos_refs = self.wos_client.search(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year'))
-    if len(wos_refs) == 1:
-      ref.update(wos_refs[0])
+  def _add_wos_data(self, refs):
+    '''Takes a list of article dictionaries and adds WoS data about the given articles.'''
+    refs = [ref for ref in refs if ref.get('title') and 'authors' in ref]
+    searches = [(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year')) for ref in refs]
+    for (ref, wos_refs) in zip(refs, self.wos_client.search_many(searches)):
+      if len(wos_refs) == 1:
+        ref.update(wos_refs[0])
+
+  def _citations(self, refs):
+    '''Yields the tuple (index of the ref, citing article) for each of the given refs
+    containing a WoS ID, as the citing articles arrive.'''
+    return self.wos_client.iter_citations_many(refs)
 
   def _ref_has_institution(self, ref, institution_name):
     '''Returns true if the given institution is in the given article dictionary's
@@ -66,37 +73,11 @@ class BottomUp:
             return True
     return False
 
-  def _add_layer_of_refs(self, refs, parent_index, max_levels, level, filter_func = None):
-    '''Adds a layer of references to the literature network.'''
-    # add level attribute
-    for ref in refs:
-      if ref.get('level') == None:
-        ref['level'] = level
-
-    # add pubmed data
-    self.pm_client.add_pubmed_data(refs)
-
-    # add wos data
-    for ref in refs:
-      self._add_wos_data(ref)
-
-    if filter_func:
-      refs = filter(filter_func, refs)
-
-    # update ref counts
-    for ref in refs:
-      self._update_ref_counts(ref)
-    #if self.verbose:
-    #  print self._time_str(), self.counts['all'], 'articles'
-
-    # add each ref to the graph
-    for ref in refs:
-      ref_index = self.net.add_ref(ref, parent_index)
-
-      # add the next level if needed and if we have a WoS ID for ref
-      if 'wosid' in ref and level < max_levels:
-        child_refs = self.wos_client.citations(ref)
-        self._add_layer_of_refs(child_refs, ref_index, max_levels, level + 1)
+  def _crawl(self, refs, root_index, max_levels, filter_func = None):
+    '''Adds the given refs and the levels of articles citing them to the literature network.
+    filter_func is only applied to the given refs.'''
+    crawler = Crawler(self.net, self.pm_client, self._add_wos_data, self._citations, self._update_ref_counts)
+    crawler.crawl([(ref, root_index) for ref in refs], max_levels, filter_func)
 
   def run(self, author_name, institution_name, output_file_name, max_levels):
     start_time = datetime.datetime.now()
@@ -106,10 +87,11 @@ class BottomUp:
 
     refs = self.pm_client.search_for_papers_by_author(author_name)
     institution_name = institution_name.lower()
-    self._add_layer_of_refs(refs, root_index, max_levels, 1, lambda ref: self._ref_has_institution(ref, institution_name))
+    self._crawl(refs, root_index, max_levels, lambda ref: self._ref_has_institution(ref, institution_name))
 
     end_time = datetime.datetime.now()
 
+    self.net.finalize()
     if self.verbose:
       time_delta = (end_time - start_time)
       num_articles = len(self.net.g.vs(type='article'))
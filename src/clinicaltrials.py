@@ -5,14 +5,14 @@ import lxml.etree
 import os
 import dateutil.parser
 import refparse
-from util import xpath_str
+from util import xpath_nodes, xpath_str
 
 def _parse_clinical_trial(doc):
   t = {}
   t['nctid'] = xpath_str(doc, '/clinical_study/id_info/nct_id/text()')
   t['title'] = xpath_str(doc, '/clinical_study/official_title/text() | /clinical_study/brief_title/text()')
   refs = []
-  for reftag in doc.xpath('/clinical_study/reference | /clinical_study/results_reference'):
+  for reftag in xpath_nodes(doc, '/clinical_study/reference | /clinical_study/results_reference'):
     cseref_str = xpath_str(reftag, 'citation/text()')
     ref = refparse.parse_cse_ref(cseref_str)
     pmid = xpath_str(reftag, 'PMID/text()')
@@ -28,9 +28,12 @@ def _parse_clinical_trial(doc):
   
   return t
 
+# set CLINICALTRIALS_BASE_URL to point the client at another server, e.g. standin.py
+_base_url = os.environ.get('CLINICALTRIALS_BASE_URL', 'http://clinicaltrials.gov')
+
 class Client:
-  def __init__(self):
-    pass
+  def __init__(self, base_url = None):
+    self.base_url = base_url or _base_url
   
   def search(self, query):
     '''Takes a drug name and returns a list of dictionaries. Each dictionary
@@ -43,7 +46,7 @@ class Client:
     }'''
     (_, tmppath) = tempfile.mkstemp(prefix=('%s-clinical-trials' % query), suffix='.zip', text='False')
     with open(tmppath, 'wb') as tmpfile:
-      tmpfile.write(urllib.urlopen('http://clinicaltrials.gov/search?term=%s&studyxml=true' % query).read())
+      tmpfile.write(urllib.urlopen('%s/search?term=%s&studyxml=true' % (self.base_url, query)).read())
     trials = []
     with zipfile.ZipFile(tmppath, 'r') as archive:
       for name in archive.namelist():
@@ -0,0 +1,120 @@
+# the refs of a level below the first are added to the network in chunks of this many,
+# as they arrive, so that a whole level of refs is never held in memory at once
+_chunk_size = 500
+
+def _first_author(ref):
+  authors = ref.get('authors')
+  if not authors:
+    return None
+  else:
+    return authors[0][0]
+
+def _ref_key(ref):
+  '''Returns a hashable key that identifies the article described by the given ref
+  (article data stored in a dictionary), or None if the ref has nothing to identify it by.
+  Refs with the same key in a level are only enriched once.'''
+  if 'pmid' in ref:
+    return ('pmid', ref['pmid'])
+  if 'wosid' in ref:
+    return ('wosid', ref['wosid'])
+  title = ref.get('title')
+  if title:
+    author = _first_author(ref) or u''
+    return ('title', title.lower(), author.lower())
+  return None
+
+class Crawler:
+  '''Grows a LitNet breadth-first, one level at a time. The refs of a level are
+  gathered across every parent in chunks as they arrive, refs already in the network
+  are linked without any network calls, and the remaining distinct refs of each chunk
+  are enriched in a single batched pass before they are added to the network.'''
+
+  def __init__(self, net, pm_client, add_wos_data, expand, on_ref = None):
+    '''Args:
+      net: the LitNet to add article nodes to
+      pm_client: a pubmed.Client used to add PubMed data to each level
+      add_wos_data: a function that takes a list of refs and adds WoS data to them
+      expand: a function that takes a list of refs containing "wosid" and yields the tuple
+              (index of the ref, ref one level below it) for each of them, in order
+      on_ref: an optional function called with each ref before it is added to the network
+    '''
+    self.net = net
+    self.pm_client = pm_client
+    self.add_wos_data = add_wos_data
+    self.expand = expand
+    self.on_ref = on_ref
+
+    self.expanded = set()
+
+  def crawl(self, roots, max_levels, filter_func = None):
+    '''Adds the given roots and up to max_levels levels of refs to the network.
+    roots is a list of tuples (ref, parent node index). If given, filter_func is applied
+    to the enriched refs of the first level; refs for which it returns false are dropped.'''
+    to_expand = self._add_level(roots, max_levels, 1, filter_func)
+    level = 2
+    while to_expand:
+      next_to_expand = []
+      pairs = []
+      for (i, child_ref) in self.expand([ref for (ref, ref_index) in to_expand]):
+        pairs.append((child_ref, to_expand[i][1]))
+        if len(pairs) >= _chunk_size:
+          next_to_expand.extend(self._add_level(pairs, max_levels, level))
+          pairs = []
+      if pairs:
+        next_to_expand.extend(self._add_level(pairs, max_levels, level))
+      to_expand = next_to_expand
+      level += 1
+
+  def _dedup_level(self, pairs):
+    '''Returns the list of (ref, parent node index) tuples to add to the network, where
+    refs describing the same article share a single ref dictionary, and the list of the
+    distinct refs that aren't in the network yet and need to be enriched. Refs already in
+    the network are added again as they are, so that their IDs and data are merged into
+    their node, without looking them up.'''
+    refs_by_key = {}
+    refs = []
+    to_add = []
+    for (ref, parent_index) in pairs:
+      if self.net.find_ref(ref) != None:
+        to_add.append((ref, parent_index))
+        continue
+      key = _ref_key(ref)
+      if key == None:
+        unique_ref = ref
+        refs.append(ref)
+      elif key in refs_by_key:
+        unique_ref = refs_by_key[key]
+      else:
+        unique_ref = refs_by_key[key] = ref
+        refs.append(ref)
+      to_add.append((unique_ref, parent_index))
+    return (to_add, refs)
+
+  def _add_level(self, pairs, max_levels, level, filter_func = None):
+    '''Adds (ref, parent node index) tuples of the given level to the network. Returns
+    the list of (ref, node index) tuples of the refs whose next level should be added.'''
+    for (ref, parent_index) in pairs:
+      if ref.get('level') == None:
+        ref['level'] = level
+
+    (to_add, refs) = self._dedup_level(pairs)
+
+    if refs:
+      self.pm_client.add_pubmed_data(refs)
+      self.add_wos_data(refs)
+
+    if filter_func:
+      dropped = set(id(ref) for ref in refs if not filter_func(ref))
+      to_add = [(ref, parent_index) for (ref, parent_index) in to_add if not id(ref) in dropped]
+
+    to_expand = []
+    for (ref, parent_index) in to_add:
+      if self.on_ref:
+        self.on_ref(ref)
+      ref_index = self.net.add_ref(ref, parent_index)
+
+      # add the next level if needed and if we have a WoS ID for ref
+      if 'wosid' in ref and level < max_levels and not ref_index in self.expanded:
+        self.expanded.add(ref_index)
+        to_expand.append((ref, ref_index))
+    return to_expand
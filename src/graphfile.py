@@ -0,0 +1,131 @@
+'''Reads and writes networks in a columnar format, so that tools only load the attributes they use.
+
+A graph file is an .npz file, a zip archive with one compressed numpy array per member:
+  version     the format version
+  vcount      the number of nodes
+  edges       an E x 2 array of the source and target of each edge
+  graph       the graph attributes, as a one element object array holding a dictionary
+  v:<name>    the values of node attribute <name>
+  e:<name>    the values of edge attribute <name>
+Columns of integers or floats are stored as numeric arrays. If some of their values are None,
+a boolean array <column>:none marks them. Other columns, like titles or lists of MeSH terms,
+are stored as pickled object arrays. Each member is only decompressed when it's read.
+
+Files ending in .pklz are read and written in igraph's picklez format, like before.
+
+Convert .pklz files with:
+  python graphfile.py net1.pklz net2.pklz ...
+which writes net1.npz, net2.npz, ... next to them.
+'''
+
+import sys
+import os
+import types
+import argparse
+import numpy
+import igraph
+
+_version = 1
+
+def _is_picklez(path):
+  return path.endswith('.pklz')
+
+def _column_arrays(key, values):
+  '''Returns a dictionary of the arrays that store the attribute values under key.'''
+  present = [value for value in values if value != None]
+  if present and all(type(value) in (types.IntType, types.LongType) for value in present):
+    dtype = numpy.int64
+  elif present and all(type(value) == types.FloatType for value in present):
+    dtype = numpy.float64
+  else:
+    column = numpy.empty(len(values), dtype=object)
+    # assigned one at a time, since numpy would turn lists of equal length into a 2-D array
+    for (index, value) in enumerate(values):
+      column[index] = value
+    return {key: column}
+
+  if len(present) == len(values):
+    return {key: numpy.array(values, dtype=dtype)}
+  is_none = numpy.array([value == None for value in values], dtype=bool)
+  column = numpy.zeros(len(values), dtype=dtype)
+  column[~is_none] = present
+  return {key: column, key + ':none': is_none}
+
+def _column_values(npz, key):
+  '''Returns the list of attribute values stored under key.'''
+  values = npz[key].tolist()
+  if key + ':none' in npz.files:
+    for index in numpy.flatnonzero(npz[key + ':none']).tolist():
+      values[index] = None
+  return values
+
+def write(g, path):
+  '''Writes the graph to path, in the picklez format if path ends in .pklz
+  and in the columnar format otherwise.'''
+  if _is_picklez(path):
+    with open(path, 'wb') as output_file:
+      g.write(output_file, format='picklez')
+    return
+
+  arrays = {
+    'version': numpy.array(_version),
+    'vcount': numpy.array(g.vcount()),
+    'edges': numpy.array(g.get_edgelist(), dtype=numpy.int64).reshape(-1, 2),
+    'graph': numpy.empty(1, dtype=object),
+  }
+  arrays['graph'][0] = dict((k, g[k]) for k in g.attributes())
+  for k in g.vs.attribute_names():
+    arrays.update(_column_arrays('v:' + k, g.vs[k]))
+  for k in g.es.attribute_names():
+    arrays.update(_column_arrays('e:' + k, g.es[k]))
+
+  # numpy adds .npz to file names that don't end with it, but not to open files
+  with open(path, 'wb') as output_file:
+    numpy.savez_compressed(output_file, **arrays)
+
+def read(path, v_attrs = None, e_attrs = None):
+  '''Reads the graph at path. v_attrs and e_attrs are the lists of node and edge attributes
+  to load; all of them are loaded if they're None. Attributes that the file doesn't have are
+  skipped. Only the requested columns of a columnar file are decompressed. A picklez file is
+  always loaded in full.'''
+  if _is_picklez(path):
+    return igraph.Graph.Read(path, format='picklez')
+
+  npz = numpy.load(path, allow_pickle=True)
+  try:
+    version = int(npz['version'])
+    if version > _version:
+      raise Exception('%s was written by a newer version (format %d)' % (path, version))
+    g = igraph.Graph(n=int(npz['vcount']), edges=npz['edges'].tolist(), directed=True)
+    for (k, v) in npz['graph'][0].items():
+      g[k] = v
+    for (prefix, names, seq) in (('v:', v_attrs, g.vs), ('e:', e_attrs, g.es)):
+      keys = [name for name in npz.files if name.startswith(prefix) and not name.endswith(':none')]
+      if names != None:
+        keys = [key for key in keys if key[len(prefix):] in names]
+      for key in keys:
+        seq[key[len(prefix):]] = _column_values(npz, key)
+    return g
+  finally:
+    npz.close()
+
+def convert(input_path, output_path = None):
+  '''Converts the graph file at input_path to the format given by the extension of
+  output_path. By default, a .pklz file is converted to an .npz file next to it.'''
+  if output_path == None:
+    output_path = os.path.splitext(input_path)[0] + '.npz'
+  write(read(input_path), output_path)
+  return output_path
+
+def _parse_args(args):
+  p = argparse.ArgumentParser()
+  p.add_argument('--output', help='the output file if there is a single input; by default, the input with an .npz extension')
+  p.add_argument('inputs', nargs='+', help='.pklz or .npz graph files')
+  return p.parse_args(args)
+
+if __name__ == '__main__':
+  args = _parse_args(sys.argv[1:])
+  if args.output and len(args.inputs) > 1:
+    raise Exception('--output can only be given with a single input')
+  for input_path in args.inputs:
+    print '%s -> %s' % (input_path, convert(input_path, args.output))
@@ -2,10 +2,14 @@
 # -*- coding: utf-8 -*-
 
 import igraph
-from itertools import repeat 
+import numpy
+from itertools import repeat
+from array import array
 from collections import Counter
 import unicodedata
 
+import graphfile
+
 class LitNet:
   def __init__(self, name):
     self.g = igraph.Graph(directed=True)
@@ -21,13 +25,48 @@ class LitNet:
     self.institution_to_v = {}
     self.grant_agency_to_v = {}
 
+    # Vertices and edges are buffered here and only added to g by finalize(), since adding
+    # them to g one at a time makes igraph reallocate its vectors every time.
+    self.num_pending_vs = 0
+    self.pending_v_attrs = {}   # attribute name -> list of values of the pending vertices
+    self.pending_e_attrs = {}   # attribute name -> list of values of the pending edges
+    self.edge_ids = {}          # (src, trg) -> edge ID of every edge, pending or not
+    self.edge_srcs = array('l') # source of every edge by edge ID, pending or not
+    self.edge_trgs = array('l') # target of every edge by edge ID, pending or not
+
+  def finalize(self):
+    '''Adds the buffered vertices and edges to g. This is called before the litnet is saved,
+    laid out, or postprocessed; call it before reading g directly. Vertices and edges can
+    still be added afterwards.'''
+    if self.num_pending_vs:
+      for k in self.pending_v_attrs:
+        self._pending_column(self.pending_v_attrs, k, self.num_pending_vs)
+      self.g.add_vertices(self.num_pending_vs, attributes=self.pending_v_attrs)
+      self.num_pending_vs = 0
+      self.pending_v_attrs = {}
+    num_es = self.g.ecount()
+    num_pending_es = len(self.edge_srcs) - num_es
+    if num_pending_es > 0:
+      for k in self.pending_e_attrs:
+        self._pending_column(self.pending_e_attrs, k, num_pending_es)
+      self.g.add_edges(zip(self.edge_srcs[num_es:], self.edge_trgs[num_es:]), attributes=self.pending_e_attrs)
+      self.pending_e_attrs = {}
+
+  def _reindex_edges(self):
+    '''Rebuilds edge_ids, edge_srcs, and edge_trgs after edges were changed in g directly.'''
+    edge_list = self.g.get_edgelist()
+    self.edge_ids = dict((e, eid) for (eid, e) in enumerate(edge_list))
+    self.edge_srcs = array('l', (src for (src, trg) in edge_list))
+    self.edge_trgs = array('l', (trg for (src, trg) in edge_list))
+
   def save(self, path):
-    '''Save the litnet to a pklz format'''
-    with open(path, 'wb') as output_file:
-      self.g.write(output_file, format='picklez')
+    '''Save the litnet in the columnar format of graphfile.py, or in the pklz format if path ends in .pklz'''
+    self.finalize()
+    graphfile.write(self.g, path)
 
   def layout(self, alg='fr', scale=4.0):
     '''Apply a force-directed layout on the litnet'''
+    self.finalize()
     l = self.g.layout(alg)
     for v_index in range(self.g.vcount()):
       x, y = l[v_index]
@@ -36,33 +75,76 @@ class LitNet:
       self.g.vs[v_index]['graphics'] = {'x': str(x), 'y': str(y)}
 
   def add_v(self, **attrs):
-    '''Wrapper around igraph.Graph.add_vertex method so that it returns the node index.'''
-    index = self.g.vcount()
-    self.g.add_vertex(**attrs)
-    return index
+    '''Adds a vertex with the given attributes and returns its node index.
+    The vertex is added to g by finalize().'''
+    pending_index = self.num_pending_vs
+    self.num_pending_vs += 1
+    for (k, v) in attrs.items():
+      self._pending_column(self.pending_v_attrs, k, self.num_pending_vs)[pending_index] = v
+    return self.g.vcount() + pending_index
+
+  def _pending_column(self, pending_attrs, k, length):
+    '''Returns the list of values of attribute k in pending_attrs, padded with None to length.'''
+    column = pending_attrs.get(k)
+    if column == None:
+      column = pending_attrs[k] = []
+    if len(column) < length:
+      column.extend(repeat(None, length - len(column)))
+    return column
+
+  def _set_v_attr(self, index, k, v):
+    '''Sets attribute k of the vertex at index, whether or not it was added to g yet.'''
+    pending_index = index - self.g.vcount()
+    if pending_index < 0:
+      self.g.vs[index][k] = v
+    else:
+      self._pending_column(self.pending_v_attrs, k, self.num_pending_vs)[pending_index] = v
 
   def _add_unique_edge(self, src, trg, **attrs):
     '''Only adds an edge between src and trg if no edge exists.
     If one exists, this will augment the existing edge's attributes.'''
-    eid = self.g.get_eid(src, trg, error = False)
-    if eid < 0:
-      self.g.add_edge(src, trg, **attrs)
-    else:
-      e = self.g.es[eid]
-      for k, v in attrs.items():
-        e[k] = v
+    eid = self.edge_ids.get((src, trg))
+    if eid == None:
+      eid = self.edge_ids[(src, trg)] = len(self.edge_srcs)
+      self.edge_srcs.append(src)
+      self.edge_trgs.append(trg)
+    pending_index = eid - self.g.ecount()
+    for (k, v) in attrs.items():
+      if pending_index < 0:
+        self.g.es[eid][k] = v
+      else:
+        self._pending_column(self.pending_e_attrs, k, len(self.edge_srcs) - self.g.ecount())[pending_index] = v
+
+  def add_e(self, src, trg, **attrs):
+    '''Adds an edge between src and trg unless one already exists.'''
+    self._add_unique_edge(src, trg, **attrs)
+
+  def _find_ref_id(self, ref):
+    '''Returns the tuple (id_key, node index) of the article node that matches the given ref,
+    or None if the ref isn't in the network.'''
+    for (id_key, id_dict) in [('pmid', self.pmid_to_v), ('wosid', self.wosid_to_v), ('title', self.title_to_v)]:
+      if id_key in ref:
+        id_val = ref[id_key]
+        if id_val in id_dict:
+          return (id_key, id_dict[id_val])
+    return None
+
+  def find_ref(self, ref):
+    '''Returns the article node index that matches the given ref (article data stored in a dictionary),
+    or None if the ref isn't in the network. Unlike add_ref, this never modifies the network.'''
+    found = self._find_ref_id(ref)
+    return found[1] if found else None
 
   def _get_ref_index(self, ref):
     '''Returns the article node index that matches the given ref (article data stored in a dictionary).
     If the ref specifies article information that isn't in the network,
     this will return the index to a new article node.'''
     self.ref_counts['all'] += 1
-    for (id_key, id_dict) in [('pmid', self.pmid_to_v), ('wosid', self.wosid_to_v), ('title', self.title_to_v)]:
-      if id_key in ref:
-        id_val = ref[id_key]
-        if id_val in id_dict:
-          self.ref_counts[id_key] += 1
-          return id_dict[id_val]
+    found = self._find_ref_id(ref)
+    if found:
+      (id_key, ref_index) = found
+      self.ref_counts[id_key] += 1
+      return ref_index
     self.ref_counts['new'] += 1
     return self.add_v(type='article')
 
@@ -83,14 +165,13 @@ class LitNet:
 
   def _add_ref_data(self, ref, ref_index):
     '''Adds a ref (a dictionary containing article data) to the litnet.'''
-    ref_v = self.g.vs[ref_index]
     for attr in ('wosid', 'pmid', 'title', 'pubdate', 'pubtypes', 'level', 'citcount'):
       if attr in ref:
-        ref_v[attr] = ref[attr]
+        self._set_v_attr(ref_index, attr, ref[attr])
     if 'meshterms' in ref:
-      ref_v['meshterms'] = self._mesh_terms_as_semistructured(ref['meshterms'])
+      self._set_v_attr(ref_index, 'meshterms', self._mesh_terms_as_semistructured(ref['meshterms']))
     if 'title' in ref:
-      ref_v['label'] = ref['title']
+      self._set_v_attr(ref_index, 'label', ref['title'])
 
   def _update_ref_vertex_dicts(self, ref, ref_index):
     '''Adds the ref to the wosid_to_v, pmid_to_v, and title_to_v dictionaries.'''
@@ -184,46 +265,113 @@ class LitNet:
 
     return ref_index
 
+  def aggregate_to_neighbors(self, attr, ufunc, src_type, trg_types):
+    '''Combines the attr values of the src_type nodes linking to each node of one of
+    trg_types with the numpy ufunc (e.g. numpy.minimum), together with the node's own
+    value if it has one, and stores the result in the node's attr. Nodes whose attr is
+    None are skipped as sources, and targets without any sources are left as they are.
+    Example: aggregate_to_neighbors('pubdate', numpy.minimum, 'article', ['author'])
+    sets each author's pubdate to the earliest pubdate of the author's articles.'''
+    self.finalize()
+    if self.g.ecount() == 0 or not attr in self.g.vs.attribute_names():
+      return
+    values = self.g.vs[attr]
+    value_objs = numpy.array(values, dtype=object)
+    has_value = numpy.not_equal(value_objs, None)
+    if not has_value.any():
+      return
+    value_array = numpy.zeros(len(values), dtype=numpy.array(value_objs[has_value].tolist()).dtype)
+    value_array[has_value] = value_objs[has_value].tolist()
+    node_types = numpy.array(self.g.vs['type'], dtype=object)
+    is_src = node_types == src_type
+    is_trg = numpy.zeros(len(node_types), dtype=bool)
+    for trg_type in trg_types:
+      is_trg |= node_types == trg_type
+
+    if len(self.edge_srcs) != self.g.ecount():
+      self._reindex_edges()
+    (srcs, trgs) = (numpy.frombuffer(self.edge_srcs, dtype=numpy.int_), numpy.frombuffer(self.edge_trgs, dtype=numpy.int_))
+    kept = is_src[srcs] & has_value[srcs] & is_trg[trgs]
+    (srcs, trgs) = (srcs[kept], trgs[kept])
+    if len(trgs) == 0:
+      return
+
+    # group the source values by target and reduce each group
+    order = numpy.argsort(trgs)
+    (srcs, trgs) = (srcs[order], trgs[order])
+    group_starts = numpy.flatnonzero(numpy.concatenate(([True], trgs[1:] != trgs[:-1])))
+    group_trgs = trgs[group_starts]
+    results = ufunc.reduceat(value_array[srcs], group_starts)
+    own = has_value[group_trgs]
+    results[own] = ufunc(results[own], value_array[group_trgs[own]])
+
+    value_objs[group_trgs] = results.tolist()
+    self.g.vs[attr] = value_objs.tolist()
+
   def propagate_pubdates(self):
     '''Add the min pubdate from article nodes out to author, institution, and grantagency nodes.'''
-    for refv in self.g.vs(type='article'):
-      ref_pubdate = refv['pubdate']
-      if ref_pubdate == None: continue
-      for adj in refv.neighbors(mode = igraph.OUT):
-        if adj['type'] in ['author', 'institution', 'grantagency']:
-          adj_pubdate = adj['pubdate']
-          if adj_pubdate == None or ref_pubdate < adj_pubdate:
-            adj['pubdate'] = ref_pubdate
-
-  def _replace_node_with(self, replacee, replacer):
-    '''Redirects all edges going to replacee and points them
-    to replacer. Removes replacee.'''
-    replacee_idx = replacee.index
-    replacer_idx = replacer.index
-    for src_idx in self.g.neighbors(replacee_idx, mode = igraph.IN):
-      self.g.add_edge(src_idx, replacer_idx)
-      self.g.delete_edges(self.g.get_eid(src_idx, replacee_idx))
-    for trg_idx in self.g.neighbors(replacee_idx, mode = igraph.OUT):
-      self.g.add_edge(replacer_idx, trg_idx)
-      self.g.delete_edges(self.g.get_eid(replacee_idx, trg_idx))
+    self.aggregate_to_neighbors('pubdate', numpy.minimum, 'article', ['author', 'institution', 'grantagency'])
 
-  def remove_dup_authors(self):
-    '''Remove duplicate author nodes from the litnet.
-    E.g. "pico a" and "pico ar" would be merged into the single node "pico ar".'''
-    for authv in self.g.vs(type='author'):
-      name_raw = authv['label']
-      name_pieces = name_raw.split(' ')
-      if len(name_pieces) != 2:
+  def _dup_author_targets(self):
+    '''Returns a dictionary that maps the node index of each duplicate author to the node index
+    of the author it should be merged into. An author is a duplicate if another author has the
+    same last name and initials that start with its initials, e.g. "pico a" is a duplicate of
+    "pico ar". It's merged into the author with the most initials that start with its own,
+    or the one added first if there are several.'''
+    authors_by_last_name = {}
+    for (index, (node_type, label)) in enumerate(zip(self.g.vs['type'], self.g.vs['label'])):
+      if node_type != 'author' or label == None:
         continue
-      last_name, first_initials = (name_pieces[0], name_pieces[1])
-      n_initials = len(first_initials)
-      if n_initials <= 1:
+      name_pieces = label.split(' ')
+      if len(name_pieces) != 2 or not name_pieces[1]:
         continue
-      first_initials_alts = map(lambda l: first_initials[:l], range(1, n_initials))
-      for first_initial_alt in first_initials_alts:
-        name_alt = ' '.join([last_name, first_initial_alt])
-        dupvs = self.g.vs(type='author', label=name_alt)
-        if len(dupvs) == 0:
-          continue
-        for dupv in dupvs:
-          self._replace_node_with(dupv, authv)
+      authors_by_last_name.setdefault(name_pieces[0], []).append((name_pieces[1], index))
+
+    targets = {}
+    for authors in authors_by_last_name.itervalues():
+      if len(authors) < 2:
+        continue
+      for (initials, index) in authors:
+        target = None
+        for (other_initials, other_index) in authors:
+          if len(other_initials) > len(initials) and other_initials.startswith(initials):
+            if target == None or len(other_initials) > len(target[0]):
+              target = (other_initials, other_index)
+        if target:
+          targets[index] = target[1]
+    return targets
+
+  def remove_dup_authors(self):
+    '''Remove duplicate author nodes from the litnet.
+    E.g. "pico a" and "pico ar" would be merged into the single node "pico ar".
+    The edges of a duplicate are moved to the author it's merged into, and edges
+    that end up between the same nodes are combined by adding their counts.'''
+    self.finalize()
+    targets = self._dup_author_targets()
+    if not targets:
+      return
+
+    num_vs = self.g.vcount()
+    kept = [index for index in xrange(num_vs) if not index in targets]
+    new_indices = [None] * num_vs
+    for (new_index, index) in enumerate(kept):
+      new_indices[index] = new_index
+    mapping = [new_indices[targets.get(index, index)] for index in xrange(num_vs)]
+
+    # contract_vertices would combine the attributes of the merged nodes,
+    # but the merged node keeps the attributes of the author it was merged into
+    v_attrs = dict((k, self.g.vs[k]) for k in self.g.vs.attribute_names())
+    self.g.contract_vertices(mapping)
+    for (k, values) in v_attrs.items():
+      self.g.vs[k] = [values[index] for index in kept]
+    self.g.simplify(multiple=True, loops=False, combine_edges={'count': _sum_counts, None: 'first'})
+
+    for index_dict in (self.pmid_to_v, self.wosid_to_v, self.title_to_v, self.author_to_v, self.institution_to_v, self.grant_agency_to_v):
+      for (key, index) in index_dict.items():
+        index_dict[key] = mapping[index]
+    self._reindex_edges()
+
+def _sum_counts(counts):
+  '''Adds the counts of edges that are combined into one, ignoring edges without a count.'''
+  counts = [count for count in counts if count != None]
+  return sum(counts) if counts else None
@@ -2,10 +2,11 @@ import sys
 import itertools
 import numpy
 import pandas
-import igraph
+
+import graphfile
 
 def read_graph(path):
-  return igraph.Graph.Read(path, format='picklez')
+  return graphfile.read(path, v_attrs=['pmid', 'meshterms'], e_attrs=[])
 
 def all_mesh_terms(g):
   s = set()
@@ -27,12 +28,13 @@ def gen_mat(g):
 
   return mat
 
+def output_path(g):
+  return g['name'] + '-Mesh.csv'
+
 def main(input_path):
   g = read_graph(input_path)
   mat = gen_mat(g)
-
-  output_path = g['name'] + '-Mesh.csv'
-  mat.to_csv(output_path, mode='w')
+  mat.to_csv(output_path(g), mode='w')
 
 if __name__ == '__main__':
   main(sys.argv[1])
@@ -1,10 +1,11 @@
 import sys
-import igraph
+
+import graphfile
 
 def main(input_paths):
   counts = []
   for input_path in input_paths:
-    g = igraph.Graph.Read(input_path, format='picklez')
+    g = graphfile.read(input_path, v_attrs=['type'], e_attrs=[])
     count = len(g.vs(type='article'))
     counts.append(count)
   print sum(counts)
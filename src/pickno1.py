@@ -1,4 +1,5 @@
 import sys
+import os
 import re
 
 prefix_path = sys.argv[1]
@@ -6,7 +7,10 @@ prefix_path = sys.argv[1]
 def print_combo(author, institution):
   print author
   print institution
-  print prefix_path + '/' + author + '/' + institution + '/1/net.pklz'
+  net_path = prefix_path + '/' + author + '/' + institution + '/1/net'
+  # authors crawled before networks were saved as .npz keep their .pklz file, so that
+  # bottomup-pipeline.sh skips them instead of crawling them again
+  print net_path + ('.pklz' if os.path.exists(net_path + '.pklz') else '.npz')
 
 institution_re = re.compile(ur'(\d+)\s(.+)')
 
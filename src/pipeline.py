@@ -0,0 +1,126 @@
+'''Runs a network through several analysis stages in one process, so that it's read once
+instead of being read and written again by every script.
+
+Stages are given in order on the command line as name:key=value,key=value,... For example:
+  python pipeline.py topdown.npz score:article=propagate,neighbor=sum save:path=scored.npz \\
+    xgmml:path=scored.xgmml articles:path=articles.csv,columns=pmid+pubdays+score mesh
+
+The stages are:
+  score:article=A,neighbor=N[,parent=P]  scores the network like score.py
+  save:path=PATH                          writes the network like the other scripts, .npz or .pklz
+  xgmml:path=PATH                         writes an XGMML file like xgmml.py
+  articles:path=PATH[,columns=C1+C2...][,filter=F]
+                                          writes an article CSV like articlestats.py
+  mesh[:path=PATH]                        writes the MeSH term matrix like meshmat.py
+Only the node attributes that the stages use are read from .npz inputs. The time of
+reading the input and of each stage is printed as it finishes.
+'''
+
+import sys
+import time
+import inspect
+import argparse
+
+import graphfile
+import score
+import xgmml
+import articlestats
+import meshmat
+
+def _check_choice(stage_name, key, value, choices):
+  if value not in choices:
+    raise Exception('%s: %s must be one of %s, not "%s"' % (stage_name, key, ', '.join(sorted(choices)), value))
+
+# Each stage function checks its options and returns the tuple (node attributes, edge
+# attributes, function of the graph). The attributes are the ones the stage reads,
+# or None for all of them.
+
+def _score_stage(article, neighbor, parent = 'bfs'):
+  _check_choice('score', 'article', article, score._article_score_methods)
+  _check_choice('score', 'neighbor', neighbor, score._neighbor_score_methods)
+  _check_choice('score', 'parent', parent, score._parent_score_methods)
+  return (['type', 'score', 'ct_count', 'pubtypes'], [], lambda g: score.score(g, article, neighbor, parent))
+
+def _save_stage(path):
+  return (None, None, lambda g: graphfile.write(g, path))
+
+def _xgmml_stage(path):
+  return (None, None, lambda g: xgmml.write(g, path))
+
+def _articles_stage(path, columns = 'pubdays', filter = None):
+  columns = columns.split('+')
+  for column in columns:
+    _check_choice('articles', 'columns', column, articlestats.column_choices)
+  if filter != None:
+    _check_choice('articles', 'filter', filter, articlestats.filter_choices)
+  return (articlestats.required_attrs(columns), [], lambda g: articlestats.article_table(g, columns, filter).to_csv(path, mode='w'))
+
+def _mesh_stage(path = None):
+  return (['pmid', 'meshterms'], [], lambda g: meshmat.gen_mat(g).to_csv(path or meshmat.output_path(g), mode='w'))
+
+_stages = {
+  'score': _score_stage,
+  'save': _save_stage,
+  'xgmml': _xgmml_stage,
+  'articles': _articles_stage,
+  'mesh': _mesh_stage,
+}
+
+def parse_stage(spec):
+  '''Returns the tuple (name, node attributes, edge attributes, function of the graph)
+  of a stage given as name:key=value,key=value,...'''
+  (name, _, options_spec) = spec.partition(':')
+  if name not in _stages:
+    raise Exception('Unknown stage "%s", expected one of %s' % (name, ', '.join(sorted(_stages))))
+  options = {}
+  for option in filter(None, options_spec.split(',')):
+    (key, sep, value) = option.partition('=')
+    if not sep:
+      raise Exception('%s: option "%s" is not of the form key=value' % (name, option))
+    options[key] = value
+  argspec = inspect.getargspec(_stages[name])
+  required = argspec.args[:len(argspec.args) - len(argspec.defaults or ())]
+  unknown = sorted(set(options) - set(argspec.args))
+  if unknown:
+    raise Exception('%s: unknown options %s, expected %s' % (name, ', '.join(unknown), ', '.join(argspec.args)))
+  missing = [key for key in required if not key in options]
+  if missing:
+    raise Exception('%s: missing options %s' % (name, ', '.join(missing)))
+  (v_attrs, e_attrs, func) = _stages[name](**options)
+  return (name, v_attrs, e_attrs, func)
+
+def _union_attrs(attr_lists):
+  '''Returns the union of the attribute lists, or None if any of them is None.'''
+  if any(attrs == None for attrs in attr_lists):
+    return None
+  return set().union(*attr_lists)
+
+def run(input_path, stage_specs):
+  '''Reads the network at input_path once and passes it through the stages in order.
+  Returns the list of (stage name, seconds), starting with reading the input.'''
+  stages = map(parse_stage, stage_specs)
+  v_attrs = _union_attrs([stage[1] for stage in stages])
+  e_attrs = _union_attrs([stage[2] for stage in stages])
+
+  timings = []
+  start = time.time()
+  g = graphfile.read(input_path, v_attrs=v_attrs, e_attrs=e_attrs)
+  timings.append(('read', time.time() - start))
+  print '%-10s %8.2f s' % timings[-1]
+  for (name, _, _, func) in stages:
+    start = time.time()
+    func(g)
+    timings.append((name, time.time() - start))
+    print '%-10s %8.2f s' % timings[-1]
+  print '%-10s %8.2f s' % ('total', sum(secs for (name, secs) in timings))
+  return timings
+
+def _parse_args(args):
+  p = argparse.ArgumentParser(description='Runs a network through several stages in one process.', epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  p.add_argument('input', help='a .npz or .pklz network file')
+  p.add_argument('stages', nargs='+', help='stages of the form name:key=value,key=value,...')
+  return p.parse_args(args)
+
+if __name__ == '__main__':
+  args = _parse_args(sys.argv[1:])
+  run(args.input, args.stages)
@@ -1,11 +1,20 @@
 from io import BytesIO
+import os
 import re
+import time
+import random
+import zlib
+import sqlite3
+import threading
+import cPickle as pickle
 from itertools import count
 import requests
 import requests_cache
 import lxml.etree
-import lxml.html
-from util import has_keys, xpath_str, xpath_strs
+from multiprocessing.pool import ThreadPool
+from util import has_keys, xpath_nodes, xpath_str, xpath_strs, normalize_title, author_last_name
+import ratelimit
+import retry
 
 def _split_range(n, m):
   '''Given a range [0,m], return
@@ -45,23 +54,238 @@ def _ref_to_citmatch_str(ref, refkey):
 
 _pmid_re = re.compile(r'\d+')
 
+_esearch_bad_chars_re = re.compile(r'[()\[\]"]+')
+
 def _ref_to_esearch_term(ref):
   '''Takes a ref (article data in a dictionary) and builds an esearch term
-  (a PubMed query format).'''
-  title = ref['title']
+  (a PubMed query format). Characters that would break up the term are removed,
+  so that terms can be combined with OR.'''
+  title = _esearch_bad_chars_re.sub(u' ', ref['title']).strip()
   if not 'authors' in ref or not ref['authors']:
     return u'({title}[Title])'.format(title=title)
   else:
-    author = ref['authors'][0][0]
+    author = _esearch_bad_chars_re.sub(u' ', ref['authors'][0][0]).strip()
     return u'({title} [Title]) AND ({author} [Author - First])'.format(title=title, author=author)
 
+# set EUTILS_BASE_URL to point the client at another server, e.g. standin.py
+_eutils_base_url = os.environ.get('EUTILS_BASE_URL', 'http://eutils.ncbi.nlm.nih.gov')
+# set NCBI_API_KEY to use an NCBI API key, which allows 10 instead of 3 requests per second
+_api_key = os.environ.get('NCBI_API_KEY')
+_rate_path = '.eutils-rate.sqlite'
+_request_timeout = 120.0
+_result_timeout = 7 * 24 * 60 * 60.0
+# after a 429 response the request rate of every process sharing _rate_path is halved, down to _min_rate, and then
+# raised by _rate_recovery after each request. Once no process has sent a request for _rate_reset_after seconds,
+# the full rate is used again.
+_min_rate = 0.5
+_rate_recovery = 0.05
+_rate_reset_after = 60.0
+
+# at most this many PMIDs are fetched with cached GET requests; more are put on the history server
+_max_efetch_get_ids = 500
+_efetch_get_batch = 100
+# the number of articles fetched by each efetch request from the history server
+_efetch_window = 1000
+# the number of PMIDs sent by each epost request
+_epost_batch = 10000
+# the number of PMIDs returned by each esearch request; E-utilities doesn't allow more
+_esearch_page_size = 10000
+# set PUBMED_MIRROR to use a local PubMed mirror, made with pubmedmirror.py, from somewhere else
+_mirror_path = os.environ.get('PUBMED_MIRROR', '.pubmed-mirror.sqlite')
+
+# the number of title and author searches ORed into each esearch request, and the
+# number of candidate articles that are checked against them with esummary
+_title_search_batch = 20
+_max_title_search_candidates = 500
+# the number of recent history server searches remembered for add_pubmed_data
+_max_remembered_searches = 8
+# sampled results are fetched in windows of at most this many results, and a window only
+# grows to the next sampled result if at most _max_sample_gap unsampled results lie between
+# them, since a few unsampled PMIDs cost less than another rate-limited request
+_max_sample_window = 100
+_max_sample_gap = 10
+
+def _citation_key(journal, year, volume, firstpage, author):
+  '''Returns the tuple of normalized citation fields that the mirror indexes articles by.'''
+  return (normalize_title(journal), unicode(year).strip(), unicode(volume).strip().lower(), unicode(firstpage).strip().lower(), author_last_name(author))
+
+class Mirror:
+  '''A local copy of PubMed article data in a sqlite database. Articles are stored
+  as compressed refs keyed by PMID, and an index of their journal, year, volume,
+  first page, and first author answers citmatch-style lookups.
+  pubmedmirror.py builds it from the NLM baseline and update files.'''
+
+  def __init__(self, path):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute('pragma journal_mode=wal')
+    self.db.execute('create table if not exists articles(pmid text primary key, ref blob not null)')
+    self.db.execute('create table if not exists citations(journal text, year text, volume text, firstpage text, author text, pmid text not null)')
+    self.db.execute('create index if not exists citations_key on citations(journal, year, volume, firstpage)')
+    self.db.execute('create index if not exists citations_pmid on citations(pmid)')
+    self.db.execute('create table if not exists files(name text primary key, articles integer, deleted integer, ingested real)')
+    self.db.commit()
+
+  def put(self, articles):
+    '''Adds or replaces articles, given as a list of tuples (ref, citation key or None).'''
+    with self.lock:
+      pmids = [(ref['pmid'],) for (ref, _) in articles]
+      self.db.executemany('delete from citations where pmid = ?', pmids)
+      self.db.executemany('insert or replace into articles values(?, ?)',
+          [(ref['pmid'], sqlite3.Binary(zlib.compress(pickle.dumps(ref, pickle.HIGHEST_PROTOCOL)))) for (ref, _) in articles])
+      self.db.executemany('insert into citations values(?, ?, ?, ?, ?, ?)',
+          [key + (ref['pmid'],) for (ref, key) in articles if key])
+
+  def delete(self, pmids):
+    with self.lock:
+      self.db.executemany('delete from articles where pmid = ?', [(pmid,) for pmid in pmids])
+      self.db.executemany('delete from citations where pmid = ?', [(pmid,) for pmid in pmids])
+
+  def get(self, pmids):
+    '''Returns a dictionary that maps each of the given PMIDs found in the mirror to its ref.'''
+    refs = {}
+    pmids = list(pmids)
+    with self.lock:
+      for (lo, hi) in _split_range(500, len(pmids)):
+        if lo == hi: continue
+        rows = self.db.execute('select pmid, ref from articles where pmid in (%s)' % ','.join('?' * (hi - lo)), pmids[lo:hi])
+        for (pmid, data) in rows:
+          refs[pmid] = pickle.loads(zlib.decompress(str(data)))
+    return refs
+
+  def citmatch(self, journal, year, volume, firstpage, author):
+    '''Returns the PMID of the one article with the given citation fields, or None.'''
+    key = _citation_key(journal, year, volume, firstpage, author)
+    with self.lock:
+      rows = self.db.execute('select distinct pmid from citations where journal = ? and year = ? and volume = ? and firstpage = ? and author = ?', key).fetchall()
+    return rows[0][0] if len(rows) == 1 else None
+
+  def is_ingested(self, name):
+    with self.lock:
+      return self.db.execute('select 1 from files where name = ?', [name]).fetchone() != None
+
+  def mark_ingested(self, name, num_articles, num_deleted):
+    with self.lock:
+      self.db.execute('insert or replace into files values(?, ?, ?, ?)', [name, num_articles, num_deleted, time.time()])
+
+  def commit(self):
+    with self.lock:
+      self.db.commit()
+
+  def close(self):
+    with self.lock:
+      self.db.commit()
+      self.db.close()
+
+def _classify_error(e):
+  '''Tells the retry policy how to handle an exception raised by a request.'''
+  if isinstance(e, requests.HTTPError):
+    if e.response.status_code == 429:
+      return retry.THROTTLE
+    if e.response.status_code >= 500:
+      return retry.TRANSIENT
+    return retry.PERMANENT
+  if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+    return retry.TRANSIENT
+  return retry.PERMANENT
+
 class Client:
-  def __init__(self):
-    self.session = requests_cache.CachedSession('.req-cache')
-    self.session.mount('http://eutils.ncbi.nlm.nih.gov', requests.adapters.HTTPAdapter(max_retries=10))
-    self.session.mount('http://www.ncbi.nlm.nih.gov', requests.adapters.HTTPAdapter(max_retries=10))
+  def __init__(self, eutils_url = None, api_key = None, workers = 4, mirror_path = None):
+    '''Args:
+      eutils_url: the server to use instead of the one given by EUTILS_BASE_URL
+      api_key: the NCBI API key to use instead of the one given by NCBI_API_KEY
+      workers: the number of threads that send requests in parallel
+      mirror_path: the local PubMed mirror to use instead of the one given by PUBMED_MIRROR.
+        If the mirror exists, PMIDs and article data are looked up in it first, and
+        only the refs it doesn't have are looked up online.
+
+    All requests that aren't cached share one rate limiter across threads and processes,
+    which allows 3 requests per second, or 10 with an API key. Clients with and without
+    an API key use separate limiters.
+    '''
+    self.eutils_url = eutils_url or _eutils_base_url
+    self.api_key = api_key or _api_key
+    self.max_rate = 10.0 if self.api_key else 3.0
+    self.limiter = ratelimit.TokenBucket(self.max_rate, 1, _rate_path, 'eutils-key' if self.api_key else 'eutils',
+                                         max_rate=self.max_rate, rate_ttl=_rate_reset_after)
+    self.retry_policy = retry.RetryPolicy(self._classify_error)
+    self.workers = workers
+    self.pool = None
+
+    # the API key isn't part of the cache key, so responses cached without it are still used.
+    # POST requests are cached by their body, like GET requests by their URL.
+    self.session = requests_cache.CachedSession('.req-cache', allowable_methods=('GET', 'POST'), ignored_parameters=['api_key'])
+    # requests that use the history server can't be cached, since WebEnvs expire
+    self.history_session = requests.Session()
+    for session in [self.session, self.history_session]:
+      # each worker keeps its own connection alive
+      session.mount(self.eutils_url, requests.adapters.HTTPAdapter(pool_maxsize=workers, max_retries=10))
+    self.searches = []
+    mirror_path = mirror_path or _mirror_path
+    self.mirror = Mirror(mirror_path) if os.path.exists(mirror_path) else None
     self.xml_parser = lxml.etree.XMLParser(recover=True, encoding='utf-8')
-    self.html_parser = lxml.html.HTMLParser(recover=True, encoding='utf-8')
+
+  def close(self):
+    if self.pool:
+      self.pool.close()
+      self.pool.join()
+    self.limiter.close()
+    if self.mirror:
+      self.mirror.close()
+
+  def _classify_error(self, e):
+    kind = _classify_error(e)
+    if kind == retry.THROTTLE:
+      # slow down every thread, not just the rejected request
+      self.limiter.set_rate(max(_min_rate, self.limiter.rate / 2.0))
+    return kind
+
+  def _is_cached(self, method, url, params, data):
+    request = self.session.prepare_request(requests.Request(method, url, params=params, data=data))
+    return self.session.cache.has_key(self.session.cache.create_key(request))
+
+  def _request(self, method, url, params = None, data = None, history = False):
+    '''Sends a request and returns its response. Requests go through the cache unless history
+    is true, for requests that create or use a WebEnv on the history server, and only requests
+    that aren't cached wait for the rate limiter. Requests that are rejected with a 429 or fail
+    with a 5xx response, a timeout, or a connection error are retried.'''
+    session = self.history_session if history else self.session
+    if self.api_key:
+      if method == 'GET':
+        params = dict(params, api_key=self.api_key)
+      else:
+        data = dict(data, api_key=self.api_key)
+    if not history and self._is_cached(method, url, params, data):
+      return session.request(method, url, params=params, data=data)
+
+    def send():
+      resp = session.request(method, url, params=params, data=data, timeout=_request_timeout)
+      if resp.status_code == 429 or resp.status_code >= 500:
+        resp.raise_for_status()
+      return resp
+    resp = self.retry_policy.call(send, self.limiter.acquire)
+    if self.limiter.rate < self.max_rate:
+      self.limiter.set_rate(min(self.max_rate, self.limiter.rate + _rate_recovery))
+    return resp
+
+  def _get(self, url, params):
+    return self._request('GET', url, params=params)
+
+  def _post(self, url, data, history = False):
+    return self._request('POST', url, data=data, history=history)
+
+  def _map(self, func, items):
+    '''Calls func with each item on the worker threads and yields the results in order.'''
+    if len(items) <= 1:
+      for item in items:
+        yield func(item)
+      return
+    if not self.pool:
+      self.pool = ThreadPool(self.workers)
+    results = self.pool.imap(func, items)
+    for i in range(len(items)):
+      # next() is given a timeout so that the wait can be interrupted with Ctrl-C
+      yield results.next(_result_timeout)
 
   def _add_pmids_by_citmatch(self, refs):
     '''Try to match the list of refs (dictionaries of article data) using the citmatch service.
@@ -72,7 +296,7 @@ class Client:
 
     citmatch_str = '\n'.join([_ref_to_citmatch_str(ref, str(i)) for (ref, i) in zip(searchable_refs, count())])
 
-    req = self.session.get('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/ecitmatch.cgi',
+    req = self._get(self.eutils_url + '/entrez/eutils/ecitmatch.cgi',
         params={'db': 'pubmed', 'retmode': 'xml', 'bdata': citmatch_str})
     pmids_raw = req.text
     
@@ -87,86 +311,260 @@ class Client:
       if _pmid_re.match(pmid):
         searchable_refs[index]['pmid'] = pmid
 
-  def _add_pmid_by_author_title_scrape(self, ref):
-    '''Try to match the given ref (a dictionary of article data) by doing a standard
-    PubMed article search. If the match succeeds, the ref will acquire a PMID attribute.'''
-    esearch_term = _ref_to_esearch_term(ref)
-    req = self.session.get('http://www.ncbi.nlm.nih.gov/pubmed/', params={'term': esearch_term})
-    doc = lxml.html.document_fromstring(req.content, parser=self.html_parser)
-    idtag = doc.cssselect('.abstract .aux .rprtid .highlight')
-    if not idtag == []:
-      ref['pmid'] = idtag[0].text.encode('utf-8')
+  def _add_pmids_by_title_search(self, refs):
+    '''Try to match the list of refs (dictionaries of article data) by ORing their title and first author
+    searches into one esearch request. The title and first author of each article found are then
+    checked against each ref with esummary. If exactly one article matches a ref, the ref will
+    acquire a PMID attribute.'''
+    searchable_refs = [ref for ref in refs if not 'pmid' in ref and ref.get('title') and normalize_title(ref['title'])]
+    if not searchable_refs:
+      return
+
+    term = u' OR '.join(u'(%s)' % _ref_to_esearch_term(ref) for ref in searchable_refs)
+    req = self._get(self.eutils_url + '/entrez/eutils/esearch.fcgi',
+        params={'db': 'pubmed', 'term': term, 'retmax': _max_title_search_candidates})
+    pmids = xpath_strs(self._parse_xml(req.content), '/eSearchResult/IdList/Id/text()')
+    if not pmids:
+      return
+
+    req = self._get(self.eutils_url + '/entrez/eutils/esummary.fcgi',
+        params={'db': 'pubmed', 'id': ','.join(pmids)})
+    candidates = []
+    for docsum in xpath_nodes(self._parse_xml(req.content), '/eSummaryResult/DocSum'):
+      title = normalize_title(xpath_str(docsum, 'Item[@Name="Title"]/text()') or u'')
+      first_author = xpath_str(docsum, 'Item[@Name="AuthorList"]/Item[@Name="Author"][1]/text()')
+      candidates.append((xpath_str(docsum, 'Id/text()'), title, set(title.split()), author_last_name(first_author) if first_author else None))
+
+    for ref in searchable_refs:
+      title = normalize_title(ref['title'])
+      title_words = set(title.split())
+      last_name = author_last_name(ref['authors'][0][0]) if ref.get('authors') else None
+      # an article matches if it has every word of the title and the same first author,
+      # and an article whose whole title is the same wins over the others
+      matches = [c for c in candidates if title_words <= c[2] and (not last_name or c[3] == last_name)]
+      if len(matches) > 1:
+        matches = [c for c in matches if c[1] == title]
+      if len(matches) == 1:
+        ref['pmid'] = matches[0][0].encode('utf-8')
 
   def _add_pmids(self, refs):
     '''Takes a list of refs (dictionaries containing article data) and tries to
     match their PMIDs. First it will use the citmatch method. If that fails, it will
-    try using the scraping method.'''
-    #print 'add pmids for %d refs' % len(refs)
-    for (lo, hi) in _split_range(50, len(refs)):
-      #print 'add pmids: %d to %d of %d' % (lo, hi, len(refs))
-      self._add_pmids_by_citmatch(refs[lo:hi])
+    try searching by title and first author. The batches of each method are sent in parallel.
+    If there is a local mirror, citations are matched in it before going online.'''
+    if self.mirror:
+      for ref in refs:
+        if not 'pmid' in ref and has_keys(ref, 'journal', 'year', 'volume', 'firstpage', 'authors') and ref['authors']:
+          pmid = self.mirror.citmatch(ref['journal'], ref['year'], ref['volume'], ref['firstpage'], ref['authors'][0][0])
+          if pmid:
+            ref['pmid'] = pmid.encode('utf-8')
+
+    batches = [refs[lo:hi] for (lo, hi) in _split_range(50, len(refs)) if lo < hi]
+    for _ in self._map(self._add_pmids_by_citmatch, batches):
+      pass
+
+    unmatched_refs = [ref for ref in refs if not 'pmid' in ref]
+    batches = [unmatched_refs[lo:hi] for (lo, hi) in _split_range(_title_search_batch, len(unmatched_refs)) if lo < hi]
+    for _ in self._map(self._add_pmids_by_title_search, batches):
+      pass
+
+  def _parse_xml(self, content):
+    return lxml.etree.parse(BytesIO(content), self.xml_parser)
+
+  def _epost(self, pmids):
+    '''Puts the PMIDs on the history server. Returns a list of tuples (WebEnv, query key, number of PMIDs),
+    one per epost request, which all share the same WebEnv.'''
+    queries = []
+    webenv = None
+    for (lo, hi) in _split_range(_epost_batch, len(pmids)):
+      if lo == hi: continue
+      data = {'db': 'pubmed', 'id': ','.join(pmids[lo:hi])}
+      if webenv:
+        data['WebEnv'] = webenv
+      req = self._post(self.eutils_url + '/entrez/eutils/epost.fcgi', data=data, history=True)
+      doc = self._parse_xml(req.content)
+      webenv = xpath_str(doc, '/ePostResult/WebEnv/text()')
+      query_key = xpath_str(doc, '/ePostResult/QueryKey/text()')
+      if not webenv or not query_key:
+        raise Exception('epost failed: %s' % req.content[:200])
+      queries.append((webenv, query_key, hi - lo))
+    return queries
 
-    for ref in refs:
-      if not 'pmid' in ref:
-        self._add_pmid_by_author_title_scrape(ref)
+  def _history_queries(self, pmids):
+    '''Returns the history server queries holding exactly the given PMIDs, either
+    those of a recent search_for_papers call or new ones made with epost.'''
+    pmids_set = frozenset(pmids)
+    for (search_pmids, webenv, query_key) in self.searches:
+      if search_pmids == pmids_set:
+        return [(webenv, query_key, len(pmids_set))]
+    return self._epost(pmids)
+
+  def _fetch_articles(self, pmids):
+    '''Yields the PubmedArticle elements of the given PMIDs. A few PMIDs are fetched with cached GET
+    requests. Larger sets are put on the history server and fetched in large windows with uncached POST requests.
+    The requests are sent in parallel, and the responses are parsed in order as they arrive.'''
+    url = self.eutils_url + '/entrez/eutils/efetch.fcgi'
+    if len(pmids) <= _max_efetch_get_ids:
+      batches = [','.join(pmids[lo:hi]) for (lo, hi) in _split_range(_efetch_get_batch, len(pmids)) if lo < hi]
+      fetch = lambda pmids_str: self._get(url, params={'db': 'pubmed', 'id': pmids_str, 'rettype': 'xml'}).content
+    else:
+      batches = [(webenv, query_key, lo, hi)
+                 for (webenv, query_key, num_pmids) in self._history_queries(pmids)
+                 for (lo, hi) in _split_range(_efetch_window, num_pmids) if lo < hi]
+      def fetch(batch):
+        (webenv, query_key, lo, hi) = batch
+        return self._post(url, data={'db': 'pubmed', 'WebEnv': webenv, 'query_key': query_key, 'retstart': lo, 'retmax': hi - lo, 'rettype': 'xml'}, history=True).content
+
+    for content in self._map(fetch, batches):
+      for article in _iter_articles(content):
+        yield article
 
   def add_pubmed_data(self, refs):
     '''Takes a list of refs (dictionaries containing article data) and tries to add
     as much information about them stored in PubMed.'''
     self._add_pmids(refs)
 
-    refs_with_pmids = [ref['pmid'] for ref in refs if 'pmid' in ref]
-    if not refs_with_pmids: return #print '%d pmids found of %d refs' % (len(refs_with_pmids), len(refs))
-
-    for (lo, hi) in _split_range(100, len(refs_with_pmids)):
-      #print 'pubmed data: %d to %d of %d' % (lo, hi, len(refs_with_pmids))
-      pmids_str = ','.join(refs_with_pmids[lo:hi])
-      req = self.session.get('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi',
-          params={'db': 'pubmed', 'id': pmids_str, 'rettype': 'xml'})
+    refs_by_pmid = _refs_by_pmid(refs)
+    if self.mirror:
+      for (pmid, pubmed_ref) in self.mirror.get(refs_by_pmid.keys()).items():
+        for ref in refs_by_pmid.pop(pmid):
+          ref.update(pubmed_ref)
+    if not refs_by_pmid: return
 
-      doc = lxml.etree.parse(BytesIO(req.content), self.xml_parser)
-      articles = doc.xpath('/PubmedArticleSet/PubmedArticle')
-      for article in articles:
-        pubmed_ref = _article_to_pubmed_ref(article)
-        ref = _dict_with_value(refs, 'pmid', pubmed_ref['pmid'])
+    # articles are converted and merged one at a time while the response is parsed
+    for article in self._fetch_articles(refs_by_pmid.keys()):
+      pubmed_ref = _article_to_pubmed_ref(article)
+      for ref in refs_by_pmid.get(pubmed_ref['pmid'], []):
         ref.update(pubmed_ref)
 
-  def search_for_papers_by_author(self, author_name):
+  def search_for_papers_by_author(self, author_name, max_results = None):
     '''Return a list of refs (article data in dictionaries) written by the given author.'''
-    term = '"%s"[Author]' % author_name
-    req = self.session.get('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi',
-        params={'db': 'pubmed', 'term': term, 'retmax': 100000})
-    doc = lxml.etree.parse(BytesIO(req.content), self.xml_parser)
-    pmids = doc.xpath('/eSearchResult/IdList/Id/text()')
-    refs = [{'pmid': unicode(pmid)} for pmid in pmids]
-    return refs
+    return self.search_for_papers(_author_term(author_name), max_results)
+
+  def iter_papers_by_author(self, author_name, max_results = None):
+    '''Like search_for_papers_by_author, but yields the refs as they arrive.'''
+    return self.iter_papers(_author_term(author_name), max_results)
   
   def num_papers_by_author(self, author_name):
     '''Return the number of papers written by the given author.'''
-    term = '"%s"[Author]' % author_name
-    req = self.session.get('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi',
-        params={'db': 'pubmed', 'term': term, 'retmax': 100000})
-    doc = lxml.etree.parse(BytesIO(req.content), self.xml_parser)
-    count = doc.xpath('/eSearchResult/Count/text()')
-    return int(count[0])
-
-  def search_for_papers(self, term):
+    return self.num_papers(_author_term(author_name))
+
+  def num_papers(self, term):
+    '''Return the number of papers that match the given PubMed query term,
+    without downloading their PMIDs.'''
+    req = self._get(self.eutils_url + '/entrez/eutils/esearch.fcgi',
+        params={'db': 'pubmed', 'term': term, 'rettype': 'count'})
+    return int(xpath_str(self._parse_xml(req.content), '/eSearchResult/Count/text()') or 0)
+
+  def _esearch_page(self, params, history = False):
+    req = self._post(self.eutils_url + '/entrez/eutils/esearch.fcgi', data=params, history=history)
+    return self._parse_xml(req.content)
+
+  def _esearch_history(self, term, retmax):
+    '''Runs the search on the history server. Returns the tuple (WebEnv, query key,
+    number of results, PMIDs of the first retmax results).'''
+    doc = self._esearch_page({'db': 'pubmed', 'term': term, 'usehistory': 'y', 'retstart': 0, 'retmax': retmax}, history=True)
+    return (xpath_str(doc, '/eSearchResult/WebEnv/text()'),
+            xpath_str(doc, '/eSearchResult/QueryKey/text()'),
+            int(xpath_str(doc, '/eSearchResult/Count/text()') or 0),
+            xpath_strs(doc, '/eSearchResult/IdList/Id/text()'))
+
+  def _esearch_pages(self, term, windows):
+    '''Yields the PMIDs of each (retstart, retmax) window of the search's results.
+    The windows are fetched in parallel and yielded in order.'''
+    pages = [{'db': 'pubmed', 'term': term, 'retstart': retstart, 'retmax': retmax} for (retstart, retmax) in windows]
+    for page_doc in self._map(self._esearch_page, pages):
+      yield xpath_strs(page_doc, '/eSearchResult/IdList/Id/text()')
+
+  def iter_papers(self, term, max_results = None):
+    '''Yields refs (article data in dictionaries) that match the given PubMed query term,
+    one page of esearch results at a time, up to max_results refs if given. When every
+    result is read, the search is kept on the history server, so that a following
+    add_pubmed_data call on the same refs can fetch them without posting the PMIDs back.'''
+    page_size = min(_esearch_page_size, max_results) if max_results else _esearch_page_size
+    (webenv, query_key, num_pmids, pmids) = self._esearch_history(term, page_size)
+    if max_results:
+      num_pmids = min(num_pmids, max_results)
+    pmids = pmids[:num_pmids]
+    for pmid in pmids:
+      yield {'pmid': unicode(pmid)}
+    if not webenv or not pmids:
+      return
+
+    windows = [(lo, hi - lo) for (lo, hi) in _split_range(page_size, num_pmids) if lo > 0 and lo < hi]
+    for page_pmids in self._esearch_pages(term, windows):
+      for pmid in page_pmids:
+        yield {'pmid': unicode(pmid)}
+      pmids.extend(page_pmids)
+    if not max_results:
+      self.searches = [(frozenset(pmids), webenv, query_key)] + self.searches[:_max_remembered_searches - 1]
+
+  def search_for_papers(self, term, max_results = None):
     '''Return a list of refs (article data in dictionaries) that match the given
-    PubMed query term.'''
-    req = self.session.get('http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi',
-        params={'db': 'pubmed', 'term': term, 'retmax': 100000})
-    doc = lxml.etree.parse(BytesIO(req.content), self.xml_parser)
-    pmids = doc.xpath('/eSearchResult/IdList/Id/text()')
-    refs = [{'pmid': unicode(pmid)} for pmid in pmids]
-    return refs
+    PubMed query term, up to max_results refs if given.'''
+    return list(self.iter_papers(term, max_results))
+
+  def sample_papers(self, term, sample_size, rand = random):
+    '''Return a list of refs (article data in dictionaries) for a random sample of the papers
+    that match the given PubMed query term, or all of them if there are fewer than sample_size.
+    The search is kept on the history server, and only small windows of results around the
+    sampled positions are fetched from it.'''
+    (webenv, query_key, num_pmids, _) = self._esearch_history(term, 0)
+    if not webenv or not num_pmids:
+      return []
+    positions = rand.sample(xrange(num_pmids), min(sample_size, num_pmids))
+
+    windows = []
+    for position in sorted(positions):
+      if windows and position - windows[-1][1] <= _max_sample_gap + 1 and position - windows[-1][0] < _max_sample_window:
+        windows[-1][1] = position
+      else:
+        windows.append([position, position])
+
+    def fetch(window):
+      (lo, hi) = window
+      req = self._post(self.eutils_url + '/entrez/eutils/efetch.fcgi', data={'db': 'pubmed', 'WebEnv': webenv, 'query_key': query_key,
+          'retstart': lo, 'retmax': hi - lo + 1, 'rettype': 'uilist', 'retmode': 'text'}, history=True)
+      return req.content.split()
+
+    pmids_by_position = {}
+    for ((lo, _), window_pmids) in zip(windows, self._map(fetch, windows)):
+      for (i, pmid) in enumerate(window_pmids):
+        pmids_by_position[lo + i] = pmid
+    return [{'pmid': unicode(pmids_by_position[position])} for position in positions if position in pmids_by_position]
+
+def _author_term(author_name):
+  return '"%s"[Author]' % author_name
+
+def _refs_by_pmid(refs):
+  '''Returns a dictionary that maps each PMID to the list of refs that have it.'''
+  index = {}
+  for ref in refs:
+    if 'pmid' in ref:
+      index.setdefault(ref['pmid'], []).append(ref)
+  return index
+
+def _iter_articles(content):
+  '''Yields each PubmedArticle element of an efetch response as soon as it is parsed.
+  Elements are cleared once the caller moves on, so the response is never held as a whole tree.'''
+  for (_, article) in lxml.etree.iterparse(BytesIO(content), tag='PubmedArticle', recover=True, encoding='utf-8'):
+    yield article
+    article.clear()
+    while article.getprevious() != None:
+      del article.getparent()[0]
 
-def _dict_with_value(ds, k, v):
-  '''Given a list of dictionaries (ds),
-  return the dictionary d such that d[k] == v.'''
-  for d in ds:
-    if k in d and d[k] == v:
-      return d
-  return None
+def _article_citation_key(article, pubmed_ref):
+  '''Returns the citation key of a PubmedArticle element and its converted ref,
+  or None if the article lacks any of the citation fields.'''
+  issue = article.find('MedlineCitation/Article/Journal/JournalIssue')
+  if issue == None or not pubmed_ref.get('journal') or not pubmed_ref.get('authors'):
+    return None
+  year = issue.findtext('PubDate/Year') or (issue.findtext('PubDate/MedlineDate') or u'')[:4] or pubmed_ref.get('year')
+  volume = issue.findtext('Volume')
+  firstpage = (article.findtext('MedlineCitation/Article/Pagination/MedlinePgn') or u'').split('-')[0]
+  if not year or not volume or not firstpage:
+    return None
+  return _citation_key(pubmed_ref['journal'], year, volume, firstpage, pubmed_ref['authors'][0][0])
 
 def _article_to_pubmed_ref(article):
   '''Convert PubMed XML data about an article into a ref (dictionary containing the article data).
@@ -188,7 +586,7 @@ def _article_to_pubmed_ref(article):
 
   institutions = {}
   authors = []
-  for author in article.xpath('MedlineCitation/Article/AuthorList/Author'):
+  for author in xpath_nodes(article, 'MedlineCitation/Article/AuthorList/Author'):
     lastname = xpath_str(author, 'LastName/text()')
     initials = xpath_str(author, 'Initials/text()')
     if lastname and initials:
@@ -206,7 +604,7 @@ def _article_to_pubmed_ref(article):
   r['title'] = xpath_str(article, 'MedlineCitation/Article/ArticleTitle/text()')
 
   pubdate_str = u''
-  pubdate_elem = article.xpath('PubmedData/History/PubMedPubDate[@PubStatus="pubmed"]')[0]
+  pubdate_elem = xpath_nodes(article, 'PubmedData/History/PubMedPubDate[@PubStatus="pubmed"]')[0]
   pubdate_yr = xpath_str(pubdate_elem, 'Year/text()')
   if pubdate_yr:
     pubdate_str += pubdate_yr
@@ -228,7 +626,7 @@ def _article_to_pubmed_ref(article):
   r['pubtypes'] = xpath_strs(article, 'MedlineCitation/Article/PublicationTypeList/PublicationType/text()')
 
   allterms = []
-  for meshheading in article.xpath('MedlineCitation/MeshHeadingList/MeshHeading'):
+  for meshheading in xpath_nodes(article, 'MedlineCitation/MeshHeadingList/MeshHeading'):
     terms = xpath_strs(meshheading, 'DescriptorName/text() | QualifierName/text()')
     allterms.append(terms)
   r['meshterms'] = allterms
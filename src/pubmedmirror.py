@@ -0,0 +1,84 @@
+'''Builds a local PubMed mirror from the NLM baseline and update files.
+
+The files are at ftp://ftp.ncbi.nlm.nih.gov/pubmed/baseline/ and ftp://ftp.ncbi.nlm.nih.gov/pubmed/updatefiles/.
+Ingest the baseline files first and then the update files in order, so that newer versions of
+an article replace older ones. Files that were already ingested are skipped.
+'''
+
+import sys
+import gzip
+import time
+import argparse
+import lxml.etree
+
+import pubmed
+
+_batch_size = 1000
+
+def _open(path):
+  return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def ingest_file(mirror, path):
+  '''Streams the PubmedArticleSet file at path into the mirror. Returns the tuple
+  (number of articles added, number of articles deleted, number of articles skipped).'''
+  num_added = num_deleted = num_skipped = 0
+  batch = []
+  with _open(path) as xml_file:
+    for (_, elem) in lxml.etree.iterparse(xml_file, tag=('PubmedArticle', 'DeleteCitation'), recover=True, huge_tree=True):
+      if elem.tag == 'DeleteCitation':
+        pmids = [pmid.text for pmid in elem.iterfind('PMID')]
+        mirror.delete(pmids)
+        num_deleted += len(pmids)
+      else:
+        try:
+          pubmed_ref = pubmed._article_to_pubmed_ref(elem)
+        except (IndexError, ValueError):
+          # articles without a PubMed date can't be converted
+          pubmed_ref = None
+        if pubmed_ref and pubmed_ref.get('pmid'):
+          batch.append((pubmed_ref, pubmed._article_citation_key(elem, pubmed_ref)))
+        else:
+          num_skipped += 1
+
+      elem.clear()
+      while elem.getprevious() != None:
+        del elem.getparent()[0]
+
+      if len(batch) >= _batch_size:
+        mirror.put(batch)
+        num_added += len(batch)
+        batch = []
+
+  if batch:
+    mirror.put(batch)
+    num_added += len(batch)
+  return (num_added, num_deleted, num_skipped)
+
+def ingest(mirror_path, paths, force):
+  mirror = pubmed.Mirror(mirror_path)
+  try:
+    for path in paths:
+      if not force and mirror.is_ingested(path):
+        print '%s: already ingested' % path
+        continue
+      start = time.time()
+      (num_added, num_deleted, num_skipped) = ingest_file(mirror, path)
+      mirror.mark_ingested(path, num_added, num_deleted)
+      mirror.commit()
+      elapsed = time.time() - start
+      print '%s: %d articles added, %d deleted, %d skipped in %.1f s (%.0f articles/s)' % (
+        path, num_added, num_deleted, num_skipped, elapsed, num_added / elapsed if elapsed > 0 else 0.0)
+      sys.stdout.flush()
+  finally:
+    mirror.close()
+
+def _parse_args(args):
+  p = argparse.ArgumentParser()
+  p.add_argument('--mirror', default=pubmed._mirror_path, help='the mirror database to create or update')
+  p.add_argument('--force', action='store_true', help='ingest files again even if they were already ingested')
+  p.add_argument('files', nargs='+', help='PubmedArticleSet XML files, optionally gzipped')
+  return p.parse_args(args)
+
+if __name__ == '__main__':
+  args = _parse_args(sys.argv[1:])
+  ingest(args.mirror, args.files, args.force)
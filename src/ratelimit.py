@@ -0,0 +1,96 @@
+import time
+import threading
+import sqlite3
+
+class TokenBucket:
+  '''A token-bucket rate limiter. Tokens are refilled at "rate" tokens per second,
+  and at most "burst" tokens can be saved up. Each call to acquire takes one token.
+
+  If a path is given, the bucket and its rate are kept in a row of the sqlite database at
+  that path, so that every process using the same path and name shares the same rate, and
+  set_rate changes it for all of them. Otherwise the bucket is only shared by the threads
+  of this process. The shared rate is never raised above this bucket's max_rate, which
+  defaults to rate, so processes with different limits should use different names.
+  If rate_ttl is given, a shared rate is forgotten once nobody has used the bucket for
+  that many seconds, so that a rate lowered by an earlier run doesn't outlast it.'''
+
+  def __init__(self, rate, burst = 1, path = None, name = 'default', max_rate = None, rate_ttl = None):
+    self.max_rate = float(max_rate or rate)
+    self.initial_rate = min(float(rate), self.max_rate)
+    self.rate = self.initial_rate
+    self.rate_ttl = rate_ttl
+    self.burst = float(burst)
+    self.name = name
+    self.lock = threading.Lock()
+
+    self.tokens = self.burst
+    self.updated = time.time()
+    self.wait_time = 0.0
+
+    self.db = None
+    if path:
+      self.db = sqlite3.connect(path, timeout = 60.0, isolation_level = None, check_same_thread = False)
+      self.db.execute('create table if not exists bucket(name text primary key, tokens real, updated real, rate real)')
+      # bucket tables written by older versions don't have the rate column
+      if 'rate' not in [column[1] for column in self.db.execute('pragma table_info(bucket)')]:
+        self.db.execute('alter table bucket add column rate real')
+
+  def _reserve(self, tokens, elapsed):
+    '''Refills the given number of tokens for the elapsed seconds and takes one. If no token
+    is available, it is borrowed from the future. Returns the tuple (tokens left, seconds to wait).'''
+    tokens = min(self.burst, tokens + max(elapsed, 0.0) * self.rate) - 1.0
+    wait = -tokens / self.rate if tokens < 0.0 else 0.0
+    return (tokens, wait)
+
+  def _reserve_shared(self):
+    '''Like _reserve, but reads and writes the bucket stored in the sqlite database,
+    and picks up the rate that another process may have set.'''
+    self.db.execute('begin immediate')
+    try:
+      now = time.time()
+      row = self.db.execute('select tokens, updated, rate from bucket where name = ?', [self.name]).fetchone()
+      (tokens, updated, rate) = row if row else (self.burst, now, None)
+      if rate == None or (self.rate_ttl and now - updated > self.rate_ttl):
+        self.rate = self.initial_rate
+      else:
+        self.rate = min(rate, self.max_rate)
+      (tokens, wait) = self._reserve(tokens, now - updated)
+      self.db.execute('insert or replace into bucket values(?, ?, ?, ?)', [self.name, tokens, max(now, updated), self.rate])
+      self.db.execute('commit')
+    except:
+      self.db.execute('rollback')
+      raise
+    return wait
+
+  def acquire(self):
+    '''Blocks until the caller is allowed to make one call.'''
+    with self.lock:
+      if self.db:
+        wait = self._reserve_shared()
+      else:
+        now = time.time()
+        (self.tokens, wait) = self._reserve(self.tokens, now - self.updated)
+        self.updated = now
+      self.wait_time += wait
+    if wait > 0.0:
+      time.sleep(wait)
+
+  def set_rate(self, rate):
+    '''Changes the rate, e.g. to slow down after the service rejected a call. A bucket kept
+    in a sqlite database changes the rate of every process sharing it.'''
+    with self.lock:
+      self.rate = min(float(rate), self.max_rate)
+      if self.db:
+        self.db.execute('begin immediate')
+        try:
+          self.db.execute('insert or ignore into bucket values(?, ?, ?, ?)', [self.name, self.burst, time.time(), self.rate])
+          self.db.execute('update bucket set rate = ? where name = ?', [self.rate, self.name])
+          self.db.execute('commit')
+        except:
+          self.db.execute('rollback')
+          raise
+
+  def close(self):
+    if self.db:
+      self.db.close()
+      self.db = None
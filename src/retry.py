@@ -0,0 +1,80 @@
+import time
+import random
+import threading
+
+# the kinds of errors returned by classifier functions
+SESSION = 'session'     # the session expired or is invalid; retried after signing in again
+THROTTLE = 'throttle'   # the service rejected the call because of its rate limit; retried after a backoff
+TRANSIENT = 'transient' # a timeout, a dropped connection, or a server error; retried after a backoff
+PERMANENT = 'permanent' # the call itself is bad, e.g. a malformed query; raised right away
+
+class RetryPolicy:
+  '''Calls functions and retries them with jittered exponential backoff when they fail.
+  Each call keeps its own attempt count, so one failing call doesn't make other calls
+  give up sooner.
+
+  A classifier function decides how each exception is handled. It takes the exception
+  and returns SESSION, THROTTLE, TRANSIENT, or PERMANENT. Exceptions that aren't derived
+  from Exception, like KeyboardInterrupt, are never retried.'''
+
+  def __init__(self, classify, max_attempts = 6, base_delay = 2.0, max_delay = 120.0):
+    '''Args:
+      classify: a function that takes an exception and returns the kind of error
+      max_attempts: the number of times a call is made before its error is raised
+      base_delay: the backoff in seconds after the first failure; it doubles after each failure
+      max_delay: the longest backoff in seconds
+    '''
+    self.classify = classify
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.rand = random.Random()
+    self.lock = threading.Lock()
+    self.counts = {'calls': 0, 'retries': 0, 'failures': 0, 'reauths': 0, 'backoff_secs': 0.0,
+                   SESSION: 0, THROTTLE: 0, TRANSIENT: 0, PERMANENT: 0}
+
+  def _count(self, key, amount = 1):
+    with self.lock:
+      self.counts[key] += amount
+
+  def backoff(self, attempt):
+    '''Returns the seconds to wait after the given failed attempt (starting at 0).
+    Half of the delay is fixed and the other half is random, so that concurrent
+    calls that fail together don't retry together.'''
+    delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+    with self.lock:
+      return delay / 2.0 + self.rand.uniform(0.0, delay / 2.0)
+
+  def call(self, func, before_attempt = None, reauth = None):
+    '''Calls func and returns its result, retrying it according to the policy.
+    before_attempt is called before every attempt, e.g. to wait for a rate limiter.
+    reauth is called with the value before_attempt returned for the failed attempt
+    when func fails because of a SESSION error.'''
+    self._count('calls')
+    attempt = 0
+    while True:
+      token = before_attempt() if before_attempt else None
+      try:
+        return func()
+      except Exception as e:
+        kind = self.classify(e)
+        self._count(kind)
+        attempt += 1
+        if kind == PERMANENT or attempt >= self.max_attempts:
+          self._count('failures')
+          raise
+
+        if kind == SESSION and reauth:
+          self._count('reauths')
+          try:
+            reauth(token)
+          except Exception as reauth_error:
+            # signing in can fail for the same transient reasons; the next attempt tries again
+            if self.classify(reauth_error) == PERMANENT:
+              raise
+        if kind != SESSION or attempt > 1:
+          # a session error is retried right away the first time, since signing in again should fix it
+          delay = self.backoff(attempt - 1)
+          self._count('backoff_secs', delay)
+          time.sleep(delay)
+        self._count('retries')
@@ -1,51 +1,131 @@
 import sys
 import argparse
-import igraph
+from itertools import chain
+import numpy
+import scipy.sparse
+
+import graphfile
+
+_neighbor_types = ['author', 'institution', 'grantagency']
 
 def _read_graph(input_file_path):
-  return igraph.Graph.Read(input_file_path, format='picklez')
+  return graphfile.read(input_file_path)
 
 def _write_graph(g, output_file_path):
-  with open(output_file_path, 'wb') as output_file:
-    g.write(output_file, format='picklez')
-
-def _article_score(articlev):
-  return len(filter(lambda v: v['type'] == 'article', articlev.neighbors(mode = igraph.IN)))
-
-def _score_articles_by_propagation(g):
-  rootv = g.vs.find(type='drug')
-  for (v, depth, parentv) in g.bfsiter(rootv.index, advanced = True):
-    if not v['type'] == 'article': continue
-    parent_score = parentv['score'] if parentv['type'] == 'article' else 0
-    v['score'] = parent_score + _article_score(v)
- 
-def _score_articles_individually(g):
-  for v in g.vs(type='article'):
-    v['score'] = _article_score(v)
-
-def _score_neighbors_by_summing_article_scores(g):
-  for neighbor_type in ['author', 'institution', 'grantagency']:
-    for neighborv in g.vs(type=neighbor_type):
-      sum_scores = 0
-      for articlev in filter(lambda v: (v['type'] == 'article') and (v['score'] != None), neighborv.neighbors(mode = igraph.IN)):
-        sum_scores += articlev['score']
-      neighborv['score'] = sum_scores
-
-def _score_neighbors_by_article_indegree(g):
-  for neighbor_type in ['author', 'institution', 'grantagency']:
-    for neighborv in g.vs(type=neighbor_type):
-      neighborv['score'] = len(filter(lambda v: v['type'] == 'article', neighborv.neighbors(mode = igraph.IN)))
-
-def _add_ct_counts(g):
-  for neighbor_type in ['author', 'institution', 'grantagency']:
-    for neighborv in g.vs(type=neighbor_type):
-      ct_count = 0
-      for articlev in filter(lambda v: (v['type'] == 'article') and (v['pubtypes'] != None), neighborv.neighbors(mode = igraph.IN)):
-        for pubtype in articlev['pubtypes']:
-          if 'Clinical' in pubtype:
-            ct_count += 1
-            break
-      neighborv['ct_count'] = ct_count
+  graphfile.write(g, output_file_path)
+
+class _ScoringGraph:
+  '''The in-adjacency matrix and node type masks of a graph, built once and shared by the scoring methods.'''
+
+  def __init__(self, g):
+    self.g = g
+    n = g.vcount()
+    edge_list = g.get_edgelist()
+    self.edges = edges = numpy.fromiter(chain.from_iterable(edge_list), dtype=numpy.int64, count=2 * len(edge_list)).reshape(-1, 2)
+    # in_adj[trg, src] is the number of edges from src to trg, so in_adj.dot(x) sums x over
+    # each node's in-neighbors, counting a neighbor once per edge like Vertex.neighbors does
+    self.in_adj = scipy.sparse.csr_matrix((numpy.ones(len(edges), dtype=numpy.int64), (edges[:, 1], edges[:, 0])), shape=(n, n))
+    self.types = numpy.array(g.vs['type'], dtype=object)
+    self.is_article = self.types == 'article'
+    self.is_neighbor = numpy.zeros(n, dtype=bool)
+    for neighbor_type in _neighbor_types:
+      self.is_neighbor |= self.types == neighbor_type
+    self.article_indegrees = self.in_adj.dot(self.is_article.astype(numpy.int64))
+
+  def attr(self, name):
+    '''Returns the list of values of the node attribute name, or Nones if the graph doesn't have it.'''
+    return self.g.vs[name] if name in self.g.vs.attribute_names() else [None] * self.g.vcount()
+
+  def set_attr(self, name, mask, values):
+    '''Sets the node attribute name to values for the nodes in mask, keeping its other values.'''
+    column = numpy.empty(self.g.vcount(), dtype=object)
+    column[:] = self.attr(name)
+    column[mask] = values[mask].tolist()
+    self.g.vs[name] = column.tolist()
+
+  def article_sums(self, values):
+    '''Returns the sums of values over each node's article in-neighbors.'''
+    return self.in_adj.dot(numpy.where(self.is_article, values, 0))
+
+def _bfs_levels(g, root):
+  '''Returns the nodes reached from root in breadth first order, the level of every node
+  (-1 for unreached ones), the start of each level in the order, and each node's BFS parent.'''
+  (order, level_starts, parents) = g.bfs(root)
+  # igraph pads order and parents up to vcount; only the first level_starts[-1] entries are reached nodes
+  order = numpy.array(order[:level_starts[-1]], dtype=numpy.int64)
+  levels = numpy.full(g.vcount(), -1, dtype=numpy.int64)
+  for level in range(len(level_starts) - 1):
+    levels[order[level_starts[level]:level_starts[level + 1]]] = level
+  return (order, levels, level_starts, numpy.array(parents, dtype=numpy.int64))
+
+def _article_parents(sg, levels):
+  '''Returns a matrix whose [v, u] entry is 1 if article u is one level above v and links to it.'''
+  (srcs, trgs) = (sg.edges[:, 0], sg.edges[:, 1])
+  is_parent = (levels[srcs] >= 0) & (levels[trgs] == levels[srcs] + 1) & sg.is_article[srcs]
+  n = sg.g.vcount()
+  parents = scipy.sparse.csr_matrix((numpy.ones(is_parent.sum(), dtype=numpy.int64), (trgs[is_parent], srcs[is_parent])), shape=(n, n))
+  # a parent linking to an article more than once still counts once
+  parents.data[:] = 1
+  return parents
+
+def _bfs_parent_scores(sg, levels, bfs_parents):
+  return lambda articles, scores: scores[bfs_parents[articles]]
+
+def _max_parent_scores(sg, levels, bfs_parents):
+  parents = _article_parents(sg, levels)
+  # scores are never negative, so the implicit zeros of the sparse rows don't change the maxima
+  return lambda articles, scores: parents[articles].multiply(scores[numpy.newaxis, :]).max(axis=1).toarray().ravel()
+
+def _sum_parent_scores(sg, levels, bfs_parents):
+  parents = _article_parents(sg, levels)
+  return lambda articles, scores: parents[articles].dot(scores)
+
+_parent_score_methods = {
+    'bfs': _bfs_parent_scores,
+    'max': _max_parent_scores,
+    'sum': _sum_parent_scores
+}
+
+def _score_articles_by_propagation(sg, parent_scoring = 'bfs'):
+  '''Scores each article reached from the drug by its article in-degree plus the score
+  of its parents one level above it. A parent that isn't an article contributes 0.
+  parent_scoring picks the parents: "bfs" takes the single parent the breadth first search
+  reached the article through, "max" and "sum" combine all the parent articles.'''
+  g = sg.g
+  root = numpy.flatnonzero(sg.types == 'drug')[0]
+  (order, levels, level_starts, bfs_parents) = _bfs_levels(g, root)
+  parent_scores = _parent_score_methods[parent_scoring](sg, levels, bfs_parents)
+  # only the articles scored so far are nonzero, which is what the parent scores read
+  scores = numpy.zeros(g.vcount(), dtype=numpy.int64)
+  for level in range(1, len(level_starts) - 1):
+    level_nodes = order[level_starts[level]:level_starts[level + 1]]
+    articles = level_nodes[sg.is_article[level_nodes]]
+    scores[articles] = parent_scores(articles, scores) + sg.article_indegrees[articles]
+  sg.set_attr('score', sg.is_article & (levels >= 0), scores)
+
+def _score_articles_individually(sg):
+  sg.set_attr('score', sg.is_article, sg.article_indegrees)
+
+def _score_neighbors_by_summing_article_scores(sg):
+  scores = sg.attr('score')
+  has_score = numpy.array([score != None for score in scores], dtype=bool)
+  score_values = numpy.array([score if score != None else 0 for score in scores], dtype=numpy.int64)
+  sg.set_attr('score', sg.is_neighbor, sg.article_sums(numpy.where(has_score, score_values, 0)))
+
+def _score_neighbors_by_article_indegree(sg):
+  sg.set_attr('score', sg.is_neighbor, sg.article_indegrees)
+
+def _is_clinical(pubtypes):
+  if pubtypes == None:
+    return False
+  for pubtype in pubtypes:
+    if 'Clinical' in pubtype:
+      return True
+  return False
+
+def _add_ct_counts(sg):
+  is_clinical = numpy.array(map(_is_clinical, sg.attr('pubtypes')), dtype=numpy.int64)
+  sg.set_attr('ct_count', sg.is_neighbor, sg.article_sums(is_clinical))
 
 _article_score_methods = {
     'propagate': _score_articles_by_propagation,
@@ -57,17 +137,27 @@ _neighbor_score_methods = {
     'indegree': _score_neighbors_by_article_indegree
 }
 
-def _main(input_file_path, output_file_path, article_scoring, neighbor_scoring):
+def score(g, article_scoring, neighbor_scoring, parent_scoring = 'bfs'):
+  '''Adds the score and ct_count attributes to the graph with the given scoring methods.
+  parent_scoring only applies to propagated article scores.'''
+  sg = _ScoringGraph(g)
+  if article_scoring == 'propagate':
+    _score_articles_by_propagation(sg, parent_scoring)
+  else:
+    _article_score_methods[article_scoring](sg)
+  _neighbor_score_methods[neighbor_scoring](sg)
+  _add_ct_counts(sg)
+
+def _main(input_file_path, output_file_path, article_scoring, neighbor_scoring, parent_scoring):
   g = _read_graph(input_file_path)
-  _article_score_methods[article_scoring](g)
-  _neighbor_score_methods[neighbor_scoring](g)
-  _add_ct_counts(g)
+  score(g, article_scoring, neighbor_scoring, parent_scoring)
   _write_graph(g, output_file_path)
 
 def _parse_args(args):
   p = argparse.ArgumentParser()
   p.add_argument('--article-scoring', required=True, choices=_article_score_methods.keys())
   p.add_argument('--neighbor-scoring', required=True, choices=_neighbor_score_methods.keys())
+  p.add_argument('--parent-scoring', default='bfs', choices=_parent_score_methods.keys(), help='with --article-scoring propagate, the parent scores each article adds: the breadth first search parent\'s (the default), or the max or sum over all parent articles one level up')
   p.add_argument('input')
   p.add_argument('output')
   return p.parse_args(args)
@@ -75,4 +165,4 @@ def _parse_args(args):
 if __name__ == '__main__':
   args_raw = sys.argv[1:]
   args = _parse_args(args_raw)
-  _main(args.input, args.output, args.article_scoring, args.neighbor_scoring)
+  _main(args.input, args.output, args.article_scoring, args.neighbor_scoring, args.parent_scoring)
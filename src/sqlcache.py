@@ -0,0 +1,154 @@
+import time
+import zlib
+import sqlite3
+import threading
+import cPickle as pickle
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+# how values are stored in the "codec" column
+_codec_pickle = 0 # an uncompressed pickle, as written by older versions of the cache
+_codec_zlib = 1
+_codec_zstd = 2
+
+class Cache:
+  '''A cache of picklable values stored in a sqlite database. Values are pickled and
+  compressed, lookups are a single query on the primary key, and writes are committed
+  in batches so that a crash only loses the last few entries.
+
+  Older cache files, which keep uncompressed pickles in a "cache(ckey, cval)" table,
+  are migrated into the new table the first time they are opened.'''
+
+  def __init__(self, path, ttl = None, max_bytes = None, compression = 'zlib', commit_every = 100, commit_interval = 30.0):
+    '''Args:
+      path: the sqlite database file
+      ttl: if given, entries older than this many seconds are treated as missing and evicted
+      max_bytes: if given, the least recently used entries are evicted once the stored values exceed this size
+      compression: "zlib" or "zstd"; zstd needs the zstandard package and falls back to zlib without it
+      commit_every: commit after this many writes
+      commit_interval: commit after this many seconds, if anything was written
+    '''
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.codec = _codec_zstd if compression == 'zstd' and zstandard else _codec_zlib
+    self.commit_every = commit_every
+    self.commit_interval = commit_interval
+
+    self.lock = threading.RLock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute('pragma journal_mode=wal')
+    self.db.execute('pragma synchronous=normal')
+    self.db.execute('create table if not exists entries(ckey text primary key, cval blob not null, codec integer not null, size integer not null, ctime real not null, atime real not null)')
+    self.db.execute('create index if not exists entries_atime on entries(atime)')
+    self.db.execute('create index if not exists entries_ctime on entries(ctime)')
+    self._migrate_legacy_table()
+    self.db.commit()
+
+    self.counts = {'hits': 0, 'misses': 0, 'bytes_read': 0, 'bytes_written': 0, 'evictions': 0}
+    self.pending_writes = 0
+    self.last_commit_time = time.time()
+    self.accessed = {}
+    self.total_bytes = self._stored_bytes() if max_bytes else 0
+
+  def _migrate_legacy_table(self):
+    '''Moves the entries of the old "cache" table into the "entries" table.
+    Values are copied as is and are recompressed only when they are rewritten.'''
+    legacy = self.db.execute("select 1 from sqlite_master where type = 'table' and name = 'cache'").fetchone()
+    if not legacy:
+      return
+    now = time.time()
+    self.db.execute('insert or ignore into entries select ckey, cval, ?, length(cval), ?, ? from cache', [_codec_pickle, now, now])
+    self.db.execute('drop table cache')
+
+  def _stored_bytes(self):
+    (total,) = self.db.execute('select coalesce(sum(size), 0) from entries').fetchone()
+    return total
+
+  def _encode(self, value):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if self.codec == _codec_zstd:
+      return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data)
+
+  def _decode(self, data, codec):
+    data = str(data)
+    if codec == _codec_zlib:
+      data = zlib.decompress(data)
+    elif codec == _codec_zstd:
+      data = zstandard.ZstdDecompressor().decompress(data)
+    return pickle.loads(data)
+
+  def get(self, key):
+    '''Returns the tuple (True, value) if the key is in the cache, otherwise (False, None).'''
+    with self.lock:
+      row = self.db.execute('select cval, codec, ctime from entries where ckey = ?', [unicode(key)]).fetchone()
+      now = time.time()
+      if not row or (self.ttl and now - row[2] > self.ttl):
+        self.counts['misses'] += 1
+        return (False, None)
+      (data, codec, _) = row
+      self.counts['hits'] += 1
+      self.counts['bytes_read'] += len(data)
+      if self.max_bytes:
+        self.accessed[unicode(key)] = now
+      return (True, self._decode(data, codec))
+
+  def put(self, key, value):
+    '''Stores the value under the given key, replacing any previous value.'''
+    data = self._encode(value)
+    with self.lock:
+      now = time.time()
+      if self.max_bytes:
+        # a replaced entry's size no longer counts towards the total
+        row = self.db.execute('select size from entries where ckey = ?', [unicode(key)]).fetchone()
+        if row:
+          self.total_bytes -= row[0]
+      self.db.execute('insert or replace into entries values(?, ?, ?, ?, ?, ?)', [unicode(key), sqlite3.Binary(data), self.codec, len(data), now, now])
+      self.counts['bytes_written'] += len(data)
+      if self.max_bytes:
+        self.total_bytes += len(data)
+      self.pending_writes += 1
+      if self.pending_writes >= self.commit_every or now - self.last_commit_time >= self.commit_interval:
+        self.commit()
+
+  def _evict(self):
+    '''Deletes expired entries and, if the cache is over max_bytes,
+    the least recently used entries.'''
+    evicted = 0
+    if self.ttl:
+      evicted += self.db.execute('delete from entries where ctime < ?', [time.time() - self.ttl]).rowcount
+    if self.max_bytes:
+      if evicted:
+        self.total_bytes = self._stored_bytes()
+      excess = self.total_bytes - self.max_bytes
+      if excess > 0:
+        keys = []
+        for (key, size) in self.db.execute('select ckey, size from entries order by atime'):
+          if excess <= 0: break
+          keys.append((key,))
+          excess -= size
+        self.db.executemany('delete from entries where ckey = ?', keys)
+        evicted += len(keys)
+        self.total_bytes = self._stored_bytes()
+    self.counts['evictions'] += evicted
+
+  def commit(self):
+    '''Writes the access times of recently read entries, evicts entries
+    if needed, and commits all pending writes.'''
+    with self.lock:
+      if self.accessed:
+        self.db.executemany('update entries set atime = ? where ckey = ?', [(atime, key) for (key, atime) in self.accessed.items()])
+        self.accessed = {}
+      if self.ttl or self.max_bytes:
+        self._evict()
+      self.db.commit()
+      self.pending_writes = 0
+      self.last_commit_time = time.time()
+
+  def close(self):
+    with self.lock:
+      self.commit()
+      self.db.close()
@@ -0,0 +1,819 @@
+'''Offline stand-in for the web services used by wos.py, pubmed.py, and clinicaltrials.py.
+
+The stand-in serves the WoS SOAP services (WOKMWSAuthenticate and WokSearch), the
+E-utilities (esearch, efetch, esummary, epost, ecitmatch), and the clinicaltrials.gov
+study download from a single local HTTP server. Responses come from recorded fixtures
+when one matches the request, and otherwise from a synthetic citation graph.
+Latency, errors, and rate-limit rejections can be injected per service.
+
+Point the clients at it by setting the base URL environment variables:
+
+  WOS_BASE_URL=http://localhost:8080 EUTILS_BASE_URL=http://localhost:8080 \\
+  CLINICALTRIALS_BASE_URL=http://localhost:8080 \\
+  python src/topdown.py ...
+'''
+
+import sys
+import os
+import re
+import time
+import json
+import random
+import hashlib
+import argparse
+import threading
+import zipfile
+import urllib2
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+import lxml.etree
+
+_upstreams = {
+  'wos': 'http://search.webofknowledge.com',
+  'eutils': 'http://eutils.ncbi.nlm.nih.gov',
+  'clinicaltrials': 'http://clinicaltrials.gov',
+}
+
+def _service_of_path(path):
+  '''Returns the name of the service that the given request path belongs to.'''
+  if path.startswith('/esti/'):
+    return 'wos'
+  if path.startswith('/entrez/'):
+    return 'eutils'
+  if path.startswith('/search'):
+    return 'clinicaltrials'
+  return None
+
+_non_alphanum_re = re.compile(r'[\W_]+', re.UNICODE)
+def _normalize(s):
+  '''Lowercases the string and replaces all runs of punctuation and whitespace with a single space.'''
+  return _non_alphanum_re.sub(u' ', s.lower()).strip()
+
+def _normalize_author(author):
+  '''Takes an author written as "Smith JA", "Smith, JA", or "Smith J A" and returns
+  the tuple (last name, initials), both lowercased.'''
+  if ',' in author:
+    (last_name, initials) = author.split(',', 1)
+  else:
+    pieces = author.strip().split(' ')
+    (last_name, initials) = (' '.join(pieces[:1]), ''.join(pieces[1:]))
+  return (_normalize(last_name).replace(' ', ''), _normalize(initials).replace(' ', ''))
+
+# ---------------------------------------------------------------------------
+# Synthetic citation graph
+# ---------------------------------------------------------------------------
+
+_topic_words = [
+  'cystic', 'fibrosis', 'transmembrane', 'conductance', 'regulator', 'chloride', 'channel', 'airway',
+  'epithelial', 'sodium', 'potentiator', 'corrector', 'mutation', 'protein', 'folding', 'trafficking',
+  'lipoprotein', 'cholesterol', 'antibody', 'receptor', 'melanoma', 'lymphocyte', 'antigen', 'tumor',
+  'kinase', 'inhibitor', 'signaling', 'pathway', 'expression', 'variant', 'cohort', 'outcome',
+  'therapy', 'response', 'mechanism', 'structure', 'function', 'plasma', 'clearance', 'dose']
+_last_names = [
+  'Smith', 'Johnson', 'Garcia', 'Chen', 'Nguyen', 'Patel', 'Kim', 'Muller', 'Rossi', 'Tanaka',
+  'Dubois', 'Kowalski', 'Silva', 'Cohen', 'Ivanov', 'Larsen', 'Okafor', 'Haddad', 'Novak', 'Berg',
+  'Walker', 'Young', 'Allen', 'Wright', 'Scott', 'Green', 'Baker', 'Adams', 'Nelson', 'Hill']
+_journals = [
+  ('Journal of Synthetic Biology', 'J Synth Biol'),
+  ('Synthetic Medicine', 'Synth Med'),
+  ('Annals of Simulated Research', 'Ann Simul Res'),
+  ('Proceedings of the Offline Society', 'Proc Offline Soc'),
+  ('Clinical Trials in Silico', 'Clin Trials Silico'),
+]
+_institutions = [
+  ('Univ Synthet', 'Dept Med'), ('Offline Inst Technol', 'Dept Biol'), ('Simulated Res Ctr', 'Div Pulm'),
+  ('Fixture Med Sch', 'Dept Pediat'), ('Standin Univ', 'Dept Pharmacol')]
+_grant_agencies = ['NHLBI NIH HHS', 'NCI NIH HHS', 'Synthetic Foundation', 'Offline Trust', 'Wellcome Standin']
+_pubtypes = ['Journal Article', 'Review', 'Clinical Trial', 'Randomized Controlled Trial', 'Practice Guideline']
+
+class SyntheticGraph:
+  '''A deterministic synthetic literature: articles with authors, affiliations, grants, MeSH terms,
+  and references to older articles, plus clinical trials for each drug that refer to articles.'''
+
+  def __init__(self, num_articles = 2000, refs_per_article = 12, num_authors = 600, drugs = ('Ivacaftor',), trials_per_drug = 5, refs_per_trial = 10, seed = 1):
+    rand = random.Random(seed)
+    self.authors = []
+    for i in range(num_authors):
+      last_name = rand.choice(_last_names) + ('' if i < len(_last_names) else str(i))
+      initials = rand.choice('ABCDEFGHJKLMNPRSTW') + rand.choice(['', 'A', 'B', 'C', 'J', 'M', 'R'])
+      self.authors.append((last_name, initials))
+
+    self.articles = []
+    for i in range(num_articles):
+      year = 1980 + (35 * i) / max(num_articles, 1)
+      words = rand.sample(_topic_words, 4)
+      (journal, journal_abbrev) = rand.choice(_journals)
+      article = {
+        'index': i,
+        'pmid': str(10000000 + i),
+        'wosid': 'WOS:%015d' % (i + 1),
+        'title': 'Study %d of %s %s in %s %s' % (i, words[0], words[1], words[2], words[3]),
+        'authors': rand.sample(self.authors, rand.randint(1, 8)),
+        'institutions': rand.sample(_institutions, rand.randint(1, 3)),
+        'grantagencies': rand.sample(_grant_agencies, rand.randint(0, 2)),
+        'pubtypes': ['Journal Article'] + ([rand.choice(_pubtypes[1:])] if rand.random() < 0.3 else []),
+        'meshterms': [[word.capitalize()] for word in rand.sample(_topic_words, 3)],
+        'journal': journal,
+        'journal_abbrev': journal_abbrev,
+        'year': year,
+        'month': rand.randint(1, 12),
+        'day': rand.randint(1, 28),
+        'volume': str(rand.randint(1, 120)),
+        'firstpage': str(rand.randint(1, 2000)),
+        'refs': sorted(set(rand.randint(0, i - 1) for j in range(refs_per_article))) if i > 0 else [],
+      }
+      self.articles.append(article)
+
+    self.citing = [[] for i in range(num_articles)]
+    for article in self.articles:
+      for ref in article['refs']:
+        self.citing[ref].append(article['index'])
+
+    self.by_pmid = dict((article['pmid'], article['index']) for article in self.articles)
+    self.by_wosid = dict((article['wosid'], article['index']) for article in self.articles)
+    self.norm_titles = [_normalize(article['title']) for article in self.articles]
+    self.norm_authors = [[_normalize_author(u'%s %s' % author) for author in article['authors']] for article in self.articles]
+
+    self.trials = {}
+    nctid = 1
+    for drug in drugs:
+      trials = []
+      for i in range(trials_per_drug):
+        refs = rand.sample(range(num_articles / 2, num_articles), min(refs_per_trial, num_articles / 2))
+        trials.append({'nctid': 'NCT%08d' % nctid, 'title': 'A trial of %s, part %d' % (drug, i + 1), 'refs': refs})
+        nctid += 1
+      self.trials[drug.lower()] = trials
+
+  def cse_citation(self, i):
+    '''Returns the article as a citation in the CSE format.'''
+    article = self.articles[i]
+    authors = ', '.join('%s %s' % author for author in article['authors'])
+    return '%s. %s. %s %d;%s:%s.' % (authors, article['title'], article['journal_abbrev'], article['year'], article['volume'], article['firstpage'])
+
+  def author_matches(self, i, author, first_only = False):
+    '''Returns true if the given author name matches an author (or the first author) of article i.
+    Initials given in the query must be a prefix of the article author's initials.'''
+    (last_name, initials) = _normalize_author(author)
+    authors = self.norm_authors[i][:1] if first_only else self.norm_authors[i]
+    return any(last_name == a_last and a_initials.startswith(initials) for (a_last, a_initials) in authors)
+
+  def journal_matches(self, i, journal):
+    article = self.articles[i]
+    journal = _normalize(journal)
+    return journal in (_normalize(article['journal']), _normalize(article['journal_abbrev']))
+
+  def _match_pubmed_field(self, text, field):
+    '''Returns the set of article indices matching a single "text[field]" PubMed search term.'''
+    text = text.strip().strip('"')
+    field = field.strip().lower()
+    if field in ('author', 'au', 'author - first', '1au'):
+      first_only = field in ('author - first', '1au')
+      return set(i for i in range(len(self.articles)) if self.author_matches(i, text, first_only))
+    if field in ('pmid', 'uid'):
+      return set([self.by_pmid[text]]) if text in self.by_pmid else set()
+    if field in ('mesh terms', 'mh', 'mesh'):
+      term = text.lower()
+      return set(i for (i, article) in enumerate(self.articles) if any(t[0].lower() == term for t in article['meshterms']))
+    phrase = _normalize(text)
+    return set(i for (i, title) in enumerate(self.norm_titles) if phrase in title)
+
+  _term_token_re = re.compile(r'\s*(?:(\()|(\))|(AND|OR|NOT)(?=[\s(])|("[^"]*"|[^\[\]()]+?)\s*\[([^\]]+)\]|([^\s()\[\]]+))')
+
+  def _tokenize_term(self, term):
+    tokens = []
+    pos = 0
+    term = term.strip()
+    while pos < len(term):
+      m = self._term_token_re.match(term, pos)
+      if not m or m.end() == pos:
+        break
+      (lparen, rparen, op, text, field, word) = m.groups()
+      if lparen: tokens.append(('(', None))
+      elif rparen: tokens.append((')', None))
+      elif op: tokens.append(('op', op))
+      elif field: tokens.append(('atom', (text, field)))
+      elif word: tokens.append(('atom', (word, 'all fields')))
+      pos = m.end()
+    return tokens
+
+  def search_term(self, term):
+    '''Evaluates a PubMed search term made of "text[field]" terms combined with
+    AND, OR, NOT, and parentheses. Returns the sorted list of matching article indices.'''
+    tokens = self._tokenize_term(term)
+
+    def parse_expr(pos):
+      (result, pos) = parse_atom(pos)
+      while pos < len(tokens) and tokens[pos][0] != ')':
+        op = 'AND'
+        if tokens[pos][0] == 'op':
+          op = tokens[pos][1]
+          pos += 1
+        (rhs, pos) = parse_atom(pos)
+        if op == 'AND': result = result & rhs
+        elif op == 'OR': result = result | rhs
+        else: result = result - rhs
+      return (result, pos)
+
+    def parse_atom(pos):
+      if pos >= len(tokens):
+        return (set(), pos)
+      (kind, value) = tokens[pos]
+      if kind == '(':
+        (result, pos) = parse_expr(pos + 1)
+        return (result, pos + 1)
+      if kind == 'atom':
+        return (self._match_pubmed_field(*value), pos + 1)
+      return (set(), pos + 1)
+
+    (result, _) = parse_expr(0)
+    return sorted(result)
+
+  _wos_clause_re = re.compile(r'TI=\(([^)]*)\) AND AU=\(([^)]*)\)(?: AND SO=\(([^)]*)\))?(?: AND PY=\(([^)]*)\))?')
+
+  def wos_search(self, user_query):
+    '''Evaluates a WoS userQuery made of one or more ORed "TI=(...) AND AU=(...) [AND SO=(...)] [AND PY=(...)]"
+    clauses, as built by wos.Client. Returns the sorted list of matching article indices.'''
+    results = set()
+    for (title, author, journal, year) in self._wos_clause_re.findall(user_query):
+      phrase = _normalize(title.strip().strip('"'))
+      if not phrase:
+        continue
+      for (i, norm_title) in enumerate(self.norm_titles):
+        if not phrase in norm_title: continue
+        if not self.author_matches(i, author.strip('"')): continue
+        if journal and not self.journal_matches(i, journal): continue
+        if year and str(self.articles[i]['year']) != year.strip(): continue
+        results.add(i)
+    return sorted(results)
+
+  def citmatch(self, journal, year, volume, firstpage, author):
+    '''Returns the index of the article matching the citation, or None.'''
+    for (i, article) in enumerate(self.articles):
+      if article['volume'] == volume and article['firstpage'] == firstpage and str(article['year']) == year \
+         and self.journal_matches(i, journal) and self.author_matches(i, author, True):
+        return i
+    return None
+
+# ---------------------------------------------------------------------------
+# Response rendering
+# ---------------------------------------------------------------------------
+
+def _pubmed_article_xml(article):
+  authors = ''.join(
+    '<Author><LastName>%s</LastName><Initials>%s</Initials><Affiliation>%s</Affiliation></Author>'
+    % (escape(last_name), escape(initials), escape(', '.join(reversed(article['institutions'][j % len(article['institutions'])]))))
+    for (j, (last_name, initials)) in enumerate(article['authors']))
+  grants = ''.join('<Grant><Agency>%s</Agency></Grant>' % escape(agency) for agency in article['grantagencies'])
+  pubtypes = ''.join('<PublicationType>%s</PublicationType>' % escape(pubtype) for pubtype in article['pubtypes'])
+  meshterms = ''.join('<MeshHeading><DescriptorName>%s</DescriptorName></MeshHeading>' % escape(term[0]) for term in article['meshterms'])
+  return (
+    '<PubmedArticle><MedlineCitation Status="MEDLINE"><PMID Version="1">%(pmid)s</PMID>'
+    '<Article><Journal><JournalIssue><Volume>%(volume)s</Volume><PubDate><Year>%(year)d</Year></PubDate></JournalIssue><Title>%(journal)s</Title></Journal>'
+    '<ArticleTitle>%(title)s</ArticleTitle><Pagination><MedlinePgn>%(firstpage)s-%(lastpage)s</MedlinePgn></Pagination>'
+    '<AuthorList CompleteYN="Y">%(authors)s</AuthorList>%(grants)s'
+    '<PublicationTypeList>%(pubtypes)s</PublicationTypeList></Article>'
+    '<MedlineJournalInfo><MedlineTA>%(journal_abbrev)s</MedlineTA></MedlineJournalInfo>'
+    '<MeshHeadingList>%(meshterms)s</MeshHeadingList></MedlineCitation>'
+    '<PubmedData><History><PubMedPubDate PubStatus="pubmed"><Year>%(year)d</Year><Month>%(month)d</Month><Day>%(day)d</Day></PubMedPubDate></History>'
+    '<ArticleIdList><ArticleId IdType="pubmed">%(pmid)s</ArticleId></ArticleIdList></PubmedData></PubmedArticle>'
+    % dict(article, title=escape(article['title']), journal=escape(article['journal']), journal_abbrev=escape(article['journal_abbrev']),
+           lastpage=int(article['firstpage']) + 9, authors=authors, grants=('<GrantList CompleteYN="Y">%s</GrantList>' % grants) if grants else '', pubtypes=pubtypes, meshterms=meshterms))
+
+def _pubmed_articles_xml(articles):
+  return '<?xml version="1.0"?>\n<PubmedArticleSet>%s</PubmedArticleSet>' % ''.join(_pubmed_article_xml(article) for article in articles)
+
+def _esummary_xml(articles):
+  docsums = []
+  for article in articles:
+    authors = ''.join('<Item Name="Author" Type="String">%s %s</Item>' % (escape(last_name), escape(initials)) for (last_name, initials) in article['authors'])
+    docsums.append(
+      '<DocSum><Id>%s</Id><Item Name="PubDate" Type="Date">%d</Item><Item Name="Source" Type="String">%s</Item>'
+      '<Item Name="AuthorList" Type="List">%s</Item><Item Name="Title" Type="String">%s</Item></DocSum>'
+      % (article['pmid'], article['year'], escape(article['journal_abbrev']), authors, escape(article['title'])))
+  return '<?xml version="1.0"?>\n<eSummaryResult>%s</eSummaryResult>' % ''.join(docsums)
+
+def _wos_record_xml(article, citcount):
+  names = ''.join(
+    '<name seq_no="%d" role="author" addr_no="%d"><display_name>%s, %s</display_name><wos_standard>%s, %s</wos_standard></name>'
+    % (j + 1, j % len(article['institutions']) + 1, escape(last_name), escape(initials), escape(last_name), escape(initials))
+    for (j, (last_name, initials)) in enumerate(article['authors']))
+  addresses = ''.join(
+    '<address_name><address_spec addr_no="%d"><full_address>%s, %s</full_address><organizations count="1"><organization>%s</organization></organizations></address_spec></address_name>'
+    % (j + 1, escape(dept), escape(org), escape(org))
+    for (j, (org, dept)) in enumerate(article['institutions']))
+  return (
+    '<REC><UID>%s</UID><static_data><summary>'
+    '<pub_info issue="1" vol="%s" sortdate="%04d-%02d-%02d" pubyear="%d"/>'
+    '<titles count="2"><title type="source">%s</title><title type="item">%s</title></titles>'
+    '<names count="%d">%s</names></summary>'
+    '<fullrecord_metadata><addresses count="%d">%s</addresses></fullrecord_metadata></static_data>'
+    '<dynamic_data><citation_related><tc_list><silo_tc coll_id="WOS" local_count="%d"/></tc_list></citation_related></dynamic_data></REC>'
+    % (article['wosid'], article['volume'], article['year'], article['month'], article['day'], article['year'],
+       escape(article['journal'].upper()), escape(article['title']),
+       len(article['authors']), names, len(article['institutions']), addresses, citcount))
+
+_wos_records_ns = 'http://scientific.thomsonreuters.com/schema/wok5.4/public/FullRecord'
+_soap_env_ns = 'http://schemas.xmlsoap.org/soap/envelope/'
+_wos_search_ns = 'http://woksearch.v3.wokmws.thomsonreuters.com'
+_wos_auth_ns = 'http://auth.cxf.wokmws.thomsonreuters.com'
+# longer WoS queries are rejected with a permanent fault, like the real service does
+_wos_max_query_len = 5000
+
+def _soap_response(ns, operation, content):
+  return ('<soap:Envelope xmlns:soap="%s"><soap:Body><ns2:%sResponse xmlns:ns2="%s">%s</ns2:%sResponse></soap:Body></soap:Envelope>'
+          % (_soap_env_ns, operation, ns, content, operation))
+
+def _soap_fault(message):
+  return ('<soap:Envelope xmlns:soap="%s"><soap:Body><soap:Fault><faultcode>soap:Server</faultcode>'
+          '<faultstring>%s</faultstring></soap:Fault></soap:Body></soap:Envelope>' % (_soap_env_ns, escape(message)))
+
+def _wsdl_operation_xml(operation):
+  return ('<wsdl:operation name="%s"><soap:operation soapAction="" style="document"/>'
+          '<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>' % operation)
+
+def _wsdl(service, ns, location, types, operations):
+  '''Returns a document/literal-wrapped WSDL for the given operations, whose request and
+  response wrapper elements must be defined in types.'''
+  messages = ''.join(
+    '<wsdl:message name="%s"><wsdl:part name="parameters" element="tns:%s"/></wsdl:message>'
+    '<wsdl:message name="%sResponse"><wsdl:part name="parameters" element="tns:%sResponse"/></wsdl:message>' % (op, op, op, op)
+    for op in operations)
+  port_ops = ''.join(
+    '<wsdl:operation name="%s"><wsdl:input message="tns:%s"/><wsdl:output message="tns:%sResponse"/></wsdl:operation>' % (op, op, op)
+    for op in operations)
+  binding_ops = ''.join(_wsdl_operation_xml(op) for op in operations)
+  return (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<wsdl:definitions name="%(service)sService" targetNamespace="%(ns)s" xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" '
+    'xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="%(ns)s">'
+    '<wsdl:types><xs:schema targetNamespace="%(ns)s" elementFormDefault="unqualified">%(types)s</xs:schema></wsdl:types>'
+    '%(messages)s<wsdl:portType name="%(service)s">%(port_ops)s</wsdl:portType>'
+    '<wsdl:binding name="%(service)sServiceSoapBinding" type="tns:%(service)s">'
+    '<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>%(binding_ops)s</wsdl:binding>'
+    '<wsdl:service name="%(service)sService"><wsdl:port name="%(service)sPort" binding="tns:%(service)sServiceSoapBinding">'
+    '<soap:address location="%(location)s"/></wsdl:port></wsdl:service></wsdl:definitions>'
+    % dict(service=service, ns=ns, location=location, types=types, messages=messages, port_ops=port_ops, binding_ops=binding_ops))
+
+def _seq(*elements):
+  return '<xs:complexType><xs:sequence>%s</xs:sequence></xs:complexType>' % ''.join(elements)
+
+def _el(name, type_name, min_occurs = 1, max_occurs = 1):
+  return '<xs:element name="%s" type="%s" minOccurs="%s" maxOccurs="%s"/>' % (name, type_name, min_occurs, max_occurs)
+
+_auth_types = (
+  '<xs:element name="authenticate">%s</xs:element>' % _seq() +
+  '<xs:element name="authenticateResponse">%s</xs:element>' % _seq(_el('return', 'xs:string', 0)) +
+  '<xs:element name="closeSession">%s</xs:element>' % _seq() +
+  '<xs:element name="closeSessionResponse">%s</xs:element>' % _seq())
+
+_search_types = (
+  '<xs:complexType name="editionDesc"><xs:sequence>%s%s</xs:sequence></xs:complexType>' % (_el('collection', 'xs:string'), _el('edition', 'xs:string')) +
+  '<xs:complexType name="timeSpan"><xs:sequence>%s%s</xs:sequence></xs:complexType>' % (_el('begin', 'xs:date'), _el('end', 'xs:date')) +
+  '<xs:complexType name="sortField"><xs:sequence>%s%s</xs:sequence></xs:complexType>' % (_el('name', 'xs:string'), _el('sort', 'xs:string', 0)) +
+  '<xs:complexType name="queryParameters"><xs:sequence>%s%s%s%s%s%s</xs:sequence></xs:complexType>' % (
+    _el('databaseId', 'xs:string'), _el('userQuery', 'xs:string'), _el('editions', 'tns:editionDesc', 0, 'unbounded'),
+    _el('symbolicTimeSpan', 'xs:string', 0), _el('timeSpan', 'tns:timeSpan', 0), _el('queryLanguage', 'xs:string')) +
+  '<xs:complexType name="retrieveParameters"><xs:sequence>%s%s%s</xs:sequence></xs:complexType>' % (
+    _el('firstRecord', 'xs:int'), _el('count', 'xs:int'), _el('sortField', 'tns:sortField', 0, 'unbounded')) +
+  '<xs:complexType name="searchResults"><xs:sequence>%s%s%s%s</xs:sequence></xs:complexType>' % (
+    _el('queryId', 'xs:string', 0), _el('recordsFound', 'xs:int'), _el('recordsSearched', 'xs:long'), _el('records', 'xs:string', 0)) +
+  '<xs:complexType name="fullRecordSearchResults"><xs:sequence>%s%s%s%s%s</xs:sequence></xs:complexType>' % (
+    _el('queryId', 'xs:string', 0), _el('recordsFound', 'xs:int'), _el('recordsSearched', 'xs:long'), _el('parent', 'xs:string', 0), _el('records', 'xs:string', 0)) +
+  '<xs:complexType name="citedReference"><xs:sequence>%s</xs:sequence></xs:complexType>' % ''.join(
+    _el(name, 'xs:string', 0) for name in ['uid', 'docid', 'articleId', 'citedAuthor', 'timesCited', 'year', 'page', 'volume', 'citedTitle', 'citedWork', 'hot']) +
+  '<xs:complexType name="citedReferencesSearchResults"><xs:sequence>%s%s%s%s</xs:sequence></xs:complexType>' % (
+    _el('queryId', 'xs:string', 0), _el('references', 'tns:citedReference', 0, 'unbounded'), _el('recordsFound', 'xs:int'), _el('recordsSearched', 'xs:long')) +
+  '<xs:element name="search">%s</xs:element>' % _seq(_el('queryParameters', 'tns:queryParameters'), _el('retrieveParameters', 'tns:retrieveParameters')) +
+  '<xs:element name="searchResponse">%s</xs:element>' % _seq(_el('return', 'tns:searchResults', 0)) +
+  '<xs:element name="citedReferences">%s</xs:element>' % _seq(
+    _el('databaseId', 'xs:string'), _el('uid', 'xs:string'), _el('queryLanguage', 'xs:string'), _el('retrieveParameters', 'tns:retrieveParameters')) +
+  '<xs:element name="citedReferencesResponse">%s</xs:element>' % _seq(_el('return', 'tns:citedReferencesSearchResults', 0)) +
+  '<xs:element name="citingArticles">%s</xs:element>' % _seq(
+    _el('databaseId', 'xs:string'), _el('uid', 'xs:string'), _el('editions', 'tns:editionDesc', 0, 'unbounded'),
+    _el('timeSpan', 'tns:timeSpan', 0), _el('queryLanguage', 'xs:string'), _el('retrieveParameters', 'tns:retrieveParameters')) +
+  '<xs:element name="citingArticlesResponse">%s</xs:element>' % _seq(_el('return', 'tns:fullRecordSearchResults', 0)))
+
+def _clinical_trial_xml(graph, trial):
+  references = ''.join(
+    '<reference><citation>%s</citation><PMID>%s</PMID></reference>' % (escape(graph.cse_citation(i)), graph.articles[i]['pmid'])
+    for i in trial['refs'])
+  return ('<?xml version="1.0" encoding="UTF-8"?><clinical_study><id_info><nct_id>%s</nct_id></id_info>'
+          '<brief_title>%s</brief_title><completion_date>January 2012</completion_date>%s</clinical_study>'
+          % (trial['nctid'], escape(trial['title']), references))
+
+# ---------------------------------------------------------------------------
+# Server
+# ---------------------------------------------------------------------------
+
+class _RateLimited(Exception):
+  pass
+
+class _Fault(Exception):
+  pass
+
+class StandIn:
+  '''Answers requests for all stand-in services. Thread-safe.'''
+
+  def __init__(self, graph, base_url, fixtures_dir = None, record = False, latency = None, error_rate = None, rate_limit = None, session_ttl = None, seed = 1):
+    '''Args:
+      graph: the SyntheticGraph used when no fixture matches a request
+      base_url: the URL the stand-in is reachable at, used in WSDLs and to rewrite recorded URLs
+      fixtures_dir: a directory of recorded responses
+      record: if true, every request is forwarded to the real service and its response is saved to fixtures_dir
+      latency, error_rate, rate_limit: dictionaries that map a service name (or "*" for all services) to
+        the seconds added to each call, the fraction of calls that fail, and the calls per second allowed
+      session_ttl: if given, WoS session IDs expire after this many seconds
+    '''
+    self.graph = graph
+    self.base_url = base_url
+    self.fixtures_dir = fixtures_dir
+    self.record = record
+    self.latency = latency or {}
+    self.error_rate = error_rate or {}
+    self.rate_limit = rate_limit or {}
+    self.session_ttl = session_ttl
+
+    self.lock = threading.Lock()
+    self.rand = random.Random(seed)
+    self.call_times = {}
+    self.sessions = {}
+    self.history = {}
+    self.start_time = time.time()
+    self.stats = {}
+
+  def _setting(self, settings, service):
+    return settings.get(service, settings.get('*'))
+
+  def _count(self, service, key, amount = 1):
+    with self.lock:
+      service_stats = self.stats.setdefault(service, {'requests': 0, 'errors': 0, 'rejected': 0, 'fixtures': 0, 'bytes': 0})
+      service_stats[key] += amount
+
+  def stats_json(self):
+    with self.lock:
+      elapsed = time.time() - self.start_time
+      stats = dict((service, dict(s, requests_per_sec = s['requests'] / elapsed if elapsed > 0 else 0.0)) for (service, s) in self.stats.items())
+    return json.dumps({'elapsed_secs': elapsed, 'services': stats}, indent=2, sort_keys=True)
+
+  def _inject(self, service):
+    '''Sleeps for the configured latency and raises _RateLimited or _Fault when
+    the service is over its rate limit or an error is injected.'''
+    rate_limit = self._setting(self.rate_limit, service)
+    if rate_limit:
+      with self.lock:
+        now = time.time()
+        recent = [t for t in self.call_times.get(service, []) if now - t < 1.0]
+        over = len(recent) >= rate_limit
+        if not over:
+          recent.append(now)
+        self.call_times[service] = recent
+      if over:
+        raise _RateLimited()
+    latency = self._setting(self.latency, service)
+    if latency:
+      time.sleep(latency)
+    error_rate = self._setting(self.error_rate, service)
+    if error_rate:
+      with self.lock:
+        failed = self.rand.random() < error_rate
+      if failed:
+        raise _Fault('Internal server error (injected failure)')
+
+  def _fixture_path(self, method, path, query, body):
+    key = hashlib.sha1('\n'.join([method, path, '&'.join(sorted(query.split('&'))), body or ''])).hexdigest()
+    return os.path.join(self.fixtures_dir, key)
+
+  def _rewrite_urls(self, content):
+    '''Replaces the real services' URLs in recorded text responses with the stand-in's URL.'''
+    for upstream in _upstreams.values():
+      content = content.replace(upstream, self.base_url).replace(upstream.replace('http:', 'https:'), self.base_url)
+    return content
+
+  def _load_fixture(self, method, path, query, body):
+    if not self.fixtures_dir:
+      return None
+    fixture_path = self._fixture_path(method, path, query, body)
+    if not os.path.exists(fixture_path + '.json'):
+      return None
+    with open(fixture_path + '.json') as meta_file:
+      meta = json.load(meta_file)
+    with open(fixture_path + '.body', 'rb') as body_file:
+      content = body_file.read()
+    if 'xml' in meta['content_type'] or 'html' in meta['content_type'] or 'text' in meta['content_type']:
+      content = self._rewrite_urls(content)
+    return (meta['status'], str(meta['content_type']), content)
+
+  def _record_fixture(self, service, method, path, query, body, headers):
+    '''Forwards the request to the real service and saves its response as a fixture.'''
+    url = _upstreams[service] + path + ('?' + query if query else '')
+    req = urllib2.Request(url, data = body if method == 'POST' else None)
+    for header in ('Content-Type', 'SOAPAction', 'Cookie'):
+      if header in headers:
+        req.add_header(header, headers[header])
+    try:
+      resp = urllib2.urlopen(req)
+      (status, content_type, content) = (resp.getcode(), resp.info().gettype(), resp.read())
+    except urllib2.HTTPError as e:
+      (status, content_type, content) = (e.code, e.info().gettype(), e.read())
+    fixture_path = self._fixture_path(method, path, query, body)
+    with open(fixture_path + '.json', 'w') as meta_file:
+      json.dump({'status': status, 'content_type': content_type, 'url': url}, meta_file)
+    with open(fixture_path + '.body', 'wb') as body_file:
+      body_file.write(content)
+    if 'xml' in content_type or 'html' in content_type:
+      content = self._rewrite_urls(content)
+    return (status, content_type, content)
+
+  def handle(self, method, path, query, body, headers):
+    '''Returns the tuple (HTTP status, content type, content) for the request.'''
+    if path == '/standin/stats':
+      return (200, 'application/json', self.stats_json())
+
+    service = _service_of_path(path)
+    if not service:
+      return (404, 'text/plain', 'Unknown path: %s' % path)
+    self._count(service, 'requests')
+    try:
+      self._inject(service)
+      if self.record:
+        response = self._record_fixture(service, method, path, query, body, headers)
+      else:
+        response = self._load_fixture(method, path, query, body)
+        if response:
+          self._count(service, 'fixtures')
+        else:
+          response = self._synthetic(service, method, path, urlparse.parse_qs(query), body, headers)
+    except _RateLimited:
+      self._count(service, 'rejected')
+      if service == 'wos':
+        response = (500, 'text/xml', _soap_fault('Request denied by Throttle server'))
+      else:
+        response = (429, 'application/json', '{"error":"API rate limit exceeded"}')
+    except _Fault as e:
+      self._count(service, 'errors')
+      if service == 'wos':
+        response = (500, 'text/xml', _soap_fault(str(e)))
+      else:
+        response = (500, 'text/plain', str(e))
+    self._count(service, 'bytes', len(response[2]))
+    return response
+
+  def _synthetic(self, service, method, path, params, body, headers):
+    if method == 'POST' and service != 'wos':
+      for (k, v) in urlparse.parse_qs(body or '').items():
+        params.setdefault(k, []).extend(v)
+    params = dict((k, v[-1]) for (k, v) in params.items())
+    if service == 'wos':
+      return self._wos(method, path, params, body, headers)
+    if service == 'eutils':
+      return self._eutils(path, params)
+    return self._clinicaltrials(params)
+
+  # --- Web of Science ---
+
+  def _wos(self, method, path, params, body, headers):
+    if path.endswith('WOKMWSAuthenticate'):
+      (service, ns, types, operations) = ('WOKMWSAuthenticate', _wos_auth_ns, _auth_types, ['authenticate', 'closeSession'])
+    elif path.endswith('WokSearch'):
+      (service, ns, types, operations) = ('WokSearch', _wos_search_ns, _search_types, ['search', 'citedReferences', 'citingArticles'])
+    else:
+      return (404, 'text/plain', 'Unknown WoS service')
+    if method == 'GET':
+      return (200, 'text/xml', _wsdl(service, ns, self.base_url + path, types, operations))
+
+    envelope = lxml.etree.fromstring(body)
+    request = envelope.find('{%s}Body' % _soap_env_ns)[0]
+    operation = lxml.etree.QName(request).localname
+    args = dict((lxml.etree.QName(child).localname, child) for child in request)
+
+    if operation == 'authenticate':
+      sid = hashlib.sha1('%s-%s' % (time.time(), self.rand.random())).hexdigest()[:20].upper()
+      with self.lock:
+        self.sessions[sid] = time.time()
+      return (200, 'text/xml', _soap_response(ns, operation, '<return>%s</return>' % sid))
+    if operation == 'closeSession':
+      return (200, 'text/xml', _soap_response(ns, operation, ''))
+
+    m = re.search(r'SID="?([^";]+)"?', headers.get('Cookie', ''))
+    with self.lock:
+      created = self.sessions.get(m.group(1)) if m else None
+    if created == None or (self.session_ttl and time.time() - created > self.session_ttl):
+      return (500, 'text/xml', _soap_fault('Session ID is invalid or has expired'))
+
+    rp = args['retrieveParameters']
+    first = int(rp.findtext('firstRecord') or 1)
+    count = int(rp.findtext('count') or 100)
+    graph = self.graph
+    if operation == 'search':
+      user_query = args['queryParameters'].findtext('userQuery') or ''
+      if len(user_query) > _wos_max_query_len:
+        return (500, 'text/xml', _soap_fault('Query exceeds maximum length limit of %d characters' % _wos_max_query_len))
+      found = graph.wos_search(user_query)
+    else:
+      uid = request.findtext('uid')
+      i = graph.by_wosid.get(uid)
+      found = [] if i == None else (graph.articles[i]['refs'] if operation == 'citedReferences' else graph.citing[i])
+    page = found[first - 1:first - 1 + count]
+
+    if operation == 'citedReferences':
+      references = []
+      for j in page:
+        article = graph.articles[j]
+        references.append(
+          '<references><uid>%s</uid><citedAuthor>%s %s</citedAuthor><timesCited>%d</timesCited><year>%d</year>'
+          '<page>%s</page><volume>%s</volume><citedTitle>%s</citedTitle><citedWork>%s</citedWork></references>'
+          % (article['wosid'], escape(article['authors'][0][0]), escape(article['authors'][0][1]), len(graph.citing[j]), article['year'],
+             article['firstpage'], article['volume'], escape(article['title']), escape(article['journal_abbrev'].upper())))
+      content = '<return><queryId>1</queryId>%s<recordsFound>%d</recordsFound><recordsSearched>%d</recordsSearched></return>' % (
+        ''.join(references), len(found), len(graph.articles))
+    else:
+      records = '<records xmlns="%s">%s</records>' % (_wos_records_ns, ''.join(_wos_record_xml(graph.articles[j], len(graph.citing[j])) for j in page))
+      content = '<return><queryId>1</queryId><recordsFound>%d</recordsFound><recordsSearched>%d</recordsSearched><records>%s</records></return>' % (
+        len(found), len(graph.articles), escape(records))
+    return (200, 'text/xml', _soap_response(ns, operation, content))
+
+  # --- E-utilities ---
+
+  def _history_put(self, ids, webenv = None):
+    '''Stores the IDs on the history server under a new query key of the given WebEnv,
+    or of a new WebEnv. Returns the tuple (WebEnv, query key).'''
+    with self.lock:
+      if not webenv in self.history:
+        webenv = 'MCID_%d' % (len(self.history) + 1)
+        self.history[webenv] = []
+      self.history[webenv].append(ids)
+      return (webenv, len(self.history[webenv]))
+
+  def _ids_param(self, params):
+    '''Returns the list of PMIDs given by either the "id" or the "WebEnv" and "query_key" parameters.'''
+    if 'id' in params:
+      return [pmid.strip() for pmid in params['id'].split(',') if pmid.strip()]
+    with self.lock:
+      queries = self.history.get(params.get('WebEnv'), [])
+    query_key = int(params.get('query_key', 1))
+    ids = queries[query_key - 1] if 0 < query_key <= len(queries) else []
+    start = int(params.get('retstart', 0))
+    return ids[start:start + int(params.get('retmax', 20))]
+
+  def _articles_of_pmids(self, pmids):
+    return [self.graph.articles[self.graph.by_pmid[pmid]] for pmid in pmids if pmid in self.graph.by_pmid]
+
+  def _eutils(self, path, params):
+    graph = self.graph
+    name = path.rsplit('/', 1)[-1]
+    if name == 'esearch.fcgi':
+      pmids = [graph.articles[i]['pmid'] for i in graph.search_term(params.get('term', ''))]
+      if params.get('rettype') == 'count':
+        return (200, 'text/xml', '<?xml version="1.0"?>\n<eSearchResult><Count>%d</Count></eSearchResult>' % len(pmids))
+      start = int(params.get('retstart', 0))
+      page = pmids[start:start + int(params.get('retmax', 20))]
+      history = ''
+      if params.get('usehistory') == 'y':
+        (webenv, query_key) = self._history_put(pmids, params.get('WebEnv'))
+        history = '<QueryKey>%d</QueryKey><WebEnv>%s</WebEnv>' % (query_key, webenv)
+      return (200, 'text/xml', '<?xml version="1.0"?>\n<eSearchResult><Count>%d</Count><RetMax>%d</RetMax><RetStart>%d</RetStart>%s<IdList>%s</IdList></eSearchResult>'
+              % (len(pmids), len(page), start, history, ''.join('<Id>%s</Id>' % pmid for pmid in page)))
+    if name == 'epost.fcgi':
+      (webenv, query_key) = self._history_put(self._ids_param(params), params.get('WebEnv'))
+      return (200, 'text/xml', '<?xml version="1.0"?>\n<ePostResult><QueryKey>%d</QueryKey><WebEnv>%s</WebEnv></ePostResult>' % (query_key, webenv))
+    if name == 'efetch.fcgi':
+      if params.get('rettype') == 'uilist':
+        return (200, 'text/plain', ''.join('%s\n' % pmid for pmid in self._ids_param(params)))
+      return (200, 'text/xml', _pubmed_articles_xml(self._articles_of_pmids(self._ids_param(params))))
+    if name == 'esummary.fcgi':
+      return (200, 'text/xml', _esummary_xml(self._articles_of_pmids(self._ids_param(params))))
+    if name == 'ecitmatch.cgi':
+      lines = []
+      for line in re.split(r'%0D|\r|\n', params.get('bdata', '')):
+        pieces = line.split('|')
+        if len(pieces) < 6:
+          continue
+        (journal, year, volume, firstpage, author, key) = pieces[:6]
+        i = graph.citmatch(journal, year, volume, firstpage, author)
+        lines.append('|'.join([journal, year, volume, firstpage, author, key, graph.articles[i]['pmid'] if i != None else 'NOT_FOUND']))
+      return (200, 'text/plain', '\n'.join(lines) + '\n')
+    return (404, 'text/plain', 'Unknown E-utility: %s' % name)
+
+  # --- clinicaltrials.gov ---
+
+  def _clinicaltrials(self, params):
+    '''Returns a zip file with the XML of each clinical trial for the searched drug.'''
+    trials = self.graph.trials.get(params.get('term', '').lower(), [])
+    content = StringIO()
+    with zipfile.ZipFile(content, 'w') as archive:
+      for trial in trials:
+        archive.writestr(trial['nctid'] + '.xml', _clinical_trial_xml(self.graph, trial))
+    return (200, 'application/zip', content.getvalue())
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def _respond(self, method):
+    (path, _, query) = self.path.partition('?')
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else None
+    (status, content_type, content) = self.server.standin.handle(method, path, query, body, self.headers)
+    if isinstance(content, unicode):
+      content = content.encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', content_type + ('; charset=utf-8' if content_type.startswith('text') else ''))
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def do_GET(self):
+    self._respond('GET')
+
+  def do_POST(self):
+    self._respond('POST')
+
+  def log_message(self, format, *args):
+    if self.server.verbose:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+def serve(standin, host, port, verbose = False):
+  '''Serves the stand-in until interrupted, then prints its request statistics.'''
+  server = _Server((host, port), _Handler)
+  server.standin = standin
+  server.verbose = verbose
+  print 'Serving stand-in services at %s' % standin.base_url
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    print standin.stats_json()
+
+def _parse_service_values(values):
+  '''Parses values of the form "0.5" (applies to every service) or "wos=0.5" into a dictionary.'''
+  d = {}
+  for value in values or []:
+    (service, _, number) = value.rpartition('=')
+    d[service or '*'] = float(number)
+  return d
+
+def _graph_from_args(args):
+  return SyntheticGraph(args.articles, args.refs_per_article, args.authors, args.drugs, args.trials_per_drug, args.refs_per_trial, args.seed)
+
+def _write_input(args):
+  '''Writes a topdown.py input file for the first drug of the synthetic graph.'''
+  graph = _graph_from_args(args)
+  rand = random.Random(args.seed)
+  refs = rand.sample(range(len(graph.articles) / 2, len(graph.articles)), min(args.num_refs, len(graph.articles) / 2))
+  with open(args.output, 'w') as output_file:
+    output_file.write(args.drugs[0] + '\n')
+    for (n, i) in enumerate(refs):
+      if args.format == 'cse':
+        output_file.write('%d. %s\n' % (n + 1, graph.cse_citation(i)))
+      else:
+        output_file.write(graph.articles[i]['pmid'] + '\n')
+
+def _parse_args(raw_args):
+  p = argparse.ArgumentParser()
+  p.add_argument('--articles', type=int, default=2000)
+  p.add_argument('--refs-per-article', type=int, default=12)
+  p.add_argument('--authors', type=int, default=600)
+  p.add_argument('--drugs', nargs='+', default=['Ivacaftor'])
+  p.add_argument('--trials-per-drug', type=int, default=5)
+  p.add_argument('--refs-per-trial', type=int, default=10)
+  p.add_argument('--seed', type=int, default=1)
+  sp = p.add_subparsers(dest='command')
+
+  for (name, help_text) in [('serve', 'serve fixtures, falling back to the synthetic graph'), ('record', 'forward requests to the real services and save their responses as fixtures')]:
+    c = sp.add_parser(name, help=help_text)
+    c.add_argument('--host', default='localhost')
+    c.add_argument('--port', type=int, default=8080)
+    c.add_argument('--fixtures', required=(name == 'record'))
+    c.add_argument('--latency', nargs='*', help='seconds added to each call, e.g. 0.05 or wos=0.5')
+    c.add_argument('--error-rate', nargs='*', help='fraction of calls that fail, e.g. 0.01 or eutils=0.05')
+    c.add_argument('--rate-limit', nargs='*', help='calls per second before calls are rejected, e.g. eutils=3')
+    c.add_argument('--session-ttl', type=float, help='seconds before a WoS session ID expires')
+    c.add_argument('-v', dest='verbose', action='store_true')
+
+  c = sp.add_parser('input', help='write a topdown.py input file that refers to articles of the synthetic graph')
+  c.add_argument('--format', choices=['cse', 'pmid'], default='cse')
+  c.add_argument('--num-refs', type=int, default=20)
+  c.add_argument('output')
+  return p.parse_args(raw_args)
+
+if __name__ == '__main__':
+  args = _parse_args(sys.argv[1:])
+  if args.command == 'input':
+    _write_input(args)
+  else:
+    if args.fixtures and not os.path.isdir(args.fixtures):
+      os.makedirs(args.fixtures)
+    standin = StandIn(
+      _graph_from_args(args), 'http://%s:%d' % (args.host, args.port), args.fixtures, args.command == 'record',
+      _parse_service_values(args.latency), _parse_service_values(args.error_rate), _parse_service_values(args.rate_limit),
+      args.session_ttl, args.seed)
+    serve(standin, args.host, args.port, args.verbose)
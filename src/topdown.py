@@ -7,6 +7,7 @@ import refparse
 import clinicaltrials
 import pubmed
 import wos
+from crawler import Crawler
 
 class TopDown:
   def __init__(self, verbose):
@@ -20,6 +21,7 @@ class TopDown:
 
   def close(self):
     self.wos_client.close()
+    self.pm_client.close()
 
   def _first_author(self, ref):
     authors = ref.get('authors')
@@ -46,42 +48,27 @@ class TopDown:
       print '%4s: %5d, %6.2f%%' % (k, v, (100. * float(v) / self.counts['all']))
     print
 
-  def _add_wos_data(self, ref):
-    wos_refs = self.wos_client.search(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year'))
-    if len(wos_refs) == 1:
-      ref.update(wos_refs[0])
+  def _add_wos_data(self, refs):
+    refs = [ref for ref in refs if ref.get('title')]
+    searches = [(self._first_author(ref), ref.get('title'), ref.get('journal'), ref.get('year')) for ref in refs]
+    for (ref, wos_refs) in zip(refs, self.wos_client.search_many(searches)):
+      if len(wos_refs) == 1:
+        ref.update(wos_refs[0])
 
-  def _add_layer_of_refs(self, refs, parent_index, max_levels, level = 1):
-    # add level attribute
-    for ref in refs:
-      if ref.get('level') == None:
-        ref['level'] = level
+  def _biblio(self, refs):
+    '''Yields the tuple (index of the ref, cited article) for each of the given refs
+    containing a WoS ID, as the bibliographies arrive.'''
+    return self.wos_client.iter_biblio_many(refs)
 
-    # add pubmed data
-    self.pm_client.add_pubmed_data(refs)
-
-    # add wos data
-    for ref in refs:
-      if not ref.get('title'):
-        continue
-      self._add_wos_data(ref)
-
-    # update our counts about refs
-    for ref in refs:
-      self._update_ref_counts(ref)
+  def _crawl(self, roots, max_levels):
+    '''Adds the given list of (ref, parent node index) tuples and the levels
+    of refs below them to the network.'''
+    crawler = Crawler(self.net, self.pm_client, self._add_wos_data, self._biblio, self._update_ref_counts)
+    crawler.crawl(roots, max_levels)
 
     if self.verbose:
       print self.counts['all'], 'articles'
 
-    # add each ref to the graph
-    for ref in refs:
-      ref_index = self.net.add_ref(ref, parent_index)
-
-      # add the next level if needed and if we have a WoS ID for ref
-      if 'wosid' in ref and level < max_levels:
-        child_refs = self.wos_client.biblio(ref)
-        self._add_layer_of_refs(child_refs, ref_index, max_levels, level + 1)
-
   def run(self, input_file_path, input_format, levels, search_trials, perform_layout, output_file_path):
     input_file = codecs.open(input_file_path, 'r')
     input_lines = input_file.readlines()
@@ -94,29 +81,32 @@ class TopDown:
 
     drug_index = self.net.add_v(type='drug', label=drug_name)
 
+    roots = []
     if search_trials:
       trials = self.ct_client.search(drug_name)
 
       for trial in trials:
         trial_index = self.net.add_v(type='clinicaltrial', title=trial['title'], label=trial['nctid'])
-        self.net.g.add_edge(drug_index, trial_index)
+        self.net.add_e(drug_index, trial_index)
 
-        refs = trial['biblio']
-        if refs:
-          self._add_layer_of_refs(refs, trial_index, levels)
+        roots.extend((ref, trial_index) for ref in trial['biblio'])
 
     if input_format == 'cse':
       fda_index = self.net.add_v(type='clinicaltrial', label='FDA')
-      self.net.g.add_edge(drug_index, fda_index)
+      self.net.add_e(drug_index, fda_index)
       fda_refs = refparse.parse_cse_refs(input_lines[1:])
-      self._add_layer_of_refs(fda_refs, fda_index, levels)
+      roots.extend((ref, fda_index) for ref in fda_refs)
     elif input_format == 'pmid':
       refs = [{'pmid': pmid.strip()} for pmid in input_lines[1:]]
-      self._add_layer_of_refs(refs, drug_index, levels)
+      roots.extend((ref, drug_index) for ref in refs)
+
+    self._crawl(roots, levels)
 
     if self.verbose:
       self._print_counts()
       print self.net.ref_counts
+      print 'WoS cache:', self.wos_client.cache.counts
+      print 'WoS retries:', self.wos_client.retry_policy.counts
 
     if self.verbose:
       print 'Postprocessing...',
@@ -1,9 +1,31 @@
-def xpath_str(doc, path, ns = None):
-  result = doc.xpath(path, namespaces=ns)
+import re
+import lxml.etree
+
+# compiled XPath expressions by (expression, namespace prefixes), shared by all parsers
+_xpaths = {}
+
+def compiled_xpath(path, ns = None):
+  '''Returns the expression path compiled into an lxml.etree.XPath object that resolves
+  the prefixes in the dictionary ns, e.g. {'ns': uri} for the WoS "ns:" prefix. Each
+  expression is compiled the first time it's used and then reused, instead of being
+  parsed again on every call like doc.xpath(path) does. Use XPath variables, like
+  "name[@seq_no=$seq_no]", rather than formatting values into the expression.'''
+  key = (path, tuple(sorted(ns.iteritems())) if ns else None)
+  xpath = _xpaths.get(key)
+  if xpath == None:
+    xpath = lxml.etree.XPath(path, namespaces=ns)
+    _xpaths[key] = xpath
+  return xpath
+
+def xpath_nodes(doc, path, ns = None, **variables):
+  return compiled_xpath(path, ns)(doc, **variables)
+
+def xpath_str(doc, path, ns = None, **variables):
+  result = compiled_xpath(path, ns)(doc, **variables)
   return unicode(result[0]) if result else None
 
-def xpath_strs(doc, path, ns = None):
-  results = doc.xpath(path, namespaces=ns)
+def xpath_strs(doc, path, ns = None, **variables):
+  results = compiled_xpath(path, ns)(doc, **variables)
   return map(unicode, results)
 
 def has_keys(d, *keys):
@@ -11,3 +33,16 @@ def has_keys(d, *keys):
     if not key in d:
       return False
   return True
+
+_non_alphanum_space_re = re.compile(r'[\W_]+', re.UNICODE)
+
+def normalize_title(title):
+  '''Lowercases the title and replaces all runs of punctuation and whitespace with
+  a single space, so that titles from different sources can be compared.'''
+  return _non_alphanum_space_re.sub(u' ', title.lower()).strip()
+
+def author_last_name(author):
+  '''Returns the lowercased last name of an author written as "Smith JA" or "Smith, JA"
+  without any punctuation or whitespace.'''
+  last_name = author.split(',')[0] if ',' in author else author.strip().rsplit(' ', 1)[0]
+  return _non_alphanum_space_re.sub(u'', last_name.lower())
@@ -2,23 +2,111 @@
 # coding=utf-8
 
 import re
-import exceptions
 import time
+import json
 import suds
+import suds.cache
+import suds.transport
 import lxml.etree
-import os.path
-import sqlite3
-import cPickle as pickle
+from io import BytesIO
+import os
 import datetime
 import string
-from util import xpath_str, xpath_strs
+import sys
+import threading
+import Queue
+import collections
+import socket
+import httplib
+import urllib2
+from multiprocessing.pool import ThreadPool
+from util import normalize_title, author_last_name
+import ratelimit
+import retry
+import sqlcache
 
 _date_re = re.compile(r'(?P<yr>\d{4})-(?P<mon>\d{2})-(?P<day>\d{2})')
 _non_alphanum_re = re.compile(r'[^\w\s]+')
+_wos_tag_names = [
+  'UID', 'static_data', 'summary', 'pub_info', 'titles', 'title', 'names', 'name', 'wos_standard',
+  'fullrecord_metadata', 'addresses', 'address_name', 'address_spec', 'full_address', 'organizations', 'organization',
+  'dynamic_data', 'citation_related', 'tc_list', 'silo_tc']
+_wos_tags_by_ns = {}
+
+def _wos_tags(ns_uri):
+  '''Returns a dictionary that maps each WoS tag name to its qualified name in the given namespace.'''
+  tags = _wos_tags_by_ns.get(ns_uri)
+  if tags == None:
+    tags = dict((name, '{%s}%s' % (ns_uri, name)) for name in _wos_tag_names)
+    _wos_tags_by_ns[ns_uri] = tags
+  return tags
+
+def _child_text(elem, tag):
+  '''Returns the text of the first child of elem with the given tag that has text, or None.'''
+  for child in elem.iterchildren(tag):
+    if child.text != None:
+      return unicode(child.text)
+  return None
+
+def _convert_wos_summary(summary, t, r):
+  '''Adds the title, journal, issue, volume, pubdate, and authors in the "summary" tag to r.'''
+  authors_by_seq_no = {}
+  num_authors = None
+  for part in summary:
+    if part.tag == t['titles']:
+      for title_tag in part.iterchildren(t['title']):
+        key = {'item': 'title', 'source': 'journal'}.get(title_tag.get('type'))
+        if key and r[key] == None and title_tag.text != None:
+          r[key] = unicode(title_tag.text)
+    elif part.tag == t['pub_info']:
+      (r['issue'], r['volume'], pubdate) = (part.get('issue'), part.get('vol'), part.get('sortdate'))
+      if pubdate:
+        m = _date_re.match(pubdate)
+        r['pubdate'] = int(m.group('yr') + m.group('mon') + m.group('day'))
+    elif part.tag == t['names']:
+      if num_authors == None:
+        num_authors = int(part.get('count'))
+      for author_tag in part.iterchildren(t['name']):
+        authors_by_seq_no.setdefault(author_tag.get('seq_no'), author_tag)
+
+  for i in range(1, (num_authors or 0) + 1):
+    author_tag = authors_by_seq_no.get(str(i))
+    if author_tag == None: continue
+    author_name = _child_text(author_tag, t['wos_standard'])
+    if author_name == None: continue
+    addr_no = author_tag.get('addr_no')
+    affiliation_indices = map(int, addr_no.split(' ')) if addr_no != None else None
+
+    r['authors'].append((author_name, affiliation_indices))
+
+def _convert_wos_addresses(metadata, t, r):
+  '''Adds the institutions in the "fullrecord_metadata" tag to r.'''
+  for addresses in metadata.iterchildren(t['addresses']):
+    for address_name in addresses.iterchildren(t['address_name']):
+      for institution_tag in address_name.iterchildren(t['address_spec']):
+        index = int(institution_tag.get('addr_no'))
+        address = _child_text(institution_tag, t['full_address'])
+        organizations = [unicode(organization.text)
+                         for organizations_tag in institution_tag.iterchildren(t['organizations'])
+                         for organization in organizations_tag.iterchildren(t['organization'])
+                         if organization.text != None]
+
+        r['institutions'][index] = (address, organizations)
+
+def _convert_wos_citcount(dynamic_data, t, r):
+  '''Adds the WoS citation count in the "dynamic_data" tag to r.'''
+  for citation_related in dynamic_data.iterchildren(t['citation_related']):
+    for tc_list in citation_related.iterchildren(t['tc_list']):
+      for silo_tc in tc_list.iterchildren(t['silo_tc']):
+        if silo_tc.get('coll_id') == 'WOS' and silo_tc.get('local_count') != None:
+          r['citcount'] = int(silo_tc.get('local_count'))
+          return
+
 def _convert_wos_record(record, ns):
   """
   Takes an XML tree of a single WoS record and returns a dictionary
-  representing the record's information.
+  representing the record's information. The record is walked
+  once instead of being queried with a separate XPath for each field.
 
   Args:
     record: An XML tree, where the root is the 'REC' tag
@@ -37,42 +125,33 @@ def _convert_wos_record(record, ns):
       authors:      [(unicode, [int])]
       citcount:     int
   """
-
-  r = dict()
-  r['wosid'] = xpath_str(record, "ns:UID/text()", ns)
-  r['title'] = xpath_str(record, "ns:static_data/ns:summary/ns:titles/ns:title[@type='item']/text()",ns)
-  r['journal'] = xpath_str(record, "ns:static_data/ns:summary/ns:titles/ns:title[@type='source']/text()", ns)
-  pubinfo = record.xpath("ns:static_data/ns:summary/ns:pub_info", namespaces=ns)[0]
-  (r['issue'], r['volume'], pubdate) = (pubinfo.attrib.get('issue'), pubinfo.attrib.get('vol'), pubinfo.attrib.get('sortdate'))
-  if pubdate:
-    m = _date_re.match(pubdate)
-    r['pubdate'] = int(m.group('yr') + m.group('mon') + m.group('day'))
-
-  r['institutions'] = {}
-  num_institutions = int(record.xpath("ns:static_data/ns:fullrecord_metadata/ns:addresses", namespaces=ns)[0].attrib['count'])
-  for institution_tag in record.xpath("ns:static_data/ns:fullrecord_metadata/ns:addresses/ns:address_name/ns:address_spec", namespaces=ns):
-    index = int(institution_tag.attrib['addr_no'])
-    address = xpath_str(institution_tag, "ns:full_address/text()", ns)
-    organizations = xpath_strs(institution_tag, "ns:organizations/ns:organization/text()", ns)
-
-    r['institutions'][index] = (address, organizations)
-
-  r['authors'] = []
-  num_authors = int(record.xpath("ns:static_data/ns:summary/ns:names", namespaces=ns)[0].attrib['count'])
-  for i in range(1, num_authors + 1):
-    author_tag = record.xpath("ns:static_data/ns:summary/ns:names/ns:name[@seq_no='%d']" % i, namespaces=ns)[0]
-    author_name = xpath_str(author_tag, "ns:wos_standard/text()", ns)
-    if author_name == None: continue
-    affiliation_indices = map(int, author_tag.attrib['addr_no'].split(' ')) if 'addr_no' in author_tag.attrib else None
-
-    r['authors'].append((author_name, affiliation_indices))
-
-  cittag = record.xpath("ns:dynamic_data/ns:citation_related/ns:tc_list/ns:silo_tc[@coll_id='WOS']/@local_count", namespaces=ns)
-  if cittag:
-    r['citcount'] = int(cittag[0])
-
+  t = _wos_tags(ns['ns'])
+  r = {'wosid': None, 'title': None, 'journal': None, 'issue': None, 'volume': None, 'institutions': {}, 'authors': []}
+  for section in record:
+    if section.tag == t['UID']:
+      if r['wosid'] == None and section.text != None:
+        r['wosid'] = unicode(section.text)
+    elif section.tag == t['static_data']:
+      for part in section:
+        if part.tag == t['summary']:
+          _convert_wos_summary(part, t, r)
+        elif part.tag == t['fullrecord_metadata']:
+          _convert_wos_addresses(part, t, r)
+    elif section.tag == t['dynamic_data']:
+      _convert_wos_citcount(section, t, r)
   return r
 
+def _iter_page_records(records_xml):
+  '''Takes the "records" XML of a page of WoS results and yields each REC tag converted
+  by _convert_wos_record. Each REC tag is freed once it is converted.'''
+  if isinstance(records_xml, unicode):
+    records_xml = records_xml.encode('utf-8')
+  for (_, record) in lxml.etree.iterparse(BytesIO(records_xml), events=('end',), tag='{*}REC'):
+    yield _convert_wos_record(record, {'ns': record.nsmap[None]})
+    record.clear()
+    while record.getprevious() is not None:
+      del record.getparent()[0]
+
 def _convert_wos_biblio_record(record):
   '''Takes a WoS bibliography record and returns a ref dictionary:
   {
@@ -101,135 +180,323 @@ def _convert_wos_biblio_record(record):
   return r
 
 _cache_path = '.wos-cache.sqlite'
+# set WOS_BASE_URL to point the client at another server, e.g. standin.py
+_base_url = os.environ.get('WOS_BASE_URL', 'http://search.webofknowledge.com')
+_rate_path = '.wos-rate.sqlite'
+_wsdl_cache_path = '.wos-wsdl-cache'
+_wsdl_cache_days = 30
+_session_path = '.wos-session.json'
+# WoS sessions expire two hours after they start, so shared sessions are only reused for a bit less
+_session_max_age = 90 * 60.0
+_result_timeout = 7 * 24 * 60 * 60.0
 _wos_title_bad_chars_re = re.compile(ur'[“”\"\'\(\)\[\]\?\*\!\<\>\=\$\-\.]')
 
+# limits on how many title/author searches are ORed together into a single WoS query
+_max_batch_clauses = 10
+_max_batch_query_len = 4000
+
+def _is_abbrev_of(abbrev_word, word):
+  '''Returns true if abbrev_word, e.g. "natl", abbreviates word, e.g. "national": both start
+  with the same letter, and the letters of abbrev_word appear in word in the same order.'''
+  if not word.startswith(abbrev_word[:1]):
+    return False
+  letters = iter(word)
+  return all(letter in letters for letter in abbrev_word)
+
+def _journal_matches(journal, record_journal):
+  '''Returns true if the journal of a search, which is usually abbreviated like
+  "Proc Natl Acad Sci U S A", names the journal of a WoS record, which is usually
+  written out. Each word of the journal must abbreviate a later word of the record's
+  journal than the previous one.'''
+  record_words = iter(normalize_title(record_journal).split())
+  return all(any(_is_abbrev_of(word, record_word) for record_word in record_words)
+             for word in normalize_title(journal).split())
+
+def _record_matches(record, title, author, journal, year):
+  '''Returns true if the converted WoS record could have been found by searching
+  for the given title, first author, journal, and year.'''
+  record_title = record.get('title')
+  if not record_title or not normalize_title(title) in normalize_title(record_title):
+    return False
+  if author:
+    if not record['authors'] or author_last_name(record['authors'][0][0]) != author_last_name(author):
+      return False
+  if journal and not (record.get('journal') and _journal_matches(journal, record['journal'])):
+    return False
+  if year and record.get('pubdate'):
+    if str(record['pubdate'] / 10000) != str(year):
+      return False
+  return True
+
+# SOAP faults are classified by their message, since the service puts all of them under
+# soap:Server. The patterns only match the service's throttle and outage messages, such as
+# "Request denied by Throttle server" and "Internal server error", and not permanent faults
+# that happen to mention a limit, such as "Query exceeds maximum length limit".
+_session_fault_re = re.compile(r'session|\bSID\b|authenticat', re.IGNORECASE)
+_throttle_fault_re = re.compile(r'throttle|too many (requests|calls)|(rate|request|call) limit (exceeded|reached)', re.IGNORECASE)
+_transient_fault_re = re.compile(r'(service|server) (is )?(temporarily )?unavailable|timed? ?out|server (is )?busy|internal (server )?error|try again later', re.IGNORECASE)
+
+def _classify_http_status(status):
+  if status == 429:
+    return retry.THROTTLE
+  if status in (401, 403):
+    return retry.SESSION
+  if status >= 500:
+    return retry.TRANSIENT
+  return retry.PERMANENT
+
+def _classify_error(e):
+  '''Tells the retry policy how to handle an exception raised by a WoS query.
+  SOAP faults are classified by their message. suds raises other HTTP errors
+  as Exception((status, reason)).'''
+  if isinstance(e, suds.WebFault):
+    message = unicode(getattr(e.fault, 'faultstring', None) or e)
+    if _session_fault_re.search(message):
+      return retry.SESSION
+    if _throttle_fault_re.search(message):
+      return retry.THROTTLE
+    if _transient_fault_re.search(message):
+      return retry.TRANSIENT
+    return retry.PERMANENT
+  if isinstance(e, suds.transport.TransportError):
+    return _classify_http_status(e.httpcode)
+  if isinstance(e, urllib2.HTTPError):
+    return _classify_http_status(e.code)
+  if isinstance(e, (socket.error, urllib2.URLError, httplib.HTTPException)):
+    return retry.TRANSIENT
+  if type(e) == Exception and len(e.args) == 1 and isinstance(e.args[0], tuple) and e.args[0] and isinstance(e.args[0][0], int):
+    return _classify_http_status(e.args[0][0])
+  return retry.PERMANENT
+
+class _Prefetch:
+  '''Iterates over the items of the given iterable, which are computed on a background thread
+  so that the next item is already being computed while the caller uses the current one.
+  The thread starts right away, so the first item is computed before it's asked for.
+  close stops the thread, e.g. when the items aren't needed after all.'''
+
+  def __init__(self, iterable):
+    self.items = Queue.Queue(maxsize=1)
+    self.stopped = threading.Event()
+    producer = threading.Thread(target=self._produce, args=(iterable,))
+    producer.daemon = True
+    producer.start()
+
+  def _put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.items.put(item, timeout=1.0)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def _produce(self, iterable):
+    try:
+      for item in iterable:
+        if not self._put(('item', item)):
+          return
+      self._put(('done', None))
+    except BaseException:
+      self._put(('error', sys.exc_info()))
+
+  def __iter__(self):
+    try:
+      while True:
+        # get() is given a timeout so that the wait can be interrupted with Ctrl-C
+        (kind, value) = self.items.get(timeout=_result_timeout)
+        if kind == 'item':
+          yield value
+        elif kind == 'error':
+          raise value[0], value[1], value[2]
+        else:
+          return
+    finally:
+      self.stopped.set()
+
+  def close(self):
+    self.stopped.set()
+
+def gather(futures):
+  '''Waits for each of the given futures returned by the Client.submit_* methods
+  and returns a list of their results.'''
+  # get() is given a timeout so that the wait can be interrupted with Ctrl-C
+  return [future.get(_result_timeout) for future in futures]
+
 class Client:
-  def __init__(self):
-    self.retry_count = 0
-    self._sign_in()
-    self.cachedb = sqlite3.connect(_cache_path)
-    self.cachecur = self.cachedb.cursor()
-    self.cachecur.execute('create table if not exists cache(ckey text, cval blob)')
-
-  def _sign_in(self):
-    self.authclient = suds.client.Client('http://search.webofknowledge.com/esti/wokmws/ws/WOKMWSAuthenticate?wsdl')
-    session = self.authclient.service.authenticate()
-    header = {'Cookie': ('SID="%s"' % session)}
-    self.searchclient = suds.client.Client('http://search.webofknowledge.com/esti/wokmws/ws/WokSearch?wsdl')
-    self.searchclient.set_options(headers=header)
-
-    self.last_query_time = datetime.datetime.now()
+  def __init__(self, workers = 4, rate = 1.0, burst = 1, cache_ttl = None, cache_max_bytes = None, base_url = None, share_session = True):
+    '''Args:
+      workers: the number of threads that run queries submitted with the submit_* methods
+      rate: the number of queries per second allowed across all processes sharing the rate limiter
+      burst: the number of queries that can be made at once after being idle
+      cache_ttl: if given, cached responses older than this many seconds are queried again
+      cache_max_bytes: if given, the least recently used cached responses are evicted beyond this size
+      base_url: the WoS web service to use instead of the one given by WOS_BASE_URL
+      share_session: if true, the session ID is saved so that other processes can reuse it, and
+        a recent enough session saved by another process is reused instead of signing in.
+        Shared sessions are left to expire instead of being closed.
+
+    The client only signs in when the first query that isn't cached is made,
+    so runs whose queries are all cached never contact WoS.
+    '''
+    self.base_url = base_url or _base_url
+    self.share_session = share_session
+    self.retry_policy = retry.RetryPolicy(_classify_error)
+    self.workers = workers
+    self.pool = None
+    self.limiter = ratelimit.TokenBucket(rate, burst, _rate_path, 'wos')
+
+    self.local = threading.local()
+    self.authclient = None
+    self.searchclient = None
+    self.sid = None
+    self.session_gen = 0
+    self.auth_lock = threading.RLock()
+    self.wsdl_cache = suds.cache.ObjectCache(location=os.path.abspath(_wsdl_cache_path), days=_wsdl_cache_days)
+
+    self.cache = sqlcache.Cache(_cache_path, cache_ttl, cache_max_bytes)
+
+  def _suds_client(self, service):
+    '''Creates a suds client for the given WoS service. The parsed WSDL is kept
+    in the local WSDL cache, so it is only downloaded once every few weeks.'''
+    url = self.base_url + '/esti/wokmws/ws/' + service
+    return suds.client.Client(url + '?wsdl', location=url, cache=self.wsdl_cache)
+
+  def _load_shared_session(self):
+    '''Returns the session ID saved by this or another process if it is recent enough, otherwise None.'''
+    try:
+      with open(_session_path) as session_file:
+        saved = json.load(session_file)
+    except (IOError, ValueError):
+      return None
+    if saved.get('base_url') != self.base_url or time.time() - saved.get('created', 0.0) > _session_max_age:
+      return None
+    return saved.get('sid')
+
+  def _save_shared_session(self, sid):
+    # written to a temporary file first so that other processes never read a partial file
+    tmp_path = '%s.%d' % (_session_path, os.getpid())
+    with open(tmp_path, 'w') as session_file:
+      json.dump({'sid': sid, 'created': time.time(), 'base_url': self.base_url}, session_file)
+    os.rename(tmp_path, _session_path)
+
+  def _sign_in(self, stale_sid = None):
+    '''Starts a session. When sharing sessions, a saved session is reused
+    unless it is stale_sid, the session that just failed.'''
+    with self.auth_lock:
+      sid = self._load_shared_session() if self.share_session else None
+      if not sid or sid == stale_sid:
+        if not self.authclient:
+          self.authclient = self._suds_client('WOKMWSAuthenticate')
+        sid = self.authclient.service.authenticate()
+        if self.share_session:
+          self._save_shared_session(sid)
+      if not self.searchclient:
+        self.searchclient = self._suds_client('WokSearch')
+      self.searchclient.set_options(headers={'Cookie': ('SID="%s"' % sid)})
+      self.sid = sid
+      self.session_gen += 1
+
+  def _search_client(self):
+    '''Returns the calling thread's copy of the search client, signing in first
+    if needed. suds clients can't be shared across threads, so each thread gets
+    its own clone.'''
+    with self.auth_lock:
+      if not self.sid:
+        self.retry_policy.call(self._sign_in)
+      if getattr(self.local, 'session_gen', None) != self.session_gen:
+        self.local.searchclient = self.searchclient.clone()
+        self.local.session_gen = self.session_gen
+      return self.local.searchclient
 
   def _sign_out(self):
+    '''Closes the session this client started. Shared sessions are left open for other processes.'''
+    if not self.sid or self.share_session or not self.authclient:
+      return
     try:
       self.authclient.service.closeSession()
     except suds.WebFault:
       pass
 
   def close(self):
-    self._flush_cache()
+    if self.pool:
+      self.pool.close()
+      self.pool.join()
+    self.cache.close()
     self._sign_out()
+    self.limiter.close()
     
-  def _flush_cache(self):
-    self.cachecur.close()
-    self.cachedb.commit()
-    self.cachedb.close()
-
-  def _call_query_and_retry(self, query_func):
-    '''Calls the given query function. If an exception is thrown,
-    this will try to sign in and out of WoS then retry the query
-    up to 3 times.'''
-    try:
-      result = query_func()
-      self.retry_count = 0
-      return result
-    except exceptions.BaseException as e:
-      if self.retry_count < 3:
-        self.retry_count += 1
-        print 'Query failed. Attempt', self.retry_count
-        time.sleep(10.0)
+  def _reauth(self, session_gen):
+    '''Signs in again after a session error, unless another thread
+    already did so since the failed query was made.'''
+    with self.auth_lock:
+      if self.session_gen == session_gen:
         self._sign_out()
-        time.sleep(300.0)
-        self._sign_in()
-        time.sleep(10.0)
-        return self._call_query_and_retry(query_func)
-      else:
-        raise e
+        self._sign_in(self.sid)
 
   def _throttled_query(self, query_func):
-    '''Guarantees that query functions are only
-    called once a second.'''
-    time_now = datetime.datetime.now()
-    delta_sec = (time_now - self.last_query_time).total_seconds()
-    if delta_sec < 1.0:
-      time.sleep(1.0 - delta_sec)
-    self.last_query_time = datetime.datetime.now()
-    return self._call_query_and_retry(query_func)
-
-  def _paged_query(self, query_func, max_pages = None, records_per_page = 100):
-    '''Because WoS queries are paginated, this will return all the results of
-    a given query function. This will create a "retrieveParameters" WoS object
-    and fill it in, then call the given query function with the "retrieveParameters".
+    '''Calls the query function, waiting for the rate limiter, which is shared by
+    all threads and processes, before each attempt. Failed queries are retried with
+    a backoff, and the client signs in again only if the session expired.'''
+    def before_attempt():
+      self._search_client() # signs in if this is the first query
+      self.limiter.acquire()
+      return self.session_gen
+    return self.retry_policy.call(query_func, before_attempt, self._reauth)
+
+  def _retrieve_parameters(self, first_record, count):
+    rp = self._search_client().factory.create('retrieveParameters')
+    rp.firstRecord = first_record
+    rp.count = count
+    return rp
+
+  def _iter_pages(self, query_func, max_pages = None, records_per_page = 100):
+    '''Because WoS queries are paginated, this will yield each page of results of
+    a given query function as it arrives. This will create a "retrieveParameters" WoS object
+    for each page and call the given query function with it.
     '''
-    rp = self.searchclient.factory.create('retrieveParameters')
-    rp.firstRecord = 1
-    rp.count = records_per_page
-
-    results = []
+    rp = self._retrieve_parameters(1, records_per_page)
     first_page = self._throttled_query(lambda: query_func(rp))
-    results.append(first_page)
+    yield first_page
 
-    num_possible_pages = (first_page.recordsFound / (records_per_page + 1)) + 1
+    num_possible_pages = max((first_page.recordsFound + records_per_page - 1) / records_per_page, 1)
     effective_num_pages = min(num_possible_pages, max_pages) if max_pages else num_possible_pages
-    for i in range(effective_num_pages - 1):
-      rp.firstRecord += records_per_page
-      page = self._throttled_query(lambda: query_func(rp))
-      results.append(page)
-
-    return results
-
-  def _cache_key_exists(self, cache_key):
-    result, = self.cachecur.execute('select exists(select 1 from cache where ckey = ? limit 1)', [cache_key]).fetchone()
-    return result != 0
-
-  def _cache_get_value(self, cache_key):
-    result = self.cachecur.execute('select cval from cache where ckey = ?', [cache_key]).fetchone()
-    if not result:
-      return None
-    return pickle.loads(str(result[0]))
+    for i in range(1, effective_num_pages):
+      rp = self._retrieve_parameters(1 + i * records_per_page, records_per_page)
+      yield self._throttled_query(lambda: query_func(rp))
 
-  def _cache_add_value(self, cache_key, cache_value):
-    cache_value_bin = sqlite3.Binary(pickle.dumps(cache_value, pickle.HIGHEST_PROTOCOL))
-    self.cachecur.execute('insert into cache values(?, ?)', [unicode(cache_key), cache_value_bin])
+  def _paged_query(self, query_func, max_pages = None, records_per_page = 100):
+    '''Returns a list of all the pages of results of a given query function.'''
+    return list(self._iter_pages(query_func, max_pages, records_per_page))
 
   def _cache(func):
     '''Takes a single-parameter function and caches its result.'''
     def inner(self, arg):
       cache_key = func.__name__ + ':' + arg
-      if self._cache_key_exists(cache_key):
-        return self._cache_get_value(cache_key)
-      #print cache_key
+      (found, result) = self.cache.get(cache_key)
+      if found:
+        return result
       result = func(self, arg)
-      self._cache_add_value(cache_key, result)
+      self.cache.put(cache_key, result)
       return result
     return inner
 
   @_cache
   def _search(self, userQuery):
-    qp = self.searchclient.factory.create('queryParameters')
+    qp = self._search_client().factory.create('queryParameters')
     qp.databaseId = 'WOS'
     qp.userQuery = userQuery
     qp.queryLanguage = 'en'
 
-    query_func = lambda rp: self.searchclient.service.search(qp, rp)
+    query_func = lambda rp: self._search_client().service.search(qp, rp)
     pages = self._paged_query(query_func, 1)
+    return self._convert_pages(pages)
 
-    record = pages[0].records
-    doc = lxml.etree.fromstring(record)
-    ns = {'ns': doc.nsmap[None]}
+  def _convert_pages(self, pages):
+    '''Converts the records in each of the given pages of a paged query.'''
     results = []
-    for record in doc.xpath('/ns:records/ns:REC', namespaces=ns):
-      results.append(_convert_wos_record(record, ns))
+    for page in pages:
+      if not getattr(page, 'records', None): continue
+      results.extend(_iter_page_records(page.records))
     return results
 
   def _fix_title_pir(self, title):
@@ -261,8 +528,8 @@ class Client:
     else:
       return author
 
-  def search(self, author, title, journal=None, year=None):
-    '''Searches for an article in WoS with the given author and title.'''
+  def _search_query(self, author, title, journal=None, year=None):
+    '''Returns the WoS userQuery that searches for the given author and title.'''
     title_fixed = self._fix_title(title)
     author_fixed = self._fix_author(author)
     userQuery = 'TI=(%s) AND AU=(%s)' % (title_fixed, author_fixed)
@@ -270,51 +537,223 @@ class Client:
       userQuery += ' AND SO=(%s)' % journal
     if year:
       userQuery += ' AND PY=(%s)' % year
+    return userQuery
 
+  def search(self, author, title, journal=None, year=None):
+    '''Searches for an article in WoS with the given author and title.'''
+    userQuery = self._search_query(author, title, journal, year)
     results = self._search(userQuery)
     return results
 
-  @_cache
-  def _biblio(self, wosid):
-    query_func = lambda rp: self.searchclient.service.citedReferences('WOS', wosid, 'en', rp)
-    pages = self._paged_query(query_func)
-    results = []
-    for page in pages:
-      if not hasattr(page, 'references'): continue
-      for record in page.references:
-        results.append(_convert_wos_biblio_record(record))
+  def _search_batch(self, searches):
+    '''Searches for many articles with a single WoS query. searches is a list of
+    (author, title, journal, year) tuples. The records found are matched back to each
+    search by title, first author, journal, and year. Returns a list of results for each
+    search. If WoS rejects the query, or it finds more records than fit into a page per
+    search, each search is run on its own with search instead, and its records are
+    matched the same way.'''
+    userQuery = ' OR '.join('(%s)' % self._search_query(*search) for search in searches)
+
+    qp = self._search_client().factory.create('queryParameters')
+    qp.databaseId = 'WOS'
+    qp.userQuery = userQuery
+    qp.queryLanguage = 'en'
+
+    query_func = lambda rp: self._search_client().service.search(qp, rp)
+    try:
+      pages = self._paged_query(query_func, len(searches))
+    except Exception as e:
+      if _classify_error(e) != retry.PERMANENT:
+        raise
+      pages = None
+    if pages != None:
+      records = self._convert_pages(pages)
+    if pages == None or len(records) < pages[0].recordsFound:
+      # the query failed, or the records of some searches may not have been read
+      records_by_search = [self.search(*search) for search in searches]
+    else:
+      records_by_search = [records] * len(searches)
+    return [[record for record in search_records if _record_matches(record, title, author, journal, year)]
+            for ((author, title, journal, year), search_records) in zip(searches, records_by_search)]
+
+  def _batch_searches(self, searches):
+    '''Splits the list of (author, title, journal, year) tuples into batches
+    that each fit into a single WoS query.'''
+    batches = []
+    batch = []
+    batch_len = 0
+    for search in searches:
+      clause_len = len(self._search_query(*search)) + len(' OR ()')
+      if batch and (len(batch) >= _max_batch_clauses or batch_len + clause_len > _max_batch_query_len):
+        batches.append(batch)
+        batch = []
+        batch_len = 0
+      batch.append(search)
+      batch_len += clause_len
+    if batch:
+      batches.append(batch)
+    return batches
+
+  def search_many(self, searches):
+    '''Like search, but takes a list of (author, title, journal, year) tuples and returns a list
+    of the results for each. Searches that aren't in the cache are ORed together into
+    a few large WoS queries, which are run on the worker threads. Unlike search, only the
+    records whose first author, title, journal, and year match are returned, and they are
+    cached separately from the results of search.'''
+    results = [None] * len(searches)
+    misses = {}
+    for (i, search) in enumerate(searches):
+      (author, title, journal, year) = search
+      if not normalize_title(title):
+        results[i] = []
+        continue
+      cache_key = '_search_many:' + self._search_query(*search)
+      (found, results[i]) = self.cache.get(cache_key)
+      if found:
+        continue
+      misses.setdefault(cache_key, []).append(i)
+
+    if not misses:
+      return results
+
+    miss_keys = misses.keys()
+    batches = self._batch_searches([searches[misses[cache_key][0]] for cache_key in miss_keys])
+    batch_results = gather([self._submit(self._search_batch, batch) for batch in batches])
+
+    for (cache_key, result) in zip(miss_keys, [result for batch_result in batch_results for result in batch_result]):
+      self.cache.put(cache_key, result)
+      for i in misses[cache_key]:
+        results[i] = result
     return results
 
+  def _iter_cached_pages(self, cache_key, fetch_pages):
+    '''Yields the pages of results cached under cache_key. If they aren't cached, the pages
+    yielded by fetch_pages(), each a list of results, are yielded instead, and each page is
+    cached under its own key as it arrives. cache_key itself only gets the number of pages
+    once all of them are cached, so a stream that stopped early isn't taken for a whole one.'''
+    (found, num_pages) = self.cache.get(cache_key)
+    # the number of results already yielded from the cache, in case a page was evicted
+    skip = 0
+    if found:
+      # entries cached before results were cached by page hold the whole list
+      if isinstance(num_pages, list):
+        yield num_pages
+        return
+      for i in range(num_pages):
+        (found, page) = self.cache.get('%s#%d' % (cache_key, i))
+        if not found:
+          break
+        yield page
+        skip += len(page)
+      else:
+        return
+
+    num_pages = 0
+    for page in fetch_pages():
+      self.cache.put('%s#%d' % (cache_key, num_pages), page)
+      num_pages += 1
+      if len(page) > skip:
+        yield page[skip:]
+      skip = max(0, skip - len(page))
+    self.cache.put(cache_key, num_pages)
+
+  def _iter_many(self, iter_pages, wosrefs):
+    '''Yields the tuple (index of the wosref, result) for each result in the pages yielded
+    by iter_pages(wosid) for each of the given wosrefs, in order. While the results of one
+    wosref are consumed, those of the next ones, up to one per worker, are fetched in the
+    background.'''
+    streams = collections.deque()
+    next_index = 0
+    try:
+      while streams or next_index < len(wosrefs):
+        while next_index < len(wosrefs) and len(streams) < self.workers:
+          streams.append((next_index, _Prefetch(iter_pages(wosrefs[next_index]['wosid']))))
+          next_index += 1
+        (i, stream) = streams.popleft()
+        for page in stream:
+          for result in page:
+            yield (i, result)
+    finally:
+      for (i, stream) in streams:
+        stream.close()
+
+  def _fetch_biblio_pages(self, wosid):
+    query_func = lambda rp: self._search_client().service.citedReferences('WOS', wosid, 'en', rp)
+    for page in _Prefetch(self._iter_pages(query_func)):
+      if not hasattr(page, 'references'): continue
+      yield [_convert_wos_biblio_record(record) for record in page.references]
+
+  def _iter_biblio_pages(self, wosid):
+    for page in self._iter_cached_pages('_biblio:' + wosid, lambda: self._fetch_biblio_pages(wosid)):
+      yield [record for record in page if 'authors' in record and 'title' in record]
+
   def biblio(self, wosref):
     '''Gets article information in the bibliography of a given article. The provided wosref
     must be a ref dictionary contanining the "wosid" key.'''
-    results = self._biblio(wosref['wosid'])
-    records = [record for record in results if 'authors' in record and 'title' in record]
-    return records
-
-  @_cache
-  def _citations(self, wosid):
-    timespan = self.searchclient.factory.create('timeSpan')
+    return list(self.iter_biblio(wosref))
+
+  def iter_biblio(self, wosref):
+    '''Like biblio, but yields each record as its page of results arrives. The next page
+    is fetched while the current one is being consumed, and each page is cached as it arrives.'''
+    for page in self._iter_biblio_pages(wosref['wosid']):
+      for record in page:
+        yield record
+
+  def iter_biblio_many(self, wosrefs):
+    '''Like iter_biblio, but yields the tuple (index of the wosref, record) for each record in
+    the bibliographies of each of the given wosrefs, in order.'''
+    return self._iter_many(self._iter_biblio_pages, wosrefs)
+
+  def _fetch_citation_pages(self, wosid):
+    searchclient = self._search_client()
+    timespan = searchclient.factory.create('timeSpan')
     timespan.begin = datetime.date(1900, 1, 1)
     timespan.end = datetime.date.today()
 
-    edition = self.searchclient.factory.create('editionDesc')
+    edition = searchclient.factory.create('editionDesc')
     edition.collection = 'WOS'
     edition.edition = 'SCI'
 
-    query_func = lambda rp: self.searchclient.service.citingArticles('WOS', wosid, [edition], timespan, 'en', rp)
-    pages = self._paged_query(query_func)
-    citations = []
-    for page in pages:
-      doc = lxml.etree.fromstring(page.records)
-      ns = {'ns': doc.nsmap[None]}
-      for record in doc.xpath('/ns:records/ns:REC', namespaces=ns):
-        citations.append(_convert_wos_record(record, ns))
+    query_func = lambda rp: self._search_client().service.citingArticles('WOS', wosid, [edition], timespan, 'en', rp)
+    for page in _Prefetch(self._iter_pages(query_func)):
+      if not getattr(page, 'records', None): continue
+      yield list(_iter_page_records(page.records))
 
-    return citations
+  def _iter_citation_pages(self, wosid):
+    return self._iter_cached_pages('_citations:' + wosid, lambda: self._fetch_citation_pages(wosid))
 
   def citations(self, wosref):
     '''Returns articles that cite a given article specified by wosref,
     a ref dictionary with the key "wosid".'''
-    results = self._citations(wosref['wosid'])
-    return results
+    return list(self.iter_citations(wosref))
+
+  def iter_citations(self, wosref):
+    '''Like citations, but yields each article as its page of results arrives. The next page
+    is fetched while the current one is being consumed, and each page is cached as it arrives.'''
+    for page in self._iter_citation_pages(wosref['wosid']):
+      for record in page:
+        yield record
+
+  def iter_citations_many(self, wosrefs):
+    '''Like iter_citations, but yields the tuple (index of the wosref, citing article) for
+    each article citing each of the given wosrefs, in order.'''
+    return self._iter_many(self._iter_citation_pages, wosrefs)
+
+  def _submit(self, func, *args):
+    '''Runs func with the given arguments on the worker threads.
+    Returns a future whose get() method returns func's result.'''
+    if not self.pool:
+      self.pool = ThreadPool(self.workers)
+    return self.pool.apply_async(func, args)
+
+  def submit_search(self, author, title, journal=None, year=None):
+    '''Like search, but returns a future. Use gather to wait for many futures.'''
+    return self._submit(self.search, author, title, journal, year)
+
+  def submit_biblio(self, wosref):
+    '''Like biblio, but returns a future. Use gather to wait for many futures.'''
+    return self._submit(self.biblio, wosref)
+
+  def submit_citations(self, wosref):
+    '''Like citations, but returns a future. Use gather to wait for many futures.'''
+    return self._submit(self.citations, wosref)
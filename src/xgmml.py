@@ -1,10 +1,11 @@
 import sys
 import types
-import igraph
 from xml.etree.ElementTree import ElementTree
 import lxml.etree
 from lxml.builder import E
 
+import graphfile
+
 def _serialize_attrs(elem):
   xattrs = list()
   for k, v in elem.attributes().items():
@@ -72,9 +73,8 @@ def write(g, path):
   t.write(path, xml_declaration=True, encoding='UTF-8')
 
 def main(input_file_path, output_file_path):
-  with open(input_file_path, 'rb') as input_file:
-    g = igraph.Graph.Read(input_file, format='picklez')
-    write(g, output_file_path)
+  g = graphfile.read(input_file_path)
+  write(g, output_file_path)
 
 if __name__ == '__main__':
   main(sys.argv[1], sys.argv[2])